@@ -29,6 +29,7 @@ import Tkinter
 import time
 import datetime
 import select
+import random
 import math
 
 
@@ -404,6 +405,7 @@ class gui_Tkinter(Tkinter.Frame):
       self.__root = root
       self.__tcp = options["tcp"]
       self.__udp = options["udp"]
+      self.__trace = options.get("trace", False)
       self.blocked_features = { }
 
       Tkinter.Frame.__init__(self, root)
@@ -697,6 +699,10 @@ class gui_Tkinter(Tkinter.Frame):
 
    def send_to_radio(self, feature, value):
       my_str = feature + ": " + value + "\n"
+      if self.__trace:
+         # the simple server carries this through rigserve, see rigtrace.py
+         trace_id = "%08x" % random.getrandbits(32)
+         my_str = "trace: %s;mrig.send=%.6f\n" % (trace_id, time.time()) + my_str
       self.__tcp.sendall(my_str)
 
    def set_tuning_speed(self, value):
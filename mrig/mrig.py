@@ -41,7 +41,7 @@ udp.bind(("", LOCAL_UDP_PORT))
 udp.setblocking(0)
 
 root = Tk()
-gui = gui_Tkinter(root, tcp=tcp, udp=udp)
+gui = gui_Tkinter(root, tcp=tcp, udp=udp, trace=TRACE)
 root.mainloop()
 
 tcp.close()
@@ -25,3 +25,4 @@
 REMOTE_SERVER="192.168.2.1"       # IP address of simple server
 REMOTE_SERVER_TCP_PORT=14653      # TCP port of simple server
 LOCAL_UDP_PORT=20000              # mrig will listen for updates on this port
+TRACE=False                       # trace every change through the servers ("trace" in rigserve)
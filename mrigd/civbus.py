@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+#
+# File: civbus.py
+# Version: 1.0
+#
+# mrigd: CI-V bus reader, shared by the Icom rigs on one port
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# With "transceive" on, an Icom rig tells the bus whenever its freq or
+# mode changes (at the knob, or by scanning): a TR_FREQ (0x00) or
+# TR_MODE (0x01) frame to address 00.  Before, w_cmd0 flushed them away
+# with the serial input.
+#
+# CI-V is a multi-drop bus: several rigs, each at its own address
+# (CIVAD), can hang off one interface.  CivPort owns the serial port,
+# and a CivBus stands for each Icom backend (rig, address) on it.
+# attach() opens the port for the first rig and hands the others the
+# same one; the port is closed when its last rig is detached.  The
+# first rig to attach sets the baud rate.
+#
+# A thread per port reads every frame off the bus and routes it by
+# address:
+#
+#   - from a rig: to that rig's CivBus.  A broadcast of freq or mode
+#     updates the bus' state: the latest freq and mode, and when they
+#     came;
+#   - from us (the echo): to the CivBus of the rig it was sent to;
+#   - garbage (no addresses to go by): to the rig waiting for an answer.
+#
+# What reaches a CivBus and is not a broadcast goes to its backend,
+# which reads it through the bus as it read the port.  The bus has the
+# calls of the port that ic_codes uses (write, read, inWaiting,
+# flushInput), so the ICOM_CMD functions run on it unchanged.
+# flushInput only drops what is waiting for that backend.
+#
+# Only one rig may talk at a time, or the answers collide on the wire.
+# A write waits while another rig still owes answers to its last write
+# (one per frame sent), or until that rig's timeout runs out.  The rigs
+# must be opened in rigserve itself (not "process"): one process owns
+# the port.
+#
+# Icom.freq() and Icom.rx_mode() gets answer from the state without a
+# trip to the rig while the value is younger than STATE_MAX_AGE.  Only
+# broadcasts go into the state: a rig whose transceive has been turned
+# off stops refreshing it, so its values run out, and the gets poll the
+# rig again.  A put drops the value it changes.  The bus is live() while
+# the rig has broadcast within STATE_MAX_AGE.
+#
+# pipeline() sends several read frames back to back, up to 'window' of
+# them in flight, instead of waiting for each answer before the next
+# command.  The rig answers in order; an answer is matched to its
+# command by address (from the rig, to us) and by the command and
+# sub-command bytes it repeats (FB/FA: the oldest command not yet
+# answered).  A frame that got no answer (lost in a collision, or
+# garbled) is sent again, alone with the others that failed, up to
+# 'retries' times.  The answers are kept for PREFETCH_MAX_AGE: when
+# ic_codes then writes one of those frames, the bus hands back the echo
+# and the answer without going to the rig.  Writing any other frame
+# drops them, as it may change what they say.
+
+import threading, time
+import rigstats
+from ic_codes import ICOM_EOC, ICOM_ACK, ICOM_NAK, PREAMBLE, CONTROLLER, \
+    MAX_RD_DATA, bcd_freq
+
+BROADCAST = 0x00
+TR_FREQ   = 0x00
+TR_MODE   = 0x01
+STATE_MAX_AGE = 2.      # secs a broadcast value is trusted without a poll
+READ_SIZE = 64          # bytes taken off the port at most per read
+PIPELINE_WINDOW  = 4    # frames in flight at once
+PIPELINE_RETRIES = 2    # resends of a frame that got no answer
+PREFETCH_MAX_AGE = 1.   # secs a pipelined answer waits for its command
+
+ports = {}                  # port name:CivPort
+ports_lock = threading.Lock()
+
+# The CivBus of the rig at 'civ' on port 'name'.  The port is opened
+# with opener() (a serial port, already set up) if no rig has it yet.
+# 'owner' (the rig's name) may attach again to the same address, e.g.
+# on a re-init; another owner gets ValueError.
+def attach(name, civ, opener, owner=None):
+    ports_lock.acquire()
+    try:
+        port = ports.get(name)
+        if port == None:
+            port = CivPort(name, opener()).start()
+            ports[name] = port
+        old = port.buses.get(civ)
+        if old != None and old.owner != owner:
+            raise ValueError('CI-V address 0x%02X on %s is taken by %s' %
+                             (civ, name, old.owner))
+        bus = CivBus(port, civ, owner)
+        port.buses[civ] = bus
+        return bus
+    finally:
+        ports_lock.release()
+
+def detach(bus):
+    ports_lock.acquire()
+    try:
+        port = bus.port
+        if port.buses.get(bus.civ) is bus:
+            del port.buses[bus.civ]
+        if not port.buses and ports.get(port.name) is port:
+            del ports[port.name]
+            port.close()
+    finally:
+        ports_lock.release()
+
+class CivPort(object):
+    def __init__(self, name, ser):
+        self.name = name
+        self.ser = ser
+        self.buses = {}             # civ address:CivBus
+        self.buf = ''               # bytes of a frame not yet complete
+        self.cond = threading.Condition()
+        self.owner = None           # the bus owed answers, if any
+        self.expected = 0           # answers it is owed
+        self.busy_until = 0.        # when we stop waiting for them
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name='civbus-%s' % self.name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+
+    def close(self):
+        self.stop()
+        self.ser.close()
+
+    # ------- Reader thread ---------
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.ser.read(max(1, min(READ_SIZE,
+                                                self.ser.inWaiting())))
+            except (OSError, IOError, ValueError):
+                break               # port closed
+            if data:
+                self.received(data)
+
+    def received(self, data):
+        self.buf += data
+        while True:
+            end = self.buf.find(ICOM_EOC)
+            if end < 0:
+                break
+            frame, self.buf = self.buf[:end+1], self.buf[end+1:]
+            self.route(frame)
+        if len(self.buf) > MAX_RD_DATA:     # no FD coming: let it through
+            frame, self.buf = self.buf, ''
+            self.route(frame)
+
+    def route(self, frame):
+        bus = None
+        start = frame.find(PREAMBLE)
+        if start >= 0 and len(frame) - start >= 6:
+            to, sender = ord(frame[start+2]), ord(frame[start+3])
+            if sender == CONTROLLER:
+                bus = self.buses.get(to)
+            else:
+                bus = self.buses.get(sender)
+                if bus != None and to == CONTROLLER:
+                    self.answered(bus)
+        if bus == None:
+            bus = self.owner
+        if bus != None:
+            bus.deliver(frame)
+
+    # ------- Taking turns on the wire ---------
+
+    # Write 'data' (whole frames) for 'bus' once no other rig owes us an
+    # answer.
+    def send(self, bus, data):
+        self.cond.acquire()
+        try:
+            while self.owner not in (None, bus):
+                left = self.busy_until - time.time()
+                if left <= 0:
+                    break           # its answers are not coming
+                self.cond.wait(left)
+            now = time.time()
+            if self.owner is bus and now < self.busy_until:
+                self.expected += data.count(ICOM_EOC)
+            else:
+                self.expected = data.count(ICOM_EOC)
+            self.owner = bus
+            # the port's own timeout: a backend may wait less for an
+            # answer (see linkctl.py), but the rig may still send it
+            self.busy_until = now + self.ser.timeout
+            return self.ser.write(data)
+        finally:
+            self.cond.release()
+
+    def answered(self, bus):
+        self.cond.acquire()
+        if self.owner is bus:
+            self.expected -= 1
+            if self.expected <= 0:
+                self.owner = None
+                self.cond.notifyAll()
+        self.cond.release()
+
+class CivBus(object):
+    def __init__(self, port, civ, owner=None):
+        self.port = port
+        self.civ = civ
+        self.owner = owner
+        self.timeout = port.ser.timeout
+        self.cond = threading.Condition()
+        self.rx = ''                # bytes for the backend
+        self.state = {}             # 'freq'/'mode': (value, time)
+        self.heard = 0.             # time of the last broadcast
+        self.prefetched = {}        # frame:(answer frame, time)
+        self.prefetched_hit = False # the last write was answered so
+        self.labels = (('driver','icom'), ('civ','0x%02X' % civ))
+
+    def close(self):
+        detach(self)
+
+    # A frame the port routed to us.
+    def deliver(self, frame):
+        if self.broadcast(frame):
+            return
+        self.cond.acquire()
+        self.rx += frame
+        self.cond.notifyAll()
+        self.cond.release()
+
+    # Take in a transceive frame of our rig; False if it is not one.
+    def broadcast(self, frame):
+        start = frame.find(PREAMBLE)
+        if start < 0 or len(frame) - start < 6:
+            return False
+        to, sender, cmd = [ ord(c) for c in frame[start+2:start+5] ]
+        if to != BROADCAST or sender != self.civ:
+            return False
+        data = frame[start+5:-1]
+        if cmd == TR_FREQ and len(data) >= 5:
+            self.update('freq', float(bcd_freq(data)))
+        elif cmd == TR_MODE and len(data) >= 1:
+            self.update('mode', frame[start+4:-1])
+        else:
+            return False
+        self.heard = time.time()
+        rigstats.count('civ_transceive_total', self.labels)
+        return True
+
+    # ------- State ---------
+
+    # 'mode' is kept as RD_OP_MODE answers it: cmd, mode [, passband].
+    def update(self, name, value):
+        self.state[name] = (value, time.time())
+
+    def forget(self, name):
+        self.state.pop(name, None)
+
+    # Has the rig broadcast lately (it has transceive on)?
+    def live(self):
+        return time.time() - self.heard < STATE_MAX_AGE
+
+    # The broadcast value of 'name', if recent enough; else None.
+    def get(self, name):
+        value = self.state.get(name)
+        if value == None or time.time() - value[1] > STATE_MAX_AGE:
+            return None
+        rigstats.count('civ_state_hits_total', self.labels)
+        return value[0]
+
+    # ------- Pipelined commands ---------
+
+    # Send the read 'frames' (see ic_codes.frame), 'window' at a time,
+    # and keep their answers for the commands that follow.  Returns
+    # {frame: answer frame} of those answered.
+    def pipeline(self, frames, window=PIPELINE_WINDOW,
+                 retries=PIPELINE_RETRIES):
+        self.prefetched = {}
+        pending = []
+        for f in frames:
+            if f not in pending:
+                pending.append(f)
+        tries = dict.fromkeys(pending, 0)
+        answers = {}
+        while pending:
+            chunk = pending[:window]
+            got = self.exchange(chunk)
+            answers.update(got)
+            for f in chunk:
+                if f not in got:
+                    tries[f] += 1
+                    if tries[f] <= retries:
+                        rigstats.count('civ_pipeline_resends_total',
+                                       self.labels)
+            pending = [ f for f in pending
+                        if f not in answers and tries[f] <= retries ]
+        now = time.time()
+        for f in answers:
+            self.prefetched[f] = (answers[f], now)
+        return answers
+
+    # Write 'chunk' at once and match the answers: {frame: answer frame}.
+    def exchange(self, chunk):
+        self.flushInput()
+        self.port.send(self, ''.join(chunk))
+        waiting = list(chunk)       # in the order the rig answers them
+        got = {}
+        buf = ''
+        deadline = time.time() + self.timeout
+        while waiting:
+            data = self.take(deadline)
+            if data == '':
+                break               # the rest are lost
+            buf += data
+            while True:
+                end = buf.find(ICOM_EOC)
+                if end < 0:
+                    break
+                frame, buf = buf[:end+1], buf[end+1:]
+                f = self.match(frame, waiting)
+                if f != None:
+                    # answered in order: those before it will never be
+                    i = waiting.index(f)
+                    got[f] = frame[frame.find(PREAMBLE):]
+                    waiting = waiting[i+1:]
+                    deadline = time.time() + self.timeout
+        return got
+
+    # The frame in 'waiting' that 'frame' answers, or None (our echo,
+    # another rig, garbage).
+    def match(self, frame, waiting):
+        start = frame.find(PREAMBLE)
+        if start < 0 or len(frame) - start < 6:
+            return None
+        to, sender = ord(frame[start+2]), ord(frame[start+3])
+        if to != CONTROLLER or sender != self.civ:
+            return None
+        payload = frame[start+4:-1]
+        if payload in (ICOM_ACK, ICOM_NAK):
+            return waiting[0]
+        for f in waiting:
+            if payload.startswith(f[4:-1]):
+                return f
+        return None
+
+    # What the reader has for us, waiting for it until 'deadline'.
+    def take(self, deadline):
+        self.cond.acquire()
+        try:
+            while self.rx == '':
+                left = deadline - time.time()
+                if left <= 0:
+                    return ''
+                self.cond.wait(left)
+            data, self.rx = self.rx, ''
+            return data
+        finally:
+            self.cond.release()
+
+    # ------- The port, as ic_codes sees it ---------
+
+    # A frame answered by pipeline() is not sent again: its echo and
+    # answer are there to be read.
+    def write(self, data):
+        hit = self.prefetched.pop(data, None)
+        self.prefetched_hit = hit != None and \
+            time.time() - hit[1] < PREFETCH_MAX_AGE
+        if self.prefetched_hit:
+            self.cond.acquire()
+            self.rx += data + hit[0]
+            self.cond.notifyAll()
+            self.cond.release()
+            rigstats.count('civ_prefetch_hits_total', self.labels)
+            return len(data)
+        self.prefetched = {}
+        return self.port.send(self, data)
+
+    def read(self, size=1):
+        deadline = time.time() + self.timeout
+        self.cond.acquire()
+        try:
+            while len(self.rx) < size:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            data, self.rx = self.rx[:size], self.rx[size:]
+            return data
+        finally:
+            self.cond.release()
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    def flushInput(self):
+        self.cond.acquire()
+        self.rx = ''
+        self.cond.release()
+
+    def flushOutput(self):
+        self.port.ser.flushOutput()
@@ -59,8 +59,8 @@ DUMMY_BAND_MAIN             = [ (1.e6,30.e6)]
 DUMMY_BANDS                 = { 'MAIN':DUMMY_BAND_MAIN }
 
 class Dummy(Backend):
-    def __init__(self):
-        Backend.__init__(self)
+    def __init__(self, rig_name='dummy'):
+        Backend.__init__(self, rig_name)
 
         # Override Backend settings (for info print)
         self.backend_id =   DUMMY_BACKEND_ID
@@ -56,6 +56,10 @@ NOT_DEF =       NAK+'Operation not defined.'
 
 NULL_TUP = ()
 
+BATCH_SEP   = ';'       # separates sub-commands in a 'batch' request
+BATCH_START = 'BATCH'   # first line of a batch response
+BATCH_END   = 'END'     # last line of a batch response
+
 # Auxilliary routines
 
 def in_range(rangelist,val):   # is val in rangelist[0],[1]?
@@ -85,3 +89,40 @@ def is_nak(x):      # argument has arbitrary type, is it a NAK message?
     else:
         return False
 
+
+# Batch requests: 'batch get r.VFOA.freq; put r.MAIN.af_gain 0.5; ...'
+# The response is framed, with a status and a length for each item:
+#   BATCH <n>
+#   OK|NAK <length>
+#   <reply, exactly length chars>
+#   ...
+#   END
+
+def make_batch(cmds):   # list of sub-command strings -> one request
+    return 'batch ' + (BATCH_SEP + ' ').join(cmds)
+
+def format_batch(replies):  # list of sub-command replies -> response
+    r = '%s %d\n' % (BATCH_START, len(replies))
+    for x in replies:
+        x = str(x)
+        if x.startswith(NAK1): status = 'NAK'
+        else: status = 'OK'
+        r += '%s %d\n%s\n' % (status, len(x), x)
+    return r + BATCH_END
+
+def parse_batch(s):     # response -> list of replies, or None if incomplete
+    p = s.find('\n')
+    if p < 0: return None
+    head = s[:p].split()
+    if len(head) != 2 or head[0] != BATCH_START: return None
+    replies = []
+    p += 1
+    for i in range(int(head[1])):
+        q = s.find('\n', p)
+        if q < 0: return None
+        status, length = s[p:q].split()
+        p = q + 1 + int(length) + 1
+        if p > len(s): return None
+        replies.append(s[q+1:p-1])
+    if not s[p:].startswith(BATCH_END): return None
+    return replies
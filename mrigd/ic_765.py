@@ -76,8 +76,8 @@ GETPUT = ['GET', 'PUT']
 # Other similar models: 725-729, 735, 737, ???
 
 class IC_765(Icom):
-    def __init__(self):
-        Icom.__init__(self)
+    def __init__(self, rig_name='IC_765'):
+        Icom.__init__(self, rig_name)
         self.civ_address =  IC765_ADDRESS
         self.bands =        IC765_BANDS
         self.backend_id =   IC765_BACKEND_ID
@@ -37,7 +37,9 @@
 #   other specialized ops.
 
 
+import time
 from globals import *
+import rigstats
 
 ICOM_ACK= "\xFB"    # OK byte (as 1-char string)
 ICOM_NAK= "\xFA"    # NG byte
@@ -45,6 +47,14 @@ ICOM_EOC= "\xFD"    # End of command character
 ICOM_EOC_int= 0xFD  # same, as integer
 
 MAX_RD_DATA= 60     # limit size of received data from rig
+CONTROLLER= 0xE0    # our (the computer's) CI-V address
+PREAMBLE= "\xFE\xFE"
+
+# Serial transaction times go to rigstats as serial_seconds, with the
+# 'command' phase (write + echo) and the 'response' phase apart.
+SERIAL_CMD  = (('driver','icom'), ('phase','command'))
+SERIAL_RESP = (('driver','icom'), ('phase','response'))
+SERIAL_ICOM = (('driver','icom'),)
 
 # --------- BCD utilities ----------------
 # pack 4 BCD digits (0-9) into a hex 2-tuple
@@ -62,23 +72,79 @@ def nib(s,i):
   if i%2 == 0: k = k >> 4
   return k & 0xf
 
+# Lookup tables, so that the serial path does no string formatting:
+# BCD_VAL[byte] is the value of a byte of 2 BCD digits (0x42 -> 42),
+# BCD_CHR[n] the byte for 0 <= n <= 99.  CHR[i] is chr(i).
+CHR = [ chr(i) for i in xrange(256) ]
+BCD_VAL = [ (i >> 4) * 10 + (i & 0x0F) for i in xrange(256) ]
+BCD_CHR = [ CHR[(i / 10) << 4 | i % 10] for i in xrange(100) ]
+
+def bcd_freq(data):     # 5 bytes, least significant first -> Hz
+    f = 0
+    for c in data[4::-1]:
+        f = f * 100 + BCD_VAL[ord(c)]
+    return f
+
+def freq_bcd(f):        # Hz -> 5 bytes, least significant first
+    f = int(f)
+    out = ''
+    for i in xrange(5):
+        out += BCD_CHR[f % 100]
+        f /= 100
+    return out
+
+def level_bcd(i):       # 0 - 9999 -> 2 bytes ("0255" -> 02 55)
+    return BCD_CHR[i / 100 % 100] + BCD_CHR[i % 100]
+
 # ------- Icom communications routines ---------
 
-def w_cmd0(ser,civ,tup):
+# A frame is built in one string and written with one call; the echo
+# and the response are taken in as few reads as the port allows, up to
+# the FD that ends them.
+
+def frame(civ,tup,data=''):
+    """
+    frame builds the CI-V frame of a command tuple and its (already
+    encoded) data, from us to the rig at address civ.
+    IN: civ address, command tuple, data string
+    OUT: frame string
+    """
+    return PREAMBLE + CHR[civ] + CHR[CONTROLLER] + \
+        ''.join([ CHR[i] for i in tup ]) + data + ICOM_EOC
+
+def read_frame(ser,size):
+    """
+    read_frame reads at least size bytes, then whatever the port holds,
+    until the data ends in FD (or MAX_RD_DATA bytes, or a timeout).
+    Bytes after the FD are dropped: w_cmd0 flushes them anyway.
+    IN: serial port, bytes expected at least
+    OUT: string read, possibly short
+    """
+    a = ser.read(size)
+    while len(a) >= size and a[-1:] <> ICOM_EOC and len(a) < MAX_RD_DATA:
+        c = ser.read(max(1, ser.inWaiting()))
+        if c == '': break
+        a += c
+    end = a.find(ICOM_EOC, 4)
+    if end >= 0:
+        a = a[:end+1]
+    return a
+
+def w_cmd0(ser,civ,tup,data=''):
     """
     w_cmd0 sends a "simple" command tuple, no further arguments.
-    IN: arbitrary tuple of command bytes
+    IN: arbitrary tuple of command bytes, optional data string
     OUT: ACK/NAK
     """
+    t0 = time.time()
     ser.flushInput()        # Flush serial input, to be sure.
-    fullcmd = ( 0xFE, 0xFE, civ, 0xE0 ) + tup + (ICOM_EOC_int,)
-    # source ad = 0xE0, dest ad = civ
-    for i in fullcmd: 
-        ser.write(chr(i))
-    for i in fullcmd:
-        a = ser.read()
-        if a<>chr(i):
-            return NAK+"w_cmd0: Command echo error"
+    fullcmd = frame(civ,tup,data)
+    ser.write(fullcmd)
+    a = ser.read(len(fullcmd))          # the echo
+    if a <> fullcmd:
+        serial_failed(len(a) < len(fullcmd))
+        return NAK+"w_cmd0: Command echo error"
+    rigstats.observe('serial_seconds', SERIAL_CMD, time.time() - t0)
     return ACK
 
 def w_cmd(ser,civ,tup,tup2):
@@ -97,20 +163,22 @@ def get_response(ser):
     IN: (none)
     OUT:  string of raw bytes read from rig or NAK;
     """
-    preamble = ser.read(size=4)
-    if not preamble[:3] == '\xFE\xFE\xE0':
+    t0 = time.time()
+    a = read_frame(ser, 6)      # shortest answer: FE FE E0 civ FB FD
+    if not a[:3] == '\xFE\xFE\xE0':
         # check dest adr only, not source (which depends on civ)
+        serial_failed(len(a) < 4)
         return NAK+'get_response: preamble error'
-    a = ""
-    for i in xrange(MAX_RD_DATA):
-        c = ser.read(size=1)
-        if c == ICOM_EOC: break
-        a += c
-#    print "len(a)=%d" % len(a),
-#    for i in range(len(a)):
-#    print "ord(a['%d'])=0x%x " % (i,ord(a[i])),
-#    print
-    return a    #### check: can start with a '?' --> error??
+    rigstats.observe('serial_seconds', SERIAL_RESP, time.time() - t0)
+    if a[-1:] == ICOM_EOC:
+        return a[4:-1]
+    return a[4:]    #### check: can start with a '?' --> error??
+
+def serial_failed(timed_out):   # count a failed transaction
+    if timed_out:
+        rigstats.count('serial_timeouts_total', SERIAL_ICOM)
+    else:
+        rigstats.count('serial_errors_total', SERIAL_ICOM)
 
 # ------- "helper functions" referenced in ICOM_CMD ------------
 
@@ -132,9 +200,7 @@ def w_level2(ser,civ,tup,ival): # ival 0 - 255 int
     """
     if ival < 0 or ival > 255:
         return NAK+'w_level2: int level out of range.'
-    s = "%04d" % ival
-    err = w_cmd(ser,civ,tup,
-            bcd4(int(s[0]),int(s[1]),int(s[2]),int(s[3]) ) )
+    err = w_cmd0(ser,civ,tup,level_bcd(ival))
     if get_response(ser) <> ICOM_ACK:
         return NAK+'w_level2: Bad response after Icom write.'
     return ACK
@@ -158,9 +224,7 @@ def r_level2(ser,civ,tup):
     v = get_response(ser)      # err check?
     if is_nak(v): return v
     try:
-        u1 = ubcd(v[2])[1]
-        ux = ubcd(v[3])
-        ansi = u1*100 + ux[0]*10 + ux[1] # 000-255 bcd
+        ansi = (ord(v[2]) & 0x0F)*100 + BCD_VAL[ord(v[3])] # 000-255 bcd
     except IndexError: return NAK+'r_level2: index error'
     return ansi                # range 0 - 255
 
@@ -193,10 +257,8 @@ def r_freq(ser,civ,tup):
     if is_nak(err): return err
     ans = get_response(ser)
     if is_nak(ans): return ans
-    f=0
-    for k in [10,11,8,9,6,7,4,5,2,3]: 
-        f=10*f + nib(ans,k)
-    return float(f)
+    if len(ans) < 6: return NAK+'r_freq: short answer from rig.'
+    return float(bcd_freq(ans[1:6]))
 
 def r_freq_off(ser,civ,tup):        # works on Omni6 - verify for others
     """
@@ -207,9 +269,8 @@ def r_freq_off(ser,civ,tup):        # works on Omni6 - verify for others
     if is_nak(err): return err
     ans = get_response(ser)
     if is_nak(ans): return ans
-    f=0
-    for k in [2,3,0,1]: 
-        f=10*f + nib(ans,k)
+    if len(ans) < 2: return NAK+'r_freq_off: short answer from rig.'
+    f = BCD_VAL[ord(ans[1])]*100 + BCD_VAL[ord(ans[0])]
     f *= 10.
     if f >= 90000.:                 # 9's complement for negatives
         f = f - 100000.
@@ -220,11 +281,7 @@ def w_freq(ser,civ,tup,freq):
     IN: tup, float frequency Hz
     OUT: ACK/NAK
     """
-    fs = "%010d" % int(freq)
-    out  = bcd4(int(fs[8]),int(fs[9]),int(fs[6]),int(fs[7]))
-    out += bcd4(int(fs[4]),int(fs[5]),int(fs[2]),int(fs[3]))
-    out += bcd2(int(fs[0]),int(fs[1]))
-    err = w_cmd(ser,civ,tup,out)
+    err = w_cmd0(ser,civ,tup,freq_bcd(freq))
     if is_nak(err): return err
     if get_response(ser)[0] <> ICOM_ACK:
         return NAK+'w_freq: command not accepted by rig.'
@@ -238,9 +295,8 @@ def w_freq_off(ser,civ,tup,freq):   # Works for Omni6, must test for others
     ifreq = int(freq)
     if ifreq < 0:
         ifreq = 100000 + ifreq      # 9's complement
-    fs = "%05d" % ifreq
-    out = bcd4(int(fs[2]),int(fs[3]),int(fs[0]),int(fs[1]))
-    err = w_cmd(ser,civ,tup,out)
+    ifreq /= 10                     # 10 Hz units, 4 digits
+    err = w_cmd0(ser,civ,tup,BCD_CHR[ifreq % 100] + BCD_CHR[ifreq / 100 % 100])
     if is_nak(err): return err
     if get_response(ser)[0] <> ICOM_ACK:
         return NAK+'w_freq_off: command not accepted by rig.'
@@ -86,8 +86,8 @@ R75_CAPABILITIES = udict(IC_COMMON_CAPABILITIES,
 GETPUT = ['GET', 'PUT']
 
 class IC_r75(Icom):
-    def __init__(self):
-        Icom.__init__(self)
+    def __init__(self, rig_name='IC_r75'):
+        Icom.__init__(self, rig_name)
         self.vfo_step = 0
         self.agc_mode_v = ''
         self.af_gain_v = 0
@@ -101,6 +101,8 @@ class IC_r75(Icom):
         self.atten_dict =   R75_ATTEN_DICT
         self.tx_list =      R75_TX_LIST
         self.mode_list =    R75_MODE_MAP.keys()
+        self.mode_map =     R75_MODE_MAP
+        self.mode_map_r =   R75_MODE_MAPr
 #        self.bandpass_dict = R75_BANDPASS_SETTINGS
         self.agc_mode_list = R75_AGC_MODE_LIST
         self.mic_source_list = R75_MIC_SOURCES
@@ -108,6 +110,7 @@ class IC_r75(Icom):
         self.rx_ant_list =  R75_RX_ANTENNAS_DICT.keys()
         self.rx_ant_dict =  R75_RX_ANTENNAS_DICT
         self.capabilities = R75_CAPABILITIES
+        self.civ_address =  R75_ADDRESS
         return
 
     def info(self,tp,rx='',data=''): 
@@ -80,8 +80,8 @@ R8500_CAPABILITIES = udict(IC_COMMON_CAPABILITIES,
 GETPUT = ['GET', 'PUT']
 
 class IC_r8500(Icom):
-    def __init__(self):
-        Icom.__init__(self)
+    def __init__(self, rig_name='IC_r8500'):
+        Icom.__init__(self, rig_name)
         self.backend_id =   R8500_BACKEND_ID
         self.vfo_list=      R8500_VFO_LIST
         self.vfo_step_list= R8500_VFO_STEP_MAP.keys()
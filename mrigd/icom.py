@@ -55,6 +55,7 @@ import sys, serial, time
 
 from backend import *
 from ic_codes import *
+import civbus, linkctl
 
 # Capabilities:  This is a Python dictionary that expresses all the methods that
 # are being supported for a particular Icom model.  "All" CI-V rigs are supposed
@@ -63,7 +64,19 @@ from ic_codes import *
 
 #IC_COMMON_CAPABILITIES = set(['TR_FREQ','TR_MODE', 'RD_FRQ_EDGES', 'RD_OP_FRQ',
 #    'RD_OP_MODE','SET_FREQ', 'SET_MODE', 'VFO_MODE', 'MEM_WRITE', 'MEM2VFO'])
-IC_COMMON_CAPABILITIES = { 'freq':'rw', 'rx_mode':'rw', 'tx_mode':'rw'}
+# 'init' and 'info' are listed too, as rigserve takes a method left out
+# for not supported by the model.
+IC_COMMON_CAPABILITIES = { 'init':'rw', 'info':'r',
+    'freq':'rw', 'rx_mode':'rw', 'tx_mode':'rw'}
+
+# Gets that prefetch() can send ahead, pipelined: method:ICOM_CMD read
+# (sent without arguments, as the method's ic_get sends it).
+PIPELINE_READS = { 'freq':'RD_OP_FRQ', 'rx_mode':'RD_OP_MODE',
+    'rit':'RD_OFF_FREQ', 'af_gain':'GET_AF', 'rf_gain':'GET_RF',
+    'strength_raw':'RD_STRENGTH', 'squelch_open':'RD_SQL_STATUS',
+    'transmit':'GET_XMT_ON', 'power':'GET_RF_POWER' }
+
+ICOM_TIMEOUT = 0.2          # secs, serial read timeout (see linkctl.py)
 
 #save for later use
 # {'vfo_select':'w', 'vfo_step':'rw', 'rit':'rw', 'agc_mode':'rw',
@@ -73,8 +86,8 @@ IC_COMMON_CAPABILITIES = { 'freq':'rw', 'rx_mode':'rw', 'tx_mode':'rw'}
 # Receiver-related methods, used by all Icom gear -- at least the HF
 # models.
 class Icom(Backend):
-    def __init__(self):
-        Backend.__init__(self)
+    def __init__(self, rig_name='icom'):
+        Backend.__init__(self, rig_name)
         self.ser = None             # Serial port object
         self.port = ''              # device name
         self.port_rate = 0          # params as required by Orion
@@ -83,7 +96,10 @@ class Icom(Backend):
         self.port_stopbits = 1
         self.port_predelay = 0.0
         self.port_postdelay = 0.02
-        self.ser = False
+        self.ser = False            # civbus.CivBus on the port, once open
+        # timeouts per command from the replies seen (see linkctl.py)
+        self.link = linkctl.LinkControl(self.__class__.__name__,
+                                        ICOM_TIMEOUT)
 #
         self.capabilities = IC_COMMON_CAPABILITIES  # default for Icom
         self.vfo_step_v = 0
@@ -126,23 +142,40 @@ class Icom(Backend):
         if nlst >= 5: self.port_stopbits = int(lst[4])
         if nlst >= 6: self.port_predelay = float(lst[5])
         if nlst >= 7: self.port_predelay = float(lst[6])
-        # open the port
-        # Note: rtscts=0 -> no flow control (required for Omni w/o rtscts jumpers in cable)
-        #   It would be better to use rtscts=1 when rig supports it.
+        if self.ser:
+            self.ser.close()
+            self.ser = False
+        # open the port, or share it with the other rigs on this CI-V bus
+        # (see civbus.py): a reader thread routes each rig its frames, and
+        # takes the transceive broadcasts off the bus
         try:
-            self.ser = serial.Serial(
-                self.port, 
-                baudrate=self.port_rate,
-                bytesize=self.port_size,
-                parity=self.port_parity,
-                stopbits=self.port_stopbits,
-                xonxoff=0,rtscts=0,timeout=0.2)
+            self.ser = civbus.attach(self.port, self.civ_address,
+                                     self.open_port, self.rig_name)
         except serial.SerialException:
             return NAK+'Cannot open serial port.'
-        self.ser.flushInput()
-        self.ser.flushOutput()
+        except ValueError, e:
+            return NAK+str(e)+'.'
         return ACK
 
+    def open_port(self):
+        # Note: rtscts=0 -> no flow control (required for Omni w/o rtscts jumpers in cable)
+        #   It would be better to use rtscts=1 when rig supports it.
+        port = serial.Serial(
+            self.port, 
+            baudrate=self.port_rate,
+            bytesize=self.port_size,
+            parity=self.port_parity,
+            stopbits=self.port_stopbits,
+            xonxoff=0,rtscts=0,timeout=ICOM_TIMEOUT)
+        port.flushInput()
+        port.flushOutput()
+        return port
+
+    def close(self):                # leave the bus; the last rig closes it
+        if self.ser:
+            self.ser.close()
+            self.ser = False
+
     def ic_put(self, meth, s, cmd): # cmd is sometimes a level, byte, or freq ##
         """
         ic_put sends the Icom's command from the command table, after
@@ -150,7 +183,11 @@ class Icom(Backend):
         """
         if 'w' in self.capabilities.get(meth,''):
             thiscmd = ICOM_CMD[s]
-            code = thiscmd[FN](self.ser, self.civ_address, thiscmd[BN], cmd)
+            # paced, and with the fixed timeout: a set may take the rig
+            # longer to answer than the reads timed so far
+            code = self.link.run(None, lambda timeout:
+                                 self.ic_call(thiscmd[FN], ICOM_TIMEOUT,
+                                              thiscmd[BN], cmd))
             return code         # ACK or NAK
         else:
             return NOT_DEF         # no capability!
@@ -162,12 +199,46 @@ class Icom(Backend):
         """
         if 'r' in self.capabilities.get(meth,''):
             thiscmd = ICOM_CMD[s]
-            data = thiscmd[FN](self.ser, self.civ_address, thiscmd[BN] + cmd)
+            data = self.link.run(s, lambda timeout:
+                                 self.ic_call(thiscmd[FN], timeout,
+                                              thiscmd[BN] + cmd))
 #            if is_nak(data): return data
             return data
         else:
             return NOT_DEF         # no capability!
 
+    # Call ic_codes function 'fn' waiting up to 'timeout' for the rig,
+    # and put the bus' own timeout back after it.
+    def ic_call(self, fn, timeout, *args):
+        try:
+            self.ser.timeout = timeout
+            data = fn(self.ser, self.civ_address, *args)
+        finally:
+            self.ser.timeout = ICOM_TIMEOUT
+        if self.ser.prefetched_hit:
+            self.link.untimed()     # answered by prefetch(), not the rig
+        return data
+
+    def prefetch(self, calls):
+        """
+        prefetch sends the CI-V reads of several gets at once (see
+        civbus.py), so the gets that follow find their answers ready.
+        IN: list of (method, trv) about to be called with T_GET
+        OUT: number of reads answered
+        """
+        if not self.ser: return 0
+        frames = []
+        for meth, trv in calls:
+            s = PIPELINE_READS.get(meth)
+            if s == None or 'r' not in self.capabilities.get(meth,''):
+                continue
+            if meth in ('freq', 'rx_mode') and self.ser.live():
+                continue            # kept up by transceive
+            frames.append(frame(self.civ_address, ICOM_CMD[s][BN]))
+        if len(frames) < 2:
+            return 0                # nothing to gain
+        return len(self.ser.pipeline(frames))
+
     def init(self,tp,rx='',data='/dev/ttyS0'):
 #           Firmware initalize
         if tp == T_PUT:
@@ -213,8 +284,12 @@ class Icom(Backend):
 #            thiscmd = ICOM_CMD['SET_FREQ']
 #            err=thiscmd[FN](self.ser, self.civ_address, thiscmd[BN], f)
             if is_nak(err): return err
+            self.ser.forget('freq')     # until the rig broadcasts it
             return ACK
         elif tp == T_GET:
+            if self.ser:
+                resp = self.ser.get('freq')     # from transceive, if on
+                if resp != None: return '%.f' % resp
 #            thiscmd = ICOM_CMD['RD_OP_FRQ']
 #            freq,err = thiscmd[FN](self.ser, self.civ_address, thiscmd[BN])
             resp = self.ic_get('freq', 'RD_OP_FRQ') # resp=(freq,err)
@@ -400,12 +475,17 @@ class Icom(Backend):
 #                                            (code >> 4, code & 0x0F))
             err = self.ic_put('rx_mode', 'SET_MODE', (code >> 4, code & 0x0F) )
             if is_nak(err): return err
+            self.ser.forget('mode')     # until the rig broadcasts it
             return ACK
         elif tp == T_GET:
+            ms = None
+            if self.ser:
+                ms = self.ser.get('mode')       # from transceive, if on
 #            thiscmd = ICOM_CMD['RD_OP_MODE']
 #            ms,err = thiscmd[FN](self.ser, self.civ_address, thiscmd[BN])
-            ms = self.ic_get('rx_mode', 'RD_OP_MODE')
-            if is_nak(ms): return ms
+            if ms == None:
+                ms = self.ic_get('rx_mode', 'RD_OP_MODE')
+                if is_nak(ms): return ms
             if len(ms) < 3: ms = ms + '\0'  # Omni6 & 735 (?) don't return bandwidth
             try:
                 m = ord(ms[1]) << 4 | ord(ms[2])    # recompose code number
@@ -455,8 +535,8 @@ class Icom(Backend):
 # Icom_trx may be withdrawn in a future release.
 
 class Icom_trx(Icom):
-    def __init__(self):
-        Icom.__init__(self)
+    def __init__(self, rig_name='icom'):
+        Icom.__init__(self, rig_name)
         self.tx_power = 0.
         self.tx_power_max = 100.    # Watts, will be rig dependent
         return
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# File: linkctl.py
+# Version: 1.0
+#
+# mrigd: adaptive timeouts, pacing and retries of a backend's serial link
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# The serial timeout of a backend (0.2 s for Icom) and its waits (the
+# Orion's ORION_DSP_DELAY and GAU_WT) are set for the slowest rig on its
+# worst day, and every command pays them.  A LinkControl learns what the
+# rig at the other end really needs:
+#
+#   - timeouts: the reply time of each kind of command (the backend
+#     names it: the ICOM_CMD entry, the Orion query) is kept for the
+#     last LATENCY_SAMPLES replies.  Once MIN_SAMPLES are in, a read of
+#     that kind times out after TIMEOUT_MARGIN times their
+#     TIMEOUT_QUANTILE, plus TIMEOUT_SLACK, never more than the fixed
+#     timeout;
+#   - pacing: every command waits the gap between commands (BASE_GAP)
+#     that the rig is seen to need: none at first, and GAP_GROW times
+#     longer (up to MAX_GAP) each time a query is lost with no other
+#     wait to blame.  hold(cls) after a command says that the next one
+#     must also wait the gap of 'cls' (e.g. 'dsp' after a filter
+#     change), which starts at the fixed wait.  After GAP_RUN queries
+#     answered at a gap, it is taken as safe and the next queries try
+#     GAP_SHRINK times it; the first one lost ends the search at the
+#     last safe gap.  A query lost at the safe gap makes it GAP_GROW
+#     times longer (up to twice the fixed wait).  Sets get no answer,
+#     so they always wait the safe gap.  What is learned is kept per
+#     firmware (the backend's class, e.g. TT_orion_v1), for the next rig
+#     of the kind opened;
+#   - retries: only a command that got no answer in time is sent again,
+#     after BACKOFF secs (doubled on each retry), up to 'retries' times,
+#     and with the fixed timeout.
+#
+# A backend runs each command through run(), on its worker thread.  The
+# counters link_saved_seconds_total (waits and timeouts cut short) and
+# link_retry_seconds_total (time spent retrying) tell what the adaptive
+# mode gains; ADAPTIVE = False gives the fixed waits, for comparison.
+
+import threading, time, collections
+import rigstats
+from globals import *
+
+ADAPTIVE = True
+LATENCY_SAMPLES  = 50
+MIN_SAMPLES      = 10
+TIMEOUT_QUANTILE = 0.95
+TIMEOUT_MARGIN   = 2.
+TIMEOUT_SLACK    = 0.01     # secs, for the scheduler
+MIN_TIMEOUT      = 0.02     # secs
+LINK_RETRIES     = 2
+BACKOFF          = 0.02     # secs before the first retry
+GAP_RUN          = 5        # queries answered before a gap is safe
+GAP_SHRINK       = 0.7
+GAP_GROW         = 1.5
+MIN_GAP          = 0.005    # secs; below this the gap is 0
+MAX_GAP          = 0.5      # secs, longest BASE_GAP learned
+BASE_GAP         = ''       # pacing class of every command
+
+# firmware: {pacing class: Gap}, shared by the rigs of one firmware
+learned = {}
+lock = threading.Lock()
+
+class Gap(object):
+    # 'fixed': the fixed wait, the gap learned starts there and never
+    # grows past 'ceiling' (by default, twice the fixed wait).
+    def __init__(self, fixed, ceiling=None):
+        self.fixed = fixed
+        if ceiling == None:
+            ceiling = 2 * fixed
+        self.ceiling = ceiling
+        self.safe = fixed           # sets wait this
+        self.trying = fixed         # queries wait this
+        self.runs = 0               # queries answered at 'trying'
+        self.settled = False        # no shorter gap to look for
+
+    def answered(self):
+        self.runs += 1
+        if self.runs >= GAP_RUN and not self.settled:
+            self.safe = self.trying
+            self.trying *= GAP_SHRINK
+            if self.trying < MIN_GAP:
+                self.trying = 0.
+            self.settled = self.safe == 0.
+            self.runs = 0
+
+    def lost(self):
+        if self.trying < self.safe:
+            self.trying = self.safe         # too short: back to safe
+        else:                               # the safe gap is not
+            self.safe = self.trying = min(self.ceiling,
+                                          max(GAP_GROW * self.safe, MIN_GAP))
+        self.settled = True
+        self.runs = 0
+
+def gap_values():
+    lock.acquire()
+    try:
+        return [ ((('firmware',fw), ('class',cls)), '%.3f' % g.safe)
+                 for fw in sorted(learned.keys())
+                 for cls, g in sorted(learned[fw].items()) ]
+    finally:
+        lock.release()
+
+rigstats.gauge('link_gap_seconds', gap_values)
+
+class LinkControl(object):
+    # 'timeout': the fixed serial timeout (None: leave the port's alone);
+    # 'gaps': {pacing class: fixed wait}.
+    def __init__(self, firmware, timeout, gaps={}, retries=LINK_RETRIES,
+                 adaptive=None):
+        self.firmware = firmware
+        self.fixed_timeout = timeout
+        self.retries = retries
+        if adaptive == None:
+            adaptive = ADAPTIVE
+        self.adaptive = adaptive
+        self.latency = {}           # kind: deque of reply times
+        self.held = []              # classes the next command waits for
+        self.last = 0.              # end of the last command
+        self.timed = True
+        self.labels = (('firmware', firmware),)
+        lock.acquire()
+        self.gaps = learned.setdefault(firmware, {})
+        if not self.gaps.has_key(BASE_GAP):
+            self.gaps[BASE_GAP] = Gap(0., MAX_GAP)
+        for cls in gaps:
+            if not self.gaps.has_key(cls):
+                self.gaps[cls] = Gap(gaps[cls])
+        lock.release()
+
+    def hold(self, cls):
+        self.held.append(cls)
+
+    # The read timeout for a command of 'kind'.
+    def timeout(self, kind):
+        samples = self.latency.get(kind)
+        if not self.adaptive or self.fixed_timeout == None or \
+           samples == None or len(samples) < MIN_SAMPLES:
+            return self.fixed_timeout
+        s = sorted(samples)
+        q = s[min(len(s) - 1, int(TIMEOUT_QUANTILE * len(s)))]
+        return min(self.fixed_timeout,
+                   max(MIN_TIMEOUT, TIMEOUT_MARGIN * q + TIMEOUT_SLACK))
+
+    # The time of this command is no reply time (it was answered from a
+    # cache, say).
+    def untimed(self):
+        self.timed = False
+
+    # Run fn(timeout), one command to the rig, after the waits held for
+    # it.  'kind' names a command that is answered (None: a set, not
+    # timed or retried).  A reply that took the whole timeout is taken
+    # for no reply; without a timeout of ours (the port's own), any
+    # failed reply is, but it teaches the gaps nothing.  Returns what
+    # fn returned last.
+    def run(self, kind, fn, retry=True):
+        classes, self.held = [ BASE_GAP ] + self.held, []
+        attempts = 1
+        if kind != None and retry and self.adaptive:
+            attempts += self.retries
+        t_start = time.time()
+        for attempt in xrange(attempts):
+            if attempt:
+                time.sleep(BACKOFF * 2 ** (attempt - 1))
+                rigstats.count('link_retries_total', self.labels)
+            self.pace(classes, kind != None)
+            timeout = self.timeout(kind)
+            if attempt:
+                timeout = self.fixed_timeout
+            self.timed = True
+            t0 = time.time()
+            r = fn(timeout)
+            self.last = time.time()
+            secs = self.last - t0
+            if kind == None:
+                return r
+            lost = is_nak(r) and (timeout == None or secs >= timeout)
+            if self.adaptive and timeout != None:
+                self.learn(classes, not lost)
+            if not lost:
+                if self.timed:
+                    samples = self.latency.get(kind)
+                    if samples == None:
+                        samples = self.latency[kind] = \
+                            collections.deque(maxlen=LATENCY_SAMPLES)
+                    samples.append(secs)
+                break
+            rigstats.count('link_timeouts_total', self.labels)
+            if timeout != None and timeout < self.fixed_timeout:
+                rigstats.count('link_saved_seconds_total', self.labels +
+                               (('wait','timeout'),),
+                               self.fixed_timeout - timeout)
+        if attempt:
+            rigstats.count('link_retry_seconds_total', self.labels,
+                           time.time() - t_start)
+        return r
+
+    # Wait the gaps of 'classes' since the last command; a query waits
+    # the gap being tried.
+    def pace(self, classes, query):
+        wait, fixed = 0., 0.
+        lock.acquire()
+        for cls in classes:
+            g = self.gaps.get(cls)
+            if g == None:
+                continue
+            fixed = max(fixed, g.fixed)
+            if query:
+                wait = max(wait, g.trying)
+            else:
+                wait = max(wait, g.safe)
+        lock.release()
+        if not self.adaptive:
+            if fixed:
+                time.sleep(fixed)
+            return
+        left = self.last + wait - time.time()
+        if left > 0:
+            time.sleep(left)
+        if fixed:
+            rigstats.count('link_saved_seconds_total', self.labels +
+                           (('wait','gap'),), fixed - max(left, 0.))
+
+    # A query lost is blamed on the gaps being tried shorter, if any;
+    # else on the waits held for it, if any; else on BASE_GAP.
+    def learn(self, classes, answered):
+        lock.acquire()
+        gaps = [ self.gaps[cls] for cls in classes
+                 if self.gaps.has_key(cls) ]
+        if not answered:
+            trying = [ g for g in gaps if g.trying < g.safe ]
+            if trying:
+                gaps = trying
+            elif len(gaps) > 1:
+                gaps = gaps[1:]
+        for g in gaps:
+            if answered:
+                g.answered()
+            else:
+                g.lost()
+        lock.release()
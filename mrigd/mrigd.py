@@ -30,21 +30,124 @@ import sys
 import os
 import signal
 import time
+import rigconn
 
 
 
 NAK_START = "? "
+RIGSERVE_PORT = 14652
+START_TIMEOUT = 150     # secs for rigserve to be listening
+READY_TIMEOUT = 30      # secs for the services to be listening
+
+# Start rigserve and wait for its readiness signal (see rigconn.py), then
+# connect to it, over 'unix_path' if given.  Returns (pid,
+# rigconn.Client), or (pid, None) if it did not start or cannot be
+# reached: the caller has the pid to kill it either way.
+def start_rigserve(argv, unix_path=None):
+    if unix_path:
+        argv = argv + [ "--unix=" + unix_path ]
+    pid, ready_fd = rigconn.spawn(argv)
+    if not rigconn.wait_ready(ready_fd, START_TIMEOUT):
+        return pid, None
+    if unix_path:
+        where = rigconn.UNIX_PREFIX + unix_path
+    else:
+        where = "127.0.0.1:" + str(RIGSERVE_PORT)
+    client = rigconn.Client(where, timeout=READY_TIMEOUT + 4)
+    try:
+        return pid, client.connect()
+    except (socket.error, EOFError, IOError), e:
+        print sys.argv[0] + ": cannot connect to rigserve: " + str(e)
+        return pid, None
+
+
+# Rig setup, one command after the other.
+def setup_commands():
+    cmds = [ ]
+    cmd = "open " + RIG_NAME + " " + RIG_BACKEND
+    if RIG_PROCESS:
+        cmd += " process"
+    cmds.append(cmd)
+    cmds.append("put " + RIG_NAME + ".CONTROL.init " + RIG_INIT_STRING)
+    return cmds
+
+
+# Service starts, all independent of each other.
+def service_commands():
+    cmds = [ ]
+    if SIMPLE:
+        cmd = "start " + RIG_NAME + ".simple "
+        cmd += "listen_addr=" + SIMPLE_LISTEN_ADDR + " "
+        cmd += "listen_tcp_port=" + str(SIMPLE_TCP_PORT) + " "
+        cmd += "local_udp_port=" + str(SIMPLE_LOCAL_UDP_PORT) + " "
+        cmd += "remote_udp_port=" + str(SIMPLE_REMOTE_UDP_PORT) + " "
+        cmd += "static_clients=" + str(SIMPLE_STATIC_CLIENTS) + " "
+        cmd += "latency=" + SIMPLE_NETWORK_LATENCY
+        if SIMPLE_UNIX_PATH:
+            cmd += " listen_unix=" + SIMPLE_UNIX_PATH
+        cmds.append(cmd)
+    if HAMLIB:
+        cmd = "start " + RIG_NAME + ".hamlib "
+        cmd += "listen_addr=" + HAMLIB_LISTEN_ADDR + " "
+        cmd += "listen_tcp_port=" + str(HAMLIB_TCP_PORT) + " "
+        if SIMPLE_UNIX_PATH:
+            cmd += "simple_addr=" + rigconn.UNIX_PREFIX + SIMPLE_UNIX_PATH + " "
+        else:
+            cmd += "simple_addr=" + SIMPLE_LISTEN_ADDR + " "
+        cmd += "from_simple_if=" + SIMPLE_LISTEN_ADDR + " "
+        cmd += "simple_local_udp_port=" + str(SIMPLE_REMOTE_UDP_PORT)
+        cmds.append(cmd)
+    if RAW:
+        cmd = "start " + RIG_NAME + ".3rd_party "
+        cmd += "listen_addr=" + RAW_LISTEN_ADDR + " "
+        cmd += "listen_tcp_port=" + str(RAW_TCP_PORT)
+        cmds.append(cmd)
+    if METRICS:
+        cmd = "start rigserve.metrics "
+        cmd += "listen_addr=" + METRICS_LISTEN_ADDR + " "
+        cmd += "listen_tcp_port=" + str(METRICS_TCP_PORT)
+        cmds.append(cmd)
+    return cmds
+
+
+# Run the setup commands in order, then send all the service starts at
+# once and wait until every service is ready.  Returns None, or what
+# went wrong.
+def start_all(rigserve, setup, services):
+    for cmd in setup:
+        response = rigserve.command(cmd)
+        if response.startswith(NAK_START):
+            return "cmd " + cmd + " failed: " + response
+    started = [ (cmd, rigserve.submit(cmd)) for cmd in services ]
+    for cmd, future in started:
+        response = future.result()
+        if response.startswith(NAK_START):
+            return "cmd " + cmd + " failed: " + response
+    names = [ cmd.split()[1] for cmd in services ]
+    if names:
+        cmd = "ready " + " ".join(names) + " timeout=" + str(READY_TIMEOUT)
+        response = rigserve.command(cmd)
+        if response.startswith(NAK_START):
+            return "cmd " + cmd + " failed: " + response
+    return None
+
 
 def send_to_rigserve(request):
-    rigserve_socket.sendall(request + "\n")
-    return rigserve_socket.recv(8192)
+    return rigserve.command(request)    # framed: the whole reply, always
 
 
 def gracefully_exit():
     if rigserve_pid:
-        os.kill(rigserve_pid, signal.SIGTERM)
-        time.sleep(0.5)
-        os.kill(rigserve_pid, signal.SIGKILL)
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.kill(rigserve_pid, sig)
+            except OSError:
+                break               # gone already
+            time.sleep(0.5)
+        try:
+            os.waitpid(rigserve_pid, os.WNOHANG)
+        except OSError:
+            pass
     quit()
 
 
@@ -73,76 +176,22 @@ if __name__ == "__main__":
     install_signal_handler()
 
     # start rigserve and rigserve services
-    rigserve_pid = os.fork()
-    if rigserve_pid == 0:
-        os.execvp(PYTHON, [ PYTHON, RIGSERVE ])
-        abort("cannot execute rigserve")
-    else:
-        rigserve_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        rigserve_socket.setblocking(1)
-
-        try:
-            time.sleep(1)
-            rigserve_socket.connect(("127.0.0.1", 14652))
-            if len(rigserve_socket.recv(8192)) == 0:
-                raise IOError
-        except:
-            print "waiting for rigserve to be available..."
-            tries = 0
-            is_done = False
-            while tries < 150 and not is_done:
-                time.sleep(1)
-                tries = tries + 1
-                is_done = True
-                try:
-                    rigserve_socket.connect(("127.0.0.1", RIGSERVE_PORT))
-                    if len(rigserve_socket.recv(8192)) == 0:
-                        raise IOError
-                except:
-                    is_done = False
-            if not is_done:
-                abort("cannot connect to rigserve")
-
-        rigserve_socket.settimeout(4)
-
-        cmds = [ ]
-        cmds.append("open " + RIG_NAME + " " + RIG_BACKEND)
-        cmds.append("put " + RIG_NAME + ".CONTROL.init " + RIG_INIT_STRING)
-        if SIMPLE:
-            cmd = "start " + RIG_NAME + ".simple "
-            cmd += "listen_addr=" + SIMPLE_LISTEN_ADDR + " "
-            cmd += "listen_tcp_port=" + str(SIMPLE_TCP_PORT) + " "
-            cmd += "local_udp_port=" + str(SIMPLE_LOCAL_UDP_PORT) + " "
-            cmd += "remote_udp_port=" + str(SIMPLE_REMOTE_UDP_PORT) + " "
-            cmd += "static_clients=" + str(SIMPLE_STATIC_CLIENTS) + " "
-            cmd += "latency=" + SIMPLE_NETWORK_LATENCY
-            cmds.append(cmd)
-        if HAMLIB:
-            cmd = "start " + RIG_NAME + ".hamlib "
-            cmd += "listen_addr=" + HAMLIB_LISTEN_ADDR + " "
-            cmd += "listen_tcp_port=" + str(HAMLIB_TCP_PORT) + " "
-            cmd += "simple_addr=" + SIMPLE_LISTEN_ADDR + " "
-            cmd += "from_simple_if=" + SIMPLE_LISTEN_ADDR + " "
-            cmd += "simple_local_udp_port=" + str(SIMPLE_REMOTE_UDP_PORT)
-            cmds.append(cmd)
-        if RAW:
-            cmd = "start " + RIG_NAME + ".3rd_party "
-            cmd += "listen_addr=" + RAW_LISTEN_ADDR + " "
-            cmd += "listen_tcp_port=" + str(RAW_TCP_PORT)
-            cmds.append(cmd)
-
-        for cmd in cmds:
-            response = send_to_rigserve(cmd)
-            time.sleep(1)
-            if response.startswith(NAK_START):
-                abort("cmd " + cmd + " failed: " + response)
-        print "mrigd: initialized!"
+    t0 = time.time()
+    rigserve_pid, rigserve = start_rigserve([ PYTHON, RIGSERVE ],
+                                            RIGSERVE_UNIX_PATH)
+    if not rigserve:
+        abort("rigserve did not start")
+
+    error = start_all(rigserve, setup_commands(), service_commands())
+    if error:
+        abort(error)
+    print "mrigd: initialized in %.3f s!" % (time.time() - t0)
+
+    try:
+        os.wait()
+    except KeyboardInterrupt:
+        print "keyboard interrupt, terminating..."
+    except:
+        pass
 
-        try:
-            os.wait()
-        except KeyboardInterrupt:
-            print "keyboard interrupt, terminating..."
-        except:
-            pass
-
-        gracefully_exit()
+    gracefully_exit()
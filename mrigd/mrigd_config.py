@@ -38,6 +38,21 @@ RIG_BACKEND="YA_ft897d"                         # model of the rig
                                                 # (put device name and baud
                                                 # rate)
 RIG_INIT_STRING="/dev/ttyUSB0 38400"   # actual init string
+RIG_PROCESS=False                      # run the backend in a process of
+                                       # its own (see rigproc.py)
+
+
+
+# local transport between mrigd, rigserve and the services
+#
+# With a path, rigserve also listens on that Unix domain socket, and
+# mrigd and the services reach it there instead of over loopback TCP
+# (the TCP port stays open for remote users).  Likewise hamlib reaches
+# simple, and gets its updates, over Unix sockets next to
+# SIMPLE_UNIX_PATH.  None: TCP and UDP, as before.
+#
+RIGSERVE_UNIX_PATH=None          # e.g. "/tmp/mrigd-rigserve.sock"
+SIMPLE_UNIX_PATH=None            # e.g. "/tmp/mrigd-simple.sock"
 
 
 
@@ -84,3 +99,13 @@ HAMLIB_TCP_PORT=4532             # local TCP port hamlib will listen on
 RAW=True                         # set it to True/False to enable/disable raw
 RAW_LISTEN_ADDR="127.0.0.1"    # local IP address raw will listen on
 RAW_TCP_PORT=9999                # local TCP port raw will listen on
+
+
+
+# Prometheus metrics of rigserve over HTTP (latency histograms, error
+# counters, queue depths), on http://METRICS_LISTEN_ADDR:METRICS_TCP_PORT/metrics
+# The same figures are shown by the rigserve "stats" command.
+#
+METRICS=False                    # set it to True/False to enable/disable metrics
+METRICS_LISTEN_ADDR="127.0.0.1"  # local IP address metrics will listen on
+METRICS_TCP_PORT=14656           # local TCP port metrics will listen on
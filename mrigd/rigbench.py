@@ -0,0 +1,681 @@
+#!/usr/bin/env python
+#
+# File: rigbench.py
+# Version: 1.0
+#
+# mrigd: rigserve benchmarks
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Usage: rigbench.py dispatch [iterations]
+#        rigbench.py cache [secs]
+#        rigbench.py startup
+#        rigbench.py ptt [pollers]
+#        rigbench.py tune [secs]
+#        rigbench.py rigs [n] [secs]
+#        rigbench.py transport [requests]
+#        rigbench.py state [reads]
+#        rigbench.py client [requests]
+#        rigbench.py load [mix] [rigs] [clients] [secs] [results.json]
+#        rigbench.py compare old.json new.json
+#
+# The benchmarks against the rig emulators are in rigbench_emu.py.
+#
+# dispatch - compares commands per second of the rigserve dispatch table
+#            against the old make_cmd()/eval() path, on the Dummy backend,
+#            and shows what the hop to the rig's worker thread costs.
+# cache    - several services polling the same rig values at once, with
+#            and without the get cache: how many gets reach the rig.
+# startup  - starts rigserve and a few services the way mrigd does, and
+#            compares it with the fixed sleeps mrigd used to wait for them.
+# ptt      - PTT latency while pollers keep the rig's queue full, each
+#            backend call taking SERIAL_TIME, with and without priorities.
+# tune     - a tuning knob sending a freq put every KNOB_STEP secs to a
+#            slow CAT link: puts that reached the rig, and how far the rig
+#            lags behind the knob, with and without put coalescing.
+# rigs     - n Dummy rigs, each read back to back by its own client, with
+#            BACKEND_WORK of CPU per call: gets per second with the
+#            backends in rigserve's threads and in a process per rig.
+# transport - round trips of a (cached) get to a spawned rigserve over
+#            loopback TCP and over its Unix socket: latency, and CPU of
+#            both sides per request.
+# state    - a service's view of a rig value: a get over rigserve's Unix
+#            socket (answered from the cache) against a read of the
+#            shared state table.
+# client   - rigconn.Client against a spawned rigserve: one request at a
+#            time, pipelined, and as batches, on an uncached rig.
+# load     - a spawned rigserve with n Dummy rigs and m client processes,
+#            each replaying a mix of LOAD_MIXES on one of the rigs for
+#            'secs': throughput, latency percentiles and CPU per request
+#            (rigserve's and the clients'), saved as JSON if a file is
+#            given.
+# compare  - two load results side by side, e.g. of two revisions.
+
+import sys, os, signal, time, threading, multiprocessing
+import json, subprocess
+import rigserve, rigworker, rigstats, rigconn, rigstate, mrigd, dummy
+from rigserve import *
+
+BENCH_RIG = 'bench'
+
+# A simple-service-like polling mix: mostly gets, some puts.
+DISPATCH_MIX = [
+    'get bench.VFOA.freq',
+    'get bench.MAIN.rx_mode',
+    'get bench.MAIN.strength_raw',
+    'get bench.MAIN.af_gain',
+    'get bench.TX.transmit',
+    'put bench.VFOA.freq 7050000',
+    'put bench.MAIN.af_gain 0.5',
+    'test bench.MAIN.rf_gain',
+    ]
+
+# The pre-dispatch table command path, kept here for comparison only.
+
+def eval_make_cmd(sense, s):
+    parms = s.split(None,1)
+    subcom = parms[0]
+    args = ''
+    if len(parms)>1: args = parms[1]
+    if sense == 'put' and args == '':
+        return NAK
+    split = subcom.split(".", 3)
+    if len(split) != 3:
+        return NAK
+    h = split[0]
+    trv = split[1]
+    cmd = split[2]
+    fn_name = cmd
+    if not h in backEnd:
+        return NAK + "Radio not open."
+    if dir(backEnd[h]).count(fn_name) == 0:
+        return NAK+"function name not recognized: '%s'" % fn_name
+    mode = { 'get':T_GET, 'put':T_PUT, 'test':T_TEST } [sense]
+    cmd1 = "backEnd['%s'].%s(%d,'%s'" % (h,fn_name,mode,trv)
+    if sense == 'put':
+        cmd1 += ", '%s'" % args
+    cmd1 += ')'
+    return cmd1
+
+def eval_command(cmd):
+    split = cmd.split(None,1)
+    m = split[0]
+    args = split[1]
+    if m[0] == 't':
+        lst = args.split('.',3)
+        h, vrx, c = lst
+        result = eval('backEnd[h].%s(T_TEST,"%s")' % (c, vrx))
+        if result == None:
+            return NAK+'Function not implemented for this rig.'
+        return ACK
+    sense = { 'g':'get', 'p':'put' } [m[0]]
+    c = eval_make_cmd(sense, args)
+    if c.startswith(NAK):
+        return NAK
+    return eval(c)
+
+def run(fn, cmds, iterations):
+    t0 = time.time()
+    for i in xrange(iterations):
+        for c in cmds:
+            fn(c)
+    return iterations * len(cmds) / (time.time() - t0)
+
+def bench_dispatch(iterations):
+    rigserve.USE_WORKERS = False    # same thread as the eval path
+    print command('open %s Dummy' % BENCH_RIG)
+    command('cache %s off' % BENCH_RIG)     # every get reaches the rig
+    print command('put %s.CONTROL.init bench' % BENCH_RIG)
+    # Both paths must give the same answers.
+    for c in DISPATCH_MIX:
+        if str(eval_command(c)) != str(command(c)):
+            print 'MISMATCH:', c, eval_command(c), command(c)
+    old = run(eval_command, DISPATCH_MIX, iterations)
+    new = run(command, DISPATCH_MIX, iterations)
+    print 'eval path:      %10.0f cmd/s' % old
+    print 'dispatch table: %10.0f cmd/s' % new
+    print 'speed-up:       %10.2fx' % (new / old)
+    command('close %s' % BENCH_RIG)
+    rigserve.USE_WORKERS = True
+    command('open %s Dummy' % BENCH_RIG)
+    command('cache %s off' % BENCH_RIG)
+    command('put %s.CONTROL.init bench' % BENCH_RIG)
+    worker = run(command, DISPATCH_MIX, iterations / 10)
+    print 'via rig worker: %10.0f cmd/s' % worker
+    command('close %s' % BENCH_RIG)
+
+# What a simple/hamlib/raw service reads on every poll.
+CACHE_POLL = [
+    'get bench.VFOA.freq',
+    'get bench.MAIN.rx_mode',
+    'get bench.MAIN.strength_raw',
+    'get bench.TX.transmit',
+    ]
+CACHE_CLIENTS  = 4          # services polling at once
+CACHE_INTERVAL = 0.02       # secs between polls of one service
+
+def poll_for(secs):
+    gets = 0
+    t_end = time.time() + secs
+    while time.time() < t_end:
+        for i in xrange(CACHE_CLIENTS):
+            for c in CACHE_POLL:
+                command(c)
+                gets += 1
+        time.sleep(CACHE_INTERVAL)
+    return gets
+
+def bench_cache(secs):
+    rigserve.USE_WORKERS = False
+    command('open %s Dummy' % BENCH_RIG)
+    command('put %s.CONTROL.init bench' % BENCH_RIG)
+    for state in ('off', 'on'):
+        command('cache %s %s' % (BENCH_RIG, state))
+        cache = caches[BENCH_RIG]
+        before = cache.misses + cache.bypassed
+        gets = poll_for(secs)
+        reads = cache.misses + cache.bypassed - before
+        print 'cache %-3s: %6d gets, %6d reached the rig (%.1f%% saved)' % \
+            (state, gets, reads, 100. * (gets - reads) / gets)
+    print command('cache %s' % BENCH_RIG)
+    command('close %s' % BENCH_RIG)
+
+STARTUP_SERVICES = [
+    'start %s.dummy' % BENCH_RIG,
+    'start rigserve.dummy',
+    'start rigserve.metrics listen_tcp_port=14699',
+    ]
+
+def bench_startup():
+    argv = [ sys.executable, os.path.join(os.path.dirname(
+             os.path.abspath(__file__)), 'rigserve.py') ]
+    setup = [ 'open %s Dummy' % BENCH_RIG,
+              'put %s.CONTROL.init bench' % BENCH_RIG ]
+    t0 = time.time()
+    pid, client = mrigd.start_rigserve(argv)
+    t1 = time.time()
+    try:
+        if not client:
+            print 'rigserve did not start'
+            return
+        error = mrigd.start_all(client, setup, STARTUP_SERVICES)
+        t2 = time.time()
+        if error:
+            print error
+            return
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    # mrigd used to sleep 1 sec after the fork and after every command
+    old = 1. + len(setup) + len(STARTUP_SERVICES)
+    print 'rigserve listening: %8.1f ms' % (1e3 * (t1 - t0))
+    print 'services ready:     %8.1f ms' % (1e3 * (t2 - t1))
+    print 'total:              %8.1f ms (fixed sleeps: %.0f ms)' % \
+        (1e3 * (t2 - t0), 1e3 * old)
+
+SERIAL_TIME = 0.005         # secs per backend call, like a serial read
+PTT_SAMPLES = 20
+
+def slow_backend_call(h, fn, tp, *args):
+    time.sleep(SERIAL_TIME)
+    return fast_backend_call(h, fn, tp, *args)
+
+fast_backend_call = rigserve.backend_call
+
+# One poller: a get always queued, re-sent as soon as it is answered.
+def poller(running):
+    def done(result):
+        if running:
+            command_async('get %s.MAIN.strength_raw' % BENCH_RIG, done,
+                          rigworker.P_POLL)
+    done(None)
+
+def ptt_latency():
+    event = threading.Event()
+    t0 = time.time()
+    command_async('put %s.TX.transmit 1' % BENCH_RIG, lambda r: event.set())
+    event.wait()
+    return time.time() - t0
+
+def bench_ptt(pollers):
+    rigserve.USE_WORKERS = True
+    rigserve.backend_call = slow_backend_call
+    command('open %s Dummy' % BENCH_RIG)
+    command('cache %s off' % BENCH_RIG)     # every poll reaches the rig
+    command('put %s.CONTROL.init bench' % BENCH_RIG)
+    for use in (False, True):
+        rigworker.USE_PRIORITY = use
+        running = [True]
+        for i in xrange(pollers):
+            poller(running)
+        time.sleep(0.1)
+        times = sorted([ ptt_latency() for i in xrange(PTT_SAMPLES) ])
+        del running[:]
+        print 'priorities %-3s: PTT p50 %7.1f ms, max %7.1f ms (%d pollers)' % \
+            (('off', 'on')[use], 1e3 * times[len(times) / 2],
+             1e3 * times[-1], pollers)
+    rigworker.USE_PRIORITY = True
+    worker = workers[BENCH_RIG]
+    command('close %s' % BENCH_RIG)
+    worker.join()
+    rigserve.backend_call = fast_backend_call
+
+KNOB_STEP = 0.005           # secs between knob steps
+CAT_PUT   = 0.02            # secs for a freq put at 9600 baud
+
+def bench_tune(secs):
+    calls = []
+    def cat_backend_call(h, fn, tp, *args):
+        calls.append(args)
+        time.sleep(CAT_PUT)
+        return fast_backend_call(h, fn, tp, *args)
+    rigserve.USE_WORKERS = True
+    rigserve.backend_call = cat_backend_call
+    command('open %s Dummy' % BENCH_RIG)
+    command('put %s.CONTROL.init bench' % BENCH_RIG)
+    for use in (False, True):
+        rigserve.COALESCE_PUTS = use
+        del calls[:]
+        last = threading.Event()
+        freq = 7000000
+        t_end = time.time() + secs
+        while time.time() < t_end:
+            freq += 10
+            command_async('put %s.VFOA.freq %d' % (BENCH_RIG, freq),
+                          lambda r: None)
+            time.sleep(KNOB_STEP)
+        t_knob = time.time()
+        command_async('put %s.VFOA.freq %d' % (BENCH_RIG, freq),
+                      lambda r: last.set())
+        last.wait()
+        print 'coalescing %-3s: %5d knob steps, %5d puts reached the rig, ' \
+            'rig %6.0f ms behind' % (('off', 'on')[use],
+             (freq - 7000000) / 10 + 1, len(calls),
+             1e3 * (time.time() - t_knob))
+    rigserve.COALESCE_PUTS = True
+    worker = workers[BENCH_RIG]
+    command('close %s' % BENCH_RIG)
+    worker.join()
+    rigserve.backend_call = fast_backend_call
+    for line in rigstats.report().split('\n'):
+        if line.startswith('rigserve_puts_coalesced_total'):
+            print line
+
+BACKEND_WORK = 0.0005       # secs of CPU per backend call (parsing etc.)
+
+def busy_freq(self, tp, v='', data=''):
+    t_end = time.time() + BACKEND_WORK
+    while time.time() < t_end:
+        pass
+    return plain_freq(self, tp, v, data)
+
+plain_freq = dummy.Dummy.freq
+
+def bench_rigs(n, secs):
+    rigserve.USE_WORKERS = True
+    dummy.Dummy.freq = busy_freq    # before open: the processes fork it
+    rigs = [ '%s%d' % (BENCH_RIG, i) for i in xrange(n) ]
+    print '%d rigs, %d cpus' % (n, multiprocessing.cpu_count())
+    for mode in ('thread', 'process'):
+        for h in rigs:
+            command('open %s Dummy %s' % (h, mode))
+            command('cache %s off' % h)
+        gets = [0]
+        running = [True]
+        def client(h):
+            def done(result):
+                if str(result).startswith(NAK1):
+                    print 'get failed:', result
+                gets[0] += 1
+                if running:
+                    command_async('get %s.VFOA.freq' % h, done)
+            command_async('get %s.VFOA.freq' % h, done)
+        t0 = time.time()
+        for h in rigs:
+            client(h)
+        time.sleep(secs)
+        del running[:]
+        elapsed = time.time() - t0
+        print '%-7s: %8.0f gets/s' % (mode, gets[0] / elapsed)
+        workers_left = [ workers[h] for h in rigs ]
+        for h in rigs:
+            command('close %s' % h)
+        for worker in workers_left:
+            worker.join()
+    dummy.Dummy.freq = plain_freq
+
+def cpu_secs(pid):
+    fields = open('/proc/%d/stat' % pid).read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    return (int(fields[11]) + int(fields[12])) / float(ticks)
+
+def round_trips(sock, cmd, n):
+    for i in xrange(n):
+        sock.sendall(cmd)
+        reply = ''
+        while not reply.endswith('\n'):
+            reply += sock.recv(4096)
+
+def bench_transport(n):
+    path = '/tmp/rigbench-%d.sock' % os.getpid()
+    argv = [ sys.executable, os.path.join(os.path.dirname(
+             os.path.abspath(__file__)), 'rigserve.py') ]
+    pid, client = mrigd.start_rigserve(argv, path)
+    try:
+        client.command('open %s Dummy' % BENCH_RIG)
+        client.command('cache %s ttl freq 3600' % BENCH_RIG)
+        cmd = 'get %s.VFOA.freq\n' % BENCH_RIG
+        for where in ('127.0.0.1:%d' % mrigd.RIGSERVE_PORT,
+                      rigconn.UNIX_PREFIX + path):
+            sock = rigconn.connect_to(where, 5)
+            sock.recv(1024)         # welcome
+            round_trips(sock, cmd, 200)
+            cpu0 = sum(os.times()[:2]) + cpu_secs(pid)
+            t0 = time.time()
+            round_trips(sock, cmd, n)
+            elapsed = time.time() - t0
+            cpu = sum(os.times()[:2]) + cpu_secs(pid) - cpu0
+            sock.close()
+            print '%-4s: %7.1f us per round trip, %7.1f us CPU per request' % \
+                (('tcp', 'unix')[rigconn.is_unix(where)],
+                 1e6 * elapsed / n, 1e6 * cpu / n)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        rigconn.remove_stale(path)
+
+def bench_state(n):
+    path = '/tmp/rigbench-%d.sock' % os.getpid()
+    state_path = '/dev/shm/rigbench-%d.state' % os.getpid()
+    argv = [ sys.executable, os.path.join(os.path.dirname(
+             os.path.abspath(__file__)), 'rigserve.py'),
+             '--state=' + state_path ]
+    pid, client = mrigd.start_rigserve(argv, path)
+    try:
+        client.command('open %s Dummy' % BENCH_RIG)
+        client.command('cache %s ttl freq 3600' % BENCH_RIG)
+        name = '%s.VFOA.freq' % BENCH_RIG
+        print 'get: %s, table: %s' % (client.command('get ' + name),
+            rigstate.attach(state_path).read(name))
+        sock = rigconn.connect_to(rigconn.UNIX_PREFIX + path, 5)
+        sock.recv(1024)             # welcome
+        t0 = time.time()
+        round_trips(sock, 'get %s\n' % name, n)
+        get = (time.time() - t0) / n
+        sock.close()
+        table = rigstate.attach(state_path)
+        t0 = time.time()
+        for i in xrange(n):
+            table.read(name, 1.)
+        read = (time.time() - t0) / n
+        print 'get over Unix socket: %7.2f us' % (1e6 * get)
+        print 'state table read:     %7.2f us (%.0fx)' % (1e6 * read,
+                                                          get / read)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        rigconn.remove_stale(path)
+        os.unlink(state_path)
+
+def bench_client(n):
+    argv = [ sys.executable, os.path.join(os.path.dirname(
+             os.path.abspath(__file__)), 'rigserve.py') ]
+    pid, client = mrigd.start_rigserve(argv)
+    try:
+        client.command('open %s Dummy' % BENCH_RIG)
+        client.command('cache %s off' % BENCH_RIG)
+        cmd = 'get %s.VFOA.freq' % BENCH_RIG
+        t0 = time.time()
+        for i in xrange(n):
+            client.command(cmd)
+        one = n / (time.time() - t0)
+        t0 = time.time()
+        client.pipeline([ cmd ] * n)
+        piped = n / (time.time() - t0)
+        t0 = time.time()
+        for i in xrange(n / 10):
+            client.batch([ cmd ] * 10)
+        batched = n / (time.time() - t0)
+        print 'one at a time: %8.0f req/s' % one
+        print 'pipelined:     %8.0f req/s' % piped
+        print 'batches of 10: %8.0f gets/s' % batched
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+# What the clients of rigserve send: (setup commands, pause in secs
+# after each request, requests in turn).  %(rig)s is the client's rig,
+# %(freq)d goes up by 10 Hz every request.
+LOAD_MIXES = {
+    # the simple service: one batch of gets per tick, polling
+    'simple': ([ 'priority poll' ], 0.005,
+               [ make_batch([ 'get %(rig)s.VFOA.freq',
+                              'get %(rig)s.MAIN.rx_mode',
+                              'get %(rig)s.MAIN.strength_raw',
+                              'get %(rig)s.TX.transmit',
+                              'get %(rig)s.MAIN.af_gain' ]) ]),
+    # hamlib clients (fldigi, wsjt-x...) polling freq, mode and PTT
+    'hamlib': ([ 'priority poll' ], 0.02,
+               [ 'get %(rig)s.VFOA.freq',
+                 'get %(rig)s.MAIN.rx_mode',
+                 'get %(rig)s.TX.transmit' ]),
+    # a dial being turned: a freq put every knob step
+    'dial':   ([], KNOB_STEP,
+               [ 'put %(rig)s.VFOA.freq %(freq)d' ]),
+    # everything as fast as it goes
+    'flood':  ([], 0.,
+               [ cmd.replace(BENCH_RIG + '.', '%(rig)s.')
+                 for cmd in DISPATCH_MIX ]),
+    }
+# 'mixed' gives the clients these mixes in turn.
+MIXED = ('simple', 'hamlib', 'dial')
+
+def client_mix(mix, i):
+    if mix == 'mixed':
+        return MIXED[i % len(MIXED)]
+    return mix
+
+# One client process: tells 'results' it is connected (None), waits for
+# 'start', then runs its mix for 'secs' and puts (latencies, naks, CPU
+# secs) in 'results'.
+def load_client(where, mix, h, secs, start, results):
+    setup, pause, cmds = LOAD_MIXES[mix]
+    client = rigconn.Client(where, setup=setup).connect()
+    results.put(None)
+    start.wait()
+    times = []
+    naks = 0
+    freq = 7000000
+    cpu0 = sum(os.times()[:2])
+    t_end = time.time() + secs
+    while time.time() < t_end:
+        freq += 10
+        cmd = cmds[len(times) % len(cmds)] % { 'rig':h, 'freq':freq }
+        t0 = time.time()
+        reply = client.command(cmd)
+        times.append(time.time() - t0)
+        if reply.startswith(NAK1):
+            naks += 1
+        if pause:
+            time.sleep(pause)
+    results.put((times, naks, sum(os.times()[:2]) - cpu0))
+    client.close()
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(p * len(times)))]
+
+def revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w')
+            ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def bench_load(mix, n, m, secs, path=None):
+    if mix != 'mixed' and not LOAD_MIXES.has_key(mix):
+        print 'unknown mix: %s (one of %s, mixed)' % \
+            (mix, ', '.join(sorted(LOAD_MIXES.keys())))
+        return
+    argv = [ sys.executable, os.path.join(os.path.dirname(
+             os.path.abspath(__file__)), 'rigserve.py') ]
+    pid, client = mrigd.start_rigserve(argv)
+    try:
+        if not client:
+            print 'rigserve did not start'
+            return
+        rigs = [ '%s%d' % (BENCH_RIG, i) for i in xrange(n) ]
+        for h in rigs:
+            client.command('open %s Dummy' % h)
+            client.command('put %s.CONTROL.init bench' % h)
+        where = '127.0.0.1:%d' % mrigd.RIGSERVE_PORT
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        procs = [ multiprocessing.Process(target=load_client,
+                  args=(where, client_mix(mix, i), rigs[i % n], secs,
+                        start, results)) for i in xrange(m) ]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            results.get()           # connected
+        cpu0 = cpu_secs(pid)
+        start.set()
+        done = [ results.get() for proc in procs ]
+        server_cpu = cpu_secs(pid) - cpu0
+        for proc in procs:
+            proc.join()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    times = sorted(sum([ d[0] for d in done ], []))
+    requests = len(times)
+    if requests == 0:
+        print 'no requests answered'
+        return
+    result = {
+        'revision': revision(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'mix': mix, 'rigs': n, 'clients': m, 'secs': secs,
+        'requests': requests,
+        'naks': sum([ d[1] for d in done ]),
+        'requests_per_sec': requests / secs,
+        'latency_ms': {
+            'p50': 1e3 * percentile(times, 0.5),
+            'p99': 1e3 * percentile(times, 0.99),
+            'p999': 1e3 * percentile(times, 0.999),
+            'max': 1e3 * times[-1] },
+        'cpu_us_per_request': {
+            'rigserve': 1e6 * server_cpu / requests,
+            'clients': 1e6 * sum([ d[2] for d in done ]) / requests },
+        }
+    print_load(result)
+    if path:
+        f = open(path, 'w')
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.write('\n')
+        f.close()
+        print 'saved to %s' % path
+
+LOAD_REPORT = [
+    ('requests/s',      lambda r: r['requests_per_sec']),
+    ('p50 ms',          lambda r: r['latency_ms']['p50']),
+    ('p99 ms',          lambda r: r['latency_ms']['p99']),
+    ('p999 ms',         lambda r: r['latency_ms']['p999']),
+    ('max ms',          lambda r: r['latency_ms']['max']),
+    ('rigserve CPU us', lambda r: r['cpu_us_per_request']['rigserve']),
+    ('client CPU us',   lambda r: r['cpu_us_per_request']['clients']),
+    ]
+
+def print_load(r):
+    print '%s mix, %d rigs, %d clients, %g secs: %d requests, %d NAKs' % \
+        (r['mix'], r['rigs'], r['clients'], r['secs'], r['requests'],
+         r['naks'])
+    for name, value in LOAD_REPORT:
+        print '%-16s %10.3f' % (name, value(r))
+
+def bench_compare(old_path, new_path):
+    old = json.load(open(old_path))
+    new = json.load(open(new_path))
+    for key in ('mix', 'rigs', 'clients'):
+        if old[key] != new[key]:
+            print 'warning: %s differs: %s / %s' % (key, old[key], new[key])
+    print '%-16s %10s %10s %8s' % ('', old['revision'] or 'old',
+                                   new['revision'] or 'new', 'change')
+    for name, value in LOAD_REPORT:
+        a, b = value(old), value(new)
+        change = ''
+        if a:
+            change = '%+7.1f%%' % (100. * (b - a) / a)
+        print '%-16s %10.3f %10.3f %8s' % (name, a, b, change)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: %s dispatch [iterations] | cache [secs] | startup |' \
+            ' ptt [pollers] | tune [secs] | rigs [n] [secs] |' \
+            ' transport [requests] | state [reads] | client [requests] |' \
+            ' load [mix] [rigs] [clients] [secs] [results.json] |' \
+            ' compare old.json new.json' % sys.argv[0]
+        sys.exit(1)
+    if sys.argv[1] == 'dispatch':
+        iterations = 20000
+        if len(sys.argv) > 2: iterations = int(sys.argv[2])
+        bench_dispatch(iterations)
+    elif sys.argv[1] == 'cache':
+        secs = 2.0
+        if len(sys.argv) > 2: secs = float(sys.argv[2])
+        bench_cache(secs)
+    elif sys.argv[1] == 'startup':
+        bench_startup()
+    elif sys.argv[1] == 'ptt':
+        pollers = 8
+        if len(sys.argv) > 2: pollers = int(sys.argv[2])
+        bench_ptt(pollers)
+    elif sys.argv[1] == 'tune':
+        secs = 1.0
+        if len(sys.argv) > 2: secs = float(sys.argv[2])
+        bench_tune(secs)
+    elif sys.argv[1] == 'rigs':
+        n, secs = 4, 2.0
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        if len(sys.argv) > 3: secs = float(sys.argv[3])
+        bench_rigs(n, secs)
+    elif sys.argv[1] == 'transport':
+        n = 20000
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        bench_transport(n)
+    elif sys.argv[1] == 'state':
+        n = 20000
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        bench_state(n)
+    elif sys.argv[1] == 'client':
+        n = 5000
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        bench_client(n)
+    elif sys.argv[1] == 'load':
+        mix, n, m, secs, path = 'mixed', 2, 6, 5.0, None
+        if len(sys.argv) > 2: mix = sys.argv[2]
+        if len(sys.argv) > 3: n = int(sys.argv[3])
+        if len(sys.argv) > 4: m = int(sys.argv[4])
+        if len(sys.argv) > 5: secs = float(sys.argv[5])
+        if len(sys.argv) > 6: path = sys.argv[6]
+        bench_load(mix, n, m, secs, path)
+    elif sys.argv[1] == 'compare' and len(sys.argv) == 4:
+        bench_compare(sys.argv[2], sys.argv[3])
+    else:
+        print 'unknown benchmark: %s' % sys.argv[1]
+        sys.exit(1)
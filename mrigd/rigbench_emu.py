@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+#
+# File: rigbench_emu.py
+# Version: 1.0
+#
+# mrigd: benchmarks of the backends and the serial path, on the rig
+# emulators
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Usage: rigbench_emu.py civ [requests] [baud]
+#        rigbench_emu.py orion [rounds]
+#        rigbench_emu.py ft897 [rounds]
+#        rigbench_emu.py codec [requests]
+#        rigbench_emu.py pipeline [polls]
+#        rigbench_emu.py shared [secs]
+#        rigbench_emu.py link [rounds]
+#
+# The emulators are in rigemu.py; the benchmarks of rigserve itself are
+# in rigbench.py.
+#
+# civ      - the IC_r75 backend against a CI-V emulator (see rigemu.py)
+#            on a pty at 'baud': time per get of each method, over the
+#            whole serial path.  Needs pyserial.
+# orion    - tt_orion.py's command sequences against the Orion emulator
+#            (see rigemu.py), v1 and v2 firmware, with different gaps
+#            between commands: time per query, and how many are lost.
+#            To tune the backend's pacing (ORION_DSP_DELAY, GAU_WT).
+# ft897    - the CAT reads behind the simple service's FT-897D features
+#            against the FT-897D emulator (see rigemu.py), at each CAT
+#            rate, receiving and transmitting: time per read, and how
+#            many full polls of the features a second the link allows.
+# codec    - ic_codes' CI-V frame codec against the old byte at a time
+#            serial I/O, on the CI-V emulator (see rigemu.py) in a process
+#            of its own, with no baud rate limit and at 19200: time, read
+#            and write calls, and CPU per command.
+# pipeline - a poll of freq, mode, S meter, AF and RF gain on the CI-V
+#            emulator at 9600 baud, through civbus: one command at a
+#            time against pipelined (see civbus.py), with and without
+#            collisions on the bus: time per poll and failed reads.
+# shared   - SHARED_MODELS on one CI-V emulator bus at 19200 baud, each
+#            polled by a thread of its own through its own civbus.CivBus
+#            on the one port, against the first rig polled alone: polls
+#            a second, failed reads and answers from the wrong rig.
+# link     - tt_orion.py's commands, with its waits (ORION_LINK_ROUND),
+#            through linkctl against the Orion emulator, v1 and v2
+#            firmware: fixed waits and timeouts against adaptive ones.
+#            Time per round, failed queries, and the link_ counters.
+#            Then the IC_r75 backend on a CI-V emulator that is slower
+#            to answer sets than reads: gets, to learn the read timeout,
+#            then gets and puts in turn, which must not fail.  Needs
+#            pyserial.
+
+import sys, os, signal, time, threading, imp
+import rigserve, rigstats, rigemu, ic_codes, civbus, linkctl
+from rigserve import *
+
+CIV_GETS = [ 'VFOA.freq', 'MAIN.rx_mode', 'MAIN.strength_raw',
+             'MAIN.af_gain', 'CONTROL.status' ]
+
+# True if pyserial, which the Icom backends open their port with, is
+# installed.
+def have_pyserial():
+    try:
+        imp.find_module('serial')
+    except ImportError:
+        return False
+    return True
+
+def bench_civ(n, baud):
+    if not have_pyserial():
+        print 'the civ benchmark needs pyserial'
+        return
+    emu = rigemu.CivEmulator(model='R75', baud=baud).start()
+    rigserve.USE_WORKERS = False
+    try:
+        print command('open civ IC_r75')
+        print command('put civ.CONTROL.init %s %d' % (emu.path, baud or 19200))
+        command('cache civ off')
+        for get in CIV_GETS:
+            cmd = 'get civ.' + get
+            reply = command(cmd)
+            t0 = time.time()
+            for i in xrange(n):
+                command(cmd)
+            print '%-20s %8.2f ms  (%s)' % (get,
+                1e3 * (time.time() - t0) / n, reply)
+        command('close civ')
+    finally:
+        emu.stop()
+    print emu.status()
+
+# What tt_orion.py sends: a poll of the usual values, and a bandpass
+# change followed by the AGC parameters (the slow, fragile part).
+ORION_SEQUENCES = [
+    ('poll',     [ '?A', '?B', '?RMM', '?S', '?UM', '?RMG' ]),
+    ('bandpass', [ '*RMF2400', '*RMP100', '?RMF', '?RMP',
+                   '?RMAD', '?RMAH', '?RMAT' ]),
+    ]
+ORION_GAPS    = [ 0., 0.01, 0.02, 0.05, 0.1, 0.2 ]
+ORION_TIMEOUT = 0.2         # secs, like the backend's serial timeout
+
+def orion_round(client, cmds, gap):
+    answered, lost, secs = 0, 0, 0.
+    for cmd in cmds:
+        if gap:
+            time.sleep(gap)
+        client.write(cmd + '\r')
+        if cmd[0] != '?':
+            continue
+        t0 = time.time()
+        if cmd in ('?A', '?B'):
+            reply = client.read(size=7, timeout=ORION_TIMEOUT)
+        else:
+            reply = client.read(end='\r', timeout=ORION_TIMEOUT)
+        if reply:
+            answered += 1
+            secs += time.time() - t0
+        else:
+            lost += 1
+    return answered, lost, secs
+
+def bench_orion(rounds):
+    for firmware in sorted(rigemu.ORION_FIRMWARE.keys()):
+        emu = rigemu.OrionEmulator(firmware=firmware).start()
+        client = rigemu.PtyClient(emu.path)
+        try:
+            for name, cmds in ORION_SEQUENCES:
+                for gap in ORION_GAPS:
+                    answered, lost, secs = 0, 0, 0.
+                    t0 = time.time()
+                    for i in xrange(rounds):
+                        a, l, s = orion_round(client, cmds, gap)
+                        answered, lost, secs = answered + a, lost + l, \
+                                               secs + s
+                    elapsed = time.time() - t0
+                    print '%s %-8s gap %3.0f ms: %6.1f ms per query, ' \
+                        '%3d%% lost, %6.0f ms per round' % (firmware, name,
+                        1e3 * gap, 1e3 * secs / max(answered, 1),
+                        100 * lost / max(answered + lost, 1),
+                        1e3 * elapsed / rounds)
+        finally:
+            client.close()
+            emu.stop()
+        print emu.status()
+
+# The CAT reads behind the simple service's radio features, and the size
+# of their answers.
+FT897_POLL = [
+    ('raw_freq_and_mode_hex', '\x00\x00\x00\x00\x03', 5),
+    ('rx_status',             '\x00\x00\x00\x00\xE7', 1),
+    ('tx_status',             '\x00\x00\x00\x00\xF7', 1),
+    ('tx_metering',           '\x00\x00\x00\x00\xBD', 2),
+    ('eeprom',                '\x00\x55\x00\x00\xBB', 2),
+    ]
+FT897_PTT = { False:'\x00\x00\x00\x00\x88', True:'\x00\x00\x00\x00\x08' }
+
+def bench_ft897(rounds):
+    for baud in rigemu.FT897_BAUDS:
+        emu = rigemu.Ft897Emulator(baud=baud).start()
+        client = rigemu.PtyClient(emu.path)
+        try:
+            for ptt in (False, True):
+                client.write(FT897_PTT[ptt])
+                client.read(size=1)
+                total = 0.
+                for name, cmd, size in FT897_POLL:
+                    t0 = time.time()
+                    for i in xrange(rounds):
+                        client.write(cmd)
+                        if len(client.read(size=size)) != size:
+                            print '%s: no answer' % name
+                    secs = (time.time() - t0) / rounds
+                    total += secs
+                    print '%5d baud %s %-22s %6.1f ms' % (baud,
+                        ('rx', 'tx')[ptt], name, 1e3 * secs)
+                print '%5d baud %s full poll %6.1f ms, %5.1f polls/s' % \
+                    (baud, ('rx', 'tx')[ptt], 1e3 * total, 1. / total)
+            client.write(FT897_PTT[False])
+            client.read(size=1)
+        finally:
+            client.close()
+            emu.stop()
+        print emu.status()
+
+# ic_codes' serial I/O as it was, a byte per read() and write().
+def bytewise_w_cmd0(ser, civ, tup):
+    ser.flushInput()
+    fullcmd = ( 0xFE, 0xFE, civ, 0xE0 ) + tup + (0xFD,)
+    for i in fullcmd:
+        ser.write(chr(i))
+    for i in fullcmd:
+        if ser.read() != chr(i):
+            return NAK + 'echo error'
+    return ACK
+
+def bytewise_get_response(ser):
+    if ser.read(size=4)[:3] != '\xFE\xFE\xE0':
+        return NAK + 'preamble error'
+    a = ''
+    for i in xrange(ic_codes.MAX_RD_DATA):
+        c = ser.read(size=1)
+        if c == '\xFD': break
+        a += c
+    return a
+
+def bytewise_r_freq(ser, civ, tup):
+    bytewise_w_cmd0(ser, civ, tup)
+    ans = bytewise_get_response(ser)
+    f = 0
+    for k in [10,11,8,9,6,7,4,5,2,3]:
+        f = 10*f + ic_codes.nib(ans, k)
+    return float(f)
+
+def bytewise_r_level2(ser, civ, tup):
+    bytewise_w_cmd0(ser, civ, tup)
+    v = bytewise_get_response(ser)
+    u1 = ic_codes.ubcd(v[2])[1]
+    ux = ic_codes.ubcd(v[3])
+    return u1*100 + ux[0]*10 + ux[1]
+
+def bytewise_w_freq(ser, civ, tup, freq):
+    fs = '%010d' % int(freq)
+    out  = ic_codes.bcd4(int(fs[8]),int(fs[9]),int(fs[6]),int(fs[7]))
+    out += ic_codes.bcd4(int(fs[4]),int(fs[5]),int(fs[2]),int(fs[3]))
+    out += ic_codes.bcd2(int(fs[0]),int(fs[1]))
+    bytewise_w_cmd0(ser, civ, tup + out)
+    return bytewise_get_response(ser)
+
+CODEC_CMDS = [
+    ('read freq',  bytewise_r_freq,   ic_codes.r_freq,   (0x03,), ()),
+    ('read level', bytewise_r_level2, ic_codes.r_level2, (0x14, 0x01), ()),
+    ('set freq',   bytewise_w_freq,   ic_codes.w_freq,   (0x05,), (7050000,)),
+    ]
+
+def bench_codec(n):
+    for baud in (0, 19200):
+        emu = rigemu.CivEmulator(baud=baud)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                emu.run()
+            finally:
+                os._exit(0)
+        ser = rigemu.PtySerial(emu.path)
+        civ = emu.address
+        try:
+            for name, old, new, tup, args in CODEC_CMDS:
+                for codec, fn in (('bytewise', old), ('codec', new)):
+                    ser.syscalls = 0
+                    cpu0, t0 = sum(os.times()[:2]), time.time()
+                    for i in xrange(n):
+                        reply = fn(ser, civ, tup, *args)
+                    cpu = sum(os.times()[:2]) - cpu0
+                    print '%5s baud %-10s %-8s %7.3f ms %5.1f calls ' \
+                        '%6.1f us CPU per command (%r)' % (baud or 'no',
+                        name, codec, 1e3 * (time.time() - t0) / n,
+                        float(ser.syscalls) / n, 1e6 * cpu / n, reply)
+        finally:
+            ser.close()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+# (name, ic_codes read function, ICOM_CMD read)
+PIPELINE_POLL = [
+    ('freq',     ic_codes.r_freq,   'RD_OP_FRQ'),
+    ('mode',     ic_codes.r_data,   'RD_OP_MODE'),
+    ('s-meter',  ic_codes.r_level1, 'RD_STRENGTH'),
+    ('af',       ic_codes.r_level1, 'GET_AF'),
+    ('rf',       ic_codes.r_level1, 'GET_RF'),
+    ]
+PIPELINE_BAUD    = 9600
+PIPELINE_LATENCY = 0.004    # secs, a USB serial adapter
+PIPELINE_DELAY   = 0.003    # secs the rig takes to answer
+
+def bench_pipeline(n):
+    for collisions in (0., 0.05):
+        emu = rigemu.CivEmulator(baud=PIPELINE_BAUD, delay=PIPELINE_DELAY,
+                                 latency=PIPELINE_LATENCY,
+                                 collisions=collisions)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                emu.run()
+            finally:
+                os._exit(0)
+        bus = civbus.attach(emu.path, emu.address,
+                            lambda: rigemu.PtySerial(emu.path))
+        civ = emu.address
+        cmds = [ (fn, ic_codes.ICOM_CMD[s][ic_codes.BN])
+                 for name, fn, s in PIPELINE_POLL ]
+        frames = [ ic_codes.frame(civ, tup) for fn, tup in cmds ]
+        try:
+            for mode in ('one at a time', 'pipelined'):
+                failed = 0
+                t0 = time.time()
+                for i in xrange(n):
+                    if mode == 'pipelined':
+                        bus.pipeline(frames)
+                    for fn, tup in cmds:
+                        if is_nak(fn(bus, civ, tup)):
+                            failed += 1
+                print '%d%% collisions, %-13s: %6.1f ms per poll, ' \
+                    '%d of %d reads failed' % (100 * collisions, mode,
+                    1e3 * (time.time() - t0) / n, failed, n * len(cmds))
+        finally:
+            bus.close()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+    print rigstats.report()
+
+# A round of tt_orion.py: bandpass put (filter and PBT, each followed by
+# the DSP wait) and get,
+# agc_user get (PROG, then each parameter after the AGC wait), a memory
+# recalled to VFO A and its freq read, and a poll.  (command, wait held
+# after it)
+ORION_LINK_ROUND = [
+    ('*RMF2400', 'dsp'), ('*RMP100', 'dsp'), ('?RMF', None), ('?RMP', None),
+    ('*RMAP', 'agc'), ('?RMAD', 'agc'), ('?RMAH', 'agc'), ('?RMAT', None),
+    ('*KRA1', 'memory'), ('?A', None), ('?RMM', None), ('?S', None),
+    ]
+# tt_orion.py's ORION_GAPS (it cannot be imported here without tentec)
+ORION_LINK_GAPS = { 'dsp':0.2, 'agc':0.1, 'memory':0.4 }
+
+def orion_command(client, cmd, timeout):
+    client.write(cmd + '\r')
+    if cmd[0] != '?':
+        return ACK
+    if cmd in ('?A', '?B'):
+        reply = client.read(size=7, timeout=timeout)
+    else:
+        reply = client.read(end='\r', timeout=timeout)
+    if reply:
+        return reply
+    return NAK + 'no answer.'
+
+def link_counter(name):
+    return sum([ v for k, v in rigstats.counters.items() if k[0] == name ])
+
+# Sets answered LINK_SET_DELAY secs later than reads: longer than the
+# read timeout learned, shorter than the fixed one.
+LINK_SET_DELAY = 0.1
+
+def bench_link_icom(rounds):
+    if not have_pyserial():
+        print 'the Icom part of the link benchmark needs pyserial'
+        return
+    emu = rigemu.CivEmulator(model='R75', delay=PIPELINE_DELAY,
+                             set_delay=LINK_SET_DELAY).start()
+    rigserve.USE_WORKERS = False
+    try:
+        command('open civ IC_r75')
+        command('put civ.CONTROL.init %s 19200' % emu.path)
+        command('cache civ off')
+        for i in xrange(2 * linkctl.MIN_SAMPLES):
+            command('get civ.VFOA.freq')
+        timeout = backEnd['civ'].link.timeout('RD_OP_FRQ')
+        failed_gets = failed_puts = 0
+        t0 = time.time()
+        for i in xrange(rounds):
+            if is_nak(command('get civ.VFOA.freq')):
+                failed_gets += 1
+            if is_nak(command('put civ.VFOA.freq %d' % (7000000 + 10 * i))):
+                failed_puts += 1
+        print 'IC_r75: read timeout %.1f ms, sets take %.0f ms more: ' \
+            '%.1f ms per get and put, %d gets and %d puts failed' % \
+            (1e3 * timeout, 1e3 * LINK_SET_DELAY,
+             1e3 * (time.time() - t0) / rounds, failed_gets, failed_puts)
+        command('close civ')
+    finally:
+        emu.stop()
+    print emu.status()
+
+def bench_link(rounds):
+    for firmware in sorted(rigemu.ORION_FIRMWARE.keys()):
+        emu = rigemu.OrionEmulator(firmware=firmware).start()
+        client = rigemu.PtyClient(emu.path)
+        try:
+            for adaptive in (False, True):
+                rigstats.reset()
+                link = linkctl.LinkControl('TT_orion_' + firmware,
+                    ORION_TIMEOUT, ORION_LINK_GAPS, adaptive=adaptive)
+                failed = 0
+                t0 = time.time()
+                for i in xrange(rounds):
+                    for cmd, wait in ORION_LINK_ROUND:
+                        kind = None
+                        if cmd[0] == '?':
+                            kind = cmd
+                        r = link.run(kind, lambda timeout:
+                                     orion_command(client, cmd, timeout))
+                        if is_nak(r):
+                            failed += 1
+                        if wait:
+                            link.hold(wait)
+                print '%s %-8s: %6.0f ms per round, %d queries failed, ' \
+                    '%d retries, %.2f s saved, %.2f s retrying' % \
+                    (firmware, ('fixed', 'adaptive')[adaptive],
+                     1e3 * (time.time() - t0) / rounds, failed,
+                     link_counter('link_retries_total'),
+                     link_counter('link_saved_seconds_total'),
+                     link_counter('link_retry_seconds_total'))
+            print '%s gaps: %s; timeout of ?S %.1f ms' % (firmware,
+                ', '.join([ '%s %.3f s' % (cls, g.safe) for cls, g in
+                            sorted(link.gaps.items()) ]),
+                1e3 * link.timeout('?S'))
+        finally:
+            client.close()
+            emu.stop()
+        print emu.status()
+
+SHARED_MODELS = ('R75', 'R8500', 'R9000')
+SHARED_POLL = PIPELINE_POLL[1:3]    # mode and S meter; freq is checked
+
+# Poll the rig of 'bus' for 'secs': each poll reads the rig's freq (it
+# must be 'freq', or another rig answered) and SHARED_POLL.  Adds
+# [polls, failed reads, wrong answers] to 'results'.
+def shared_poller(bus, freq, secs, results):
+    civ = bus.civ
+    get_freq = ic_codes.ICOM_CMD['RD_OP_FRQ'][ic_codes.BN]
+    cmds = [ (fn, ic_codes.ICOM_CMD[s][ic_codes.BN])
+             for name, fn, s in SHARED_POLL ]
+    polls = failed = wrong = 0
+    deadline = time.time() + secs
+    while time.time() < deadline:
+        f = ic_codes.r_freq(bus, civ, get_freq)
+        if is_nak(f):
+            failed += 1
+        elif f != freq:
+            wrong += 1
+        for fn, tup in cmds:
+            if is_nak(fn(bus, civ, tup)):
+                failed += 1
+        polls += 1
+    results.append([polls, failed, wrong])
+
+def bench_shared(secs):
+    emu = rigemu.CivEmulator(model=','.join(SHARED_MODELS),
+                             delay=PIPELINE_DELAY, latency=PIPELINE_LATENCY)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            emu.run()
+        finally:
+            os._exit(0)
+    opener = lambda: rigemu.PtySerial(emu.path)
+    set_freq = ic_codes.ICOM_CMD['SET_FREQ'][ic_codes.BN]
+    try:
+        for models in (SHARED_MODELS[:1], SHARED_MODELS):
+            buses = [ civbus.attach(emu.path, ic_codes.CIVAD[m], opener, m)
+                      for m in models ]
+            results, threads = [], []
+            for i in xrange(len(buses)):
+                freq = 7000000. + 100000 * i    # a freq of its own
+                ic_codes.w_freq(buses[i], buses[i].civ, set_freq, freq)
+                threads.append(threading.Thread(target=shared_poller,
+                    args=(buses[i], freq, secs, results)))
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for bus in buses:
+                bus.close()
+            polls = sum([ r[0] for r in results ])
+            print '%d rig(s) on the port: %6.1f polls/s (%s), %d reads ' \
+                'failed, %d wrong answers' % (len(models), polls / secs,
+                ' '.join([ '%d' % r[0] for r in results ]),
+                sum([ r[1] for r in results ]),
+                sum([ r[2] for r in results ]))
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: %s civ [requests] [baud] | orion [rounds] |' \
+            ' ft897 [rounds] | codec [requests] | pipeline [polls] |' \
+            ' shared [secs] | link [rounds]' % sys.argv[0]
+        sys.exit(1)
+    if sys.argv[1] == 'civ':
+        n, baud = 50, 19200
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        if len(sys.argv) > 3: baud = int(sys.argv[3])
+        bench_civ(n, baud)
+    elif sys.argv[1] == 'orion':
+        rounds = 5
+        if len(sys.argv) > 2: rounds = int(sys.argv[2])
+        bench_orion(rounds)
+    elif sys.argv[1] == 'ft897':
+        rounds = 20
+        if len(sys.argv) > 2: rounds = int(sys.argv[2])
+        bench_ft897(rounds)
+    elif sys.argv[1] == 'codec':
+        n = 500
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        bench_codec(n)
+    elif sys.argv[1] == 'pipeline':
+        n = 50
+        if len(sys.argv) > 2: n = int(sys.argv[2])
+        bench_pipeline(n)
+    elif sys.argv[1] == 'shared':
+        secs = 5.0
+        if len(sys.argv) > 2: secs = float(sys.argv[2])
+        bench_shared(secs)
+    elif sys.argv[1] == 'link':
+        rounds = 20
+        if len(sys.argv) > 2: rounds = int(sys.argv[2])
+        bench_link(rounds)
+        bench_link_icom(rounds)
+    else:
+        print 'unknown benchmark: %s' % sys.argv[1]
+        sys.exit(1)
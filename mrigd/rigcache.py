@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# File: rigcache.py
+# Version: 1.0
+#
+# mrigd: read-through cache of rig values for rigserve
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Several services poll the same rig values within a few milliseconds of
+# each other.  A RigCache keeps the last answer of every get for a short
+# time (its TTL, per method) so that only the first one reaches the rig.
+#
+# A put drops the cached values of its method and of the methods it is
+# known to affect (RELATED); a put of 'init' drops everything.  Methods
+# with no TTL, or a TTL of 0, are never cached.
+#
+# Only gets the cache could have answered count as hits or misses; those
+# of a method never cached, or made while the cache is off, are counted
+# apart as bypassed.
+
+import threading, time
+from globals import *
+
+# Default TTLs in seconds.  Meters change all the time and get the
+# shortest ones; settings only change on a put or from the front panel.
+CACHE_TTL = {
+    'info':             5.0,
+    'vfo_step':         1.0,
+    'freq':             0.1,
+    'rx_mode':          0.25,
+    'tx_mode':          0.25,
+    'bandpass':         0.25,
+    'bandpass_limits':  0.25,
+    'agc_mode':         0.25,
+    'agc_user':         0.25,
+    'af_gain':          0.25,
+    'rf_gain':          0.25,
+    'squelch_level':    0.25,
+    'rit':              0.25,
+    'xit':              0.25,
+    'mic_gain':         0.25,
+    'speech_proc':      0.25,
+    'power':            0.25,
+    'noise_blank':      0.25,
+    'noise_reduce':     0.25,
+    'notch_auto':       0.25,
+    'preamp':           0.25,
+    'atten':            0.25,
+    'transmit':         0.05,
+    'squelch_open':     0.05,
+    'strength':         0.05,
+    'strength_raw':     0.05,
+    'swr':              0.05,
+    'swr_raw':          0.05,
+    }
+
+# method:[other methods whose value a put of 'method' may change]
+RELATED = {
+    'freq':             ['vfo_memory', 'strength', 'strength_raw',
+                         'squelch_open'],
+    'vfo_select':       ['freq', 'rx_mode', 'tx_mode'],
+    'vfo_memory':       ['freq'],
+    'memory_channel':   ['vfo_memory', 'freq'],
+    'rx_mode':          ['tx_mode', 'bandpass', 'bandpass_limits'],
+    'tx_mode':          ['rx_mode'],
+    'bandpass':         ['bandpass_limits'],
+    'bandpass_limits':  ['bandpass'],
+    'bandpass_standard':['bandpass', 'bandpass_limits'],
+    'agc_mode':         ['agc_user'],
+    'agc_user':         ['agc_mode'],
+    'squelch_level':    ['squelch_open'],
+    'transmit':         ['power', 'swr', 'swr_raw', 'strength',
+                         'strength_raw'],
+    }
+
+class RigCache(object):
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.ttl     = CACHE_TTL.copy()     # method:secs
+        self.values  = {}                   # (trv, method):(reply, time)
+        self.enabled = True
+        self.writers = 0        # puts queued but not yet run
+        self.hits    = 0
+        self.misses  = 0        # cacheable gets that reached the rig
+        self.bypassed = 0       # gets not cacheable (cache off, no TTL)
+        self.drops   = 0        # values dropped by a put
+
+    # Returns (reply, age in secs) or None.
+    def lookup(self, trv, method, count_miss=True):
+        self.lock.acquire()
+        try:
+            if not self.enabled or self.ttl.get(method, 0) <= 0:
+                if count_miss:
+                    self.bypassed += 1
+                return None
+            entry = self.values.get((trv, method))
+            if entry != None:
+                age = time.time() - entry[1]
+                if age < self.ttl.get(method, 0):
+                    self.hits += 1
+                    return entry[0], age
+            if count_miss:
+                self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+
+    # Would lookup() find a value?  (Not counted as a hit or a miss.)
+    def fresh(self, trv, method):
+        self.lock.acquire()
+        entry = self.values.get((trv, method))
+        self.lock.release()
+        return entry != None and \
+            time.time() - entry[1] < self.ttl.get(method, 0)
+
+    def store(self, trv, method, reply, when):
+        if not self.enabled or self.ttl.get(method, 0) <= 0:
+            return
+        if str(reply).startswith(NAK1):
+            return              # errors are never kept
+        self.lock.acquire()
+        self.values[(trv, method)] = (reply, when)
+        self.lock.release()
+
+    # A put of 'method' was done: forget what it may have changed.
+    def invalidate(self, method):
+        self.lock.acquire()
+        if method == 'init':
+            self.drops += len(self.values)
+            self.values = {}
+        else:
+            methods = [method] + RELATED.get(method, [])
+            for key in self.values.keys():
+                if key[1] in methods:
+                    del self.values[key]
+                    self.drops += 1
+        self.lock.release()
+
+    def clear(self):
+        self.invalidate('init')
+
+    def set_ttl(self, method, secs):
+        self.lock.acquire()
+        self.ttl[method] = secs
+        for key in self.values.keys():
+            if key[1] == method:
+                del self.values[key]
+        self.lock.release()
+
+    def set_enabled(self, on):
+        self.enabled = on
+        if not on:
+            self.clear()
+
+    # Count queued puts, so the network side does not answer a get from
+    # the cache while a put for the same rig is still waiting to run.
+    def put_queued(self):
+        self.lock.acquire()
+        self.writers += 1
+        self.lock.release()
+
+    def put_done(self):
+        self.lock.acquire()
+        self.writers -= 1
+        self.lock.release()
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = 0.
+        if total: ratio = 100. * self.hits / total
+        return 'cache %s: %d hits, %d misses (%.1f%% hit), %d bypassed, %d dropped, %d kept' % \
+            ({True:'on', False:'off'}[self.enabled], self.hits, self.misses,
+             ratio, self.bypassed, self.drops, len(self.values))
+
+    def ttl_list(self):
+        names = self.ttl.keys()
+        names.sort()
+        return ' '.join([ '%s=%g' % (n, self.ttl[n]) for n in names ])
@@ -26,26 +26,62 @@
 
 # Send commands to the listener's port and listen for replies.
 #
+# Usage: rigclient.py [address]             interactive
+#        rigclient.py [address] < commands  non-interactive: the commands,
+#                                           one per line, are sent without
+#                                           waiting, replies printed in order
+#
+# 'address' is "host:port", "unix:/path" or just the path of rigserve's
+# Unix socket; by default localhost:PORT.
+#
 #from common import *
 
 
 PORT    =14652      # Pick a memorable port number to listen on.
+WINDOW  =64         # non-interactive: commands in flight at a time
+
+import sys
+import rigconn
+
+def address(arg):
+  if ':' in arg:            # host:port or unix:/path
+    return arg
+  return rigconn.UNIX_PREFIX + arg
+
+def interactive(client):
+  try:
+    while True:
+      cmd = raw_input(' $')
+      resp = client.command(cmd)
+      print '....resp:',resp
+      if cmd == 'quit': break
+  finally:
+    client.close()
+    print 'client socket closed'
+
+def streamed(client):
+  pending = []
+  for line in sys.stdin:
+    cmd = line.strip()
+    if cmd == '' or cmd.startswith('#'):
+      continue
+    pending.append(client.submit(cmd))
+    if len(pending) >= WINDOW:
+      print pending.pop(0).result()
+  for future in pending:
+    print future.result()
+  client.close()
 
-import socket, sys
-
-print 'rigclient.py v. 0.22'
-print 'Using Port', PORT
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect(('localhost', PORT))
-print 'Connected to server'
-print s.recv(1024)      # Welcome message
-try:
-  while True:
-    cmd = raw_input(' $')
-    s.sendall(cmd)
-    resp = s.recv(10240)
-    print '....resp:',resp
-    if cmd == 'quit': break
-finally:
-  s.close()
-  print 'client socket closed'
+if __name__ == '__main__':
+  where = 'localhost:%d' % PORT
+  if len(sys.argv) > 1:
+    where = address(sys.argv[1])
+  client = rigconn.Client(where)
+  if sys.stdin.isatty():
+    print 'rigclient.py v. 0.22'
+    print 'Using', where
+    client.connect()
+    print 'Connected to server'
+    interactive(client)
+  else:
+    streamed(client)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+#
+# File: rigconn.py
+# Version: 1.0
+#
+# mrigd: starting and connecting to rigserve and its services
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Readiness, instead of sleeping and hoping:
+#
+#   - spawn() starts rigserve with the write end of a pipe, named in the
+#     MRIGD_READY_FD environment variable.  rigserve calls signal_ready()
+#     once it is listening, and wait_ready() in the parent returns then.
+#   - connect() and bind() retry quickly at first and back off up to
+#     MAX_BACKOFF, so a peer that comes up a few ms later costs a few ms,
+#     not a whole second.
+#
+# Local hops (mrigd, the services) may use Unix domain sockets instead of
+# loopback TCP.  An address given as text is either "host:port" or
+# "unix:/path/to/socket"; see parse_addr().  A datagram sync that goes
+# to UDP port N over TCP goes to "<path>.N" over a Unix socket.
+#
+# Client is what mrigd and the services use to talk to rigserve: a pool
+# of framed connections (see rigframe.py), opened when first needed and
+# again after they break.  submit() sends a command at once and returns
+# a Future; any number of commands can be in flight.  Errors, timeouts
+# and lost connections come back as NAK replies, like rigserve's own.
+#
+# Any number of threads may wait for replies on one connection.  One of
+# them at a time reads the socket, with the connection's lock released,
+# for up to READ_SLICE secs; then it wakes the others, who take their
+# replies or check their timeouts, and one of those still waiting reads
+# next.  The reply to a request whose waiter gave up is thrown away when
+# it is read.
+
+import os, socket, select, time, errno, stat, threading
+import rigframe, rigtrace
+from globals import *
+
+READY_ENV   = 'MRIGD_READY_FD'
+READY_MSG   = 'READY\n'
+MIN_BACKOFF = 0.005     # secs, first retry
+MAX_BACKOFF = 0.5       # secs, longest wait between retries
+UNIX_PREFIX = 'unix:'
+CLIENT_TIMEOUT = 5.     # secs to wait for a reply, by default
+READ_SLICE  = 0.05      # secs a waiter reads before the others look
+
+# Where the services find rigserve.  rigserve sets it before starting
+# them, so the services (forked from rigserve) use the same transport.
+RIGSERVE_ADDR = '127.0.0.1:14652'
+
+# Run 'argv' in a child process, with a readiness pipe.  Returns
+# (pid, fd to give to wait_ready).
+def spawn(argv):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        os.environ[READY_ENV] = str(wfd)
+        try:
+            os.execvp(argv[0], argv)
+        finally:
+            os._exit(127)
+    os.close(wfd)
+    return pid, rfd
+
+# Wait until the child says it is ready.  False on timeout, or if the
+# child exited first.
+def wait_ready(fd, timeout):
+    deadline = time.time() + timeout
+    msg = ''
+    while True:
+        left = deadline - time.time()
+        if left <= 0:
+            return False
+        try:
+            r, w, e = select.select([fd], [], [], left)
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                continue
+            raise
+        if not r:
+            return False
+        data = os.read(fd, 64)
+        if data == '':
+            os.close(fd)
+            return msg == READY_MSG
+        msg += data
+        if msg == READY_MSG:
+            os.close(fd)
+            return True
+
+# Called by the spawned program when it is ready to serve.  Does nothing
+# if it was not started by spawn().
+def signal_ready():
+    fd = os.environ.pop(READY_ENV, None)
+    if fd == None:
+        return
+    try:
+        os.write(int(fd), READY_MSG)
+        os.close(int(fd))
+    except (OSError, ValueError):
+        pass
+
+def backoff(delay):
+    time.sleep(delay)
+    return min(delay * 2, MAX_BACKOFF)
+
+# Connect to 'addr', retrying for up to 'timeout' secs.  Returns the
+# connected socket, or raises socket.error.  A Unix socket is first
+# bound to the path 'local', if given, so the server can tell its
+# clients apart (see client_path()).
+def connect(addr, timeout, family=socket.AF_INET, local=None):
+    deadline = time.time() + timeout
+    delay = MIN_BACKOFF
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if local != None:
+                remove_stale(local)
+                sock.bind(local)
+            sock.connect(addr)
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except socket.error:
+            sock.close()
+            if time.time() + delay > deadline:
+                raise
+        delay = backoff(delay)
+
+# Bind 'sock' to 'addr', retrying for up to 'timeout' secs while the
+# address is in use.  Returns True if bound.
+def bind(sock, addr, timeout):
+    if sock.family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    deadline = time.time() + timeout
+    delay = MIN_BACKOFF
+    while True:
+        try:
+            sock.bind(addr)
+            return True
+        except socket.error:
+            if time.time() + delay > deadline:
+                return False
+        delay = backoff(delay)
+
+# "host:port" -> (AF_INET, (host, port)), "unix:/path" -> (AF_UNIX, path)
+def parse_addr(where):
+    if where.startswith(UNIX_PREFIX):
+        return socket.AF_UNIX, where[len(UNIX_PREFIX):]
+    host, port = where.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def is_unix(where):
+    return where.startswith(UNIX_PREFIX)
+
+# connect() to an address given as text.
+def connect_to(where, timeout, local=None):
+    family, addr = parse_addr(where)
+    return connect(addr, timeout, family, local)
+
+def connect_rigserve(timeout):
+    return connect_to(RIGSERVE_ADDR, timeout)
+
+# A listening stream socket on an address given as text, or None if it
+# cannot be bound within 'timeout' secs.  A Unix socket left behind by a
+# previous run is removed first.
+def listen(where, timeout, backlog=5):
+    family, addr = parse_addr(where)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        remove_stale(addr)
+    else:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if not bind(sock, addr, timeout):
+        sock.close()
+        return None
+    sock.listen(backlog)
+    return sock
+
+def remove_stale(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+
+# Path of the Unix datagram socket standing in for UDP port 'port'.
+def sync_path(path, port):
+    return '%s.%d' % (path, int(port))
+
+# A path of this connection's own (process id and a count, so that two
+# connections of one process do not remove each other's), next to the
+# Unix socket 'path' of a server, to connect() from.  A server that
+# sends datagrams to its clients sends them to sync_path() of the
+# client's path, as it sends them to the client's IP address over UDP.
+client_count = [0]
+client_lock = threading.Lock()
+
+def client_path(path):
+    client_lock.acquire()
+    try:
+        client_count[0] += 1
+        n = client_count[0]
+    finally:
+        client_lock.release()
+    return '%s-%d-%d' % (path, os.getpid(), n)
+
+# A datagram socket bound to UDP 'port' of interface 'where', or, for
+# "unix:/path", to sync_path(path, port).
+def datagram(where, port):
+    if is_unix(where):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        path = sync_path(where[len(UNIX_PREFIX):], port)
+        remove_stale(path)
+        sock.bind(path)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((where, int(port)))
+    return sock
+
+# ------- Pooled, pipelining client ---------
+
+class Future(object):
+    def __init__(self, conn, req_id, generation, value=None):
+        self.conn = conn
+        self.req_id = req_id
+        self.generation = generation
+        self.value = value
+
+    # The reply text, waiting up to 'timeout' secs (None: the client's).
+    def result(self, timeout=None):
+        if self.value == None:
+            self.value = self.conn.result(self, timeout)
+        return self.value
+
+class PooledConnection(object):
+    def __init__(self, where, setup, connect_timeout, timeout):
+        self.where = where
+        self.setup = setup
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.client = None          # rigframe.FramedClient, when open
+        self.generation = 0         # +1 on every reconnect
+        self.abandoned = set()      # request ids nobody waits for any more
+        self.reading = False        # a waiter is reading the socket
+
+    def open(self):
+        sock = connect_to(self.where, self.connect_timeout)
+        sock.settimeout(self.timeout)
+        self.client = rigframe.FramedClient(sock)
+        self.generation += 1
+        self.abandoned = set()
+        for cmd in self.setup:
+            self.client.command(cmd)
+
+    def drop(self):
+        if self.client != None:
+            self.client.sock.close()
+            self.client = None
+
+    # Send 'cmd'; a connection found broken is opened again, once.
+    def send(self, cmd):
+        self.lock.acquire()
+        try:
+            for attempt in (1, 2):
+                try:
+                    if self.client == None:
+                        self.open()
+                    return Future(self, self.client.send(cmd),
+                                  self.generation)
+                except (socket.error, EOFError, IOError), e:
+                    self.drop()
+            return Future(self, 0, 0,
+                          NAK + 'cannot reach rigserve at %s: %s' % (self.where, e))
+        finally:
+            self.lock.release()
+
+    def result(self, future, timeout):
+        if timeout == None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                if future.generation != self.generation or self.client == None:
+                    return NAK + 'connection to rigserve lost.'
+                reply = self.client.replies.pop(future.req_id, None)
+                if reply != None:
+                    break
+                left = deadline - time.time()
+                if left <= 0:
+                    self.abandoned.add(future.req_id)
+                    return NAK + 'no reply from rigserve in %g s.' % timeout
+                if self.reading:
+                    self.cond.wait()        # the reader wakes us
+                else:
+                    self.read(min(left, READ_SLICE))
+        finally:
+            self.cond.release()
+        status, payload = reply
+        if status == rigframe.ST_NAK:
+            return NAK + payload
+        return payload
+
+    # Read what rigserve sends in the next 'secs', with the lock (held
+    # on entry) released meanwhile, and wake the other waiters.
+    def read(self, secs):
+        client = self.client
+        self.reading = True
+        self.cond.release()
+        data, lost = '', False
+        try:
+            try:
+                if select.select([client.sock], [], [], secs)[0]:
+                    data = client.sock.recv(8192)
+                    lost = data == ''
+            except (socket.error, select.error, ValueError):
+                lost = True             # also: closed meanwhile
+        finally:
+            self.cond.acquire()
+            self.reading = False
+            self.cond.notify_all()
+        if client is not self.client:
+            return                      # dropped or opened again meanwhile
+        if lost:
+            self.drop()
+            return
+        client.buf += data
+        client.take()
+        for req_id in self.abandoned & set(client.replies.keys()):
+            del client.replies[req_id]
+            self.abandoned.discard(req_id)
+
+    def close(self):
+        self.lock.acquire()
+        self.drop()
+        self.lock.release()
+
+class Client(object):
+    # 'where' defaults to RIGSERVE_ADDR; 'size' connections are used in
+    # turn.  'setup' commands are run on every new connection (e.g.
+    # "priority poll").
+    def __init__(self, where=None, size=1, timeout=CLIENT_TIMEOUT,
+                 setup=(), connect_timeout=5.):
+        if where == None:
+            where = RIGSERVE_ADDR
+        self.pool = [ PooledConnection(where, setup, connect_timeout,
+                                       timeout) for i in xrange(size) ]
+        self.next = 0
+        self.lock = threading.Lock()    # for 'next'
+
+    # Open all the connections now, rather than on first use.  Raises
+    # socket.error if rigserve cannot be reached.
+    def connect(self):
+        for conn in self.pool:
+            conn.lock.acquire()
+            try:
+                if conn.client == None:
+                    conn.open()
+            finally:
+                conn.lock.release()
+        return self
+
+    def submit(self, cmd):
+        self.lock.acquire()
+        conn = self.pool[self.next]
+        self.next = (self.next + 1) % len(self.pool)
+        self.lock.release()
+        return conn.send(cmd)
+
+    def command(self, cmd, timeout=None):
+        return self.submit(cmd).result(timeout)
+
+    # Send all of 'cmds' at once, then collect the replies, in order.
+    def pipeline(self, cmds, timeout=None):
+        futures = [ self.submit(cmd) for cmd in cmds ]
+        return [ f.result(timeout) for f in futures ]
+
+    # get/put/test commands as one rigserve 'batch': one request, one
+    # trip to the rig's worker.  Returns the list of replies.  'trace' is
+    # (trace id, stages so far) to carry the batch in a trace.
+    def batch(self, cmds, timeout=None, trace=None):
+        if not cmds:
+            return []
+        cmd = make_batch(cmds)
+        if trace != None:
+            cmd = rigtrace.tag(trace[0], cmd, trace[1])
+        response = self.command(cmd, timeout)
+        if response.startswith(NAK1):
+            return [ response ] * len(cmds)
+        replies = parse_batch(response)
+        if replies == None:
+            return [ NAK + 'bad batch reply.' ] * len(cmds)
+        return replies
+
+    # Values pushed by watches, [(status, payload)], taken off the list.
+    def pushes(self):
+        pushed = []
+        for conn in self.pool:
+            conn.lock.acquire()
+            if conn.client != None:
+                pushed += conn.client.pushes
+                conn.client.pushes = []
+            conn.lock.release()
+        return pushed
+
+    def close(self):
+        for conn in self.pool:
+            conn.close()
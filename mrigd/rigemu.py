@@ -0,0 +1,819 @@
+#!/usr/bin/env python
+#
+# File: rigemu.py
+# Version: 1.0
+#
+# mrigd: rig emulators on pseudo-terminals, for testing without a radio
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Usage: rigemu.py icom [--model=R75[,R8500...]] [--link=/tmp/civ] [options]
+#        rigemu.py orion [--firmware=v1|v2] [--link=/tmp/orion] [options]
+#        rigemu.py ft897 [--baud=4800] [--eeprom=dump] [--link=/tmp/cat] [options]
+#
+#   --baud=N          bytes go over the "wire" at N baud (0: no limit)
+#   --delay=SECS      the rig thinks this long before it answers
+#   --jitter=SECS     plus up to this much more, at random
+#   --latency=SECS    what the controller writes reaches the rig this much
+#                     later, as through a USB serial adapter
+#   --collisions=P    this fraction of the commands collide on the bus
+#   --transceive=SECS the dial moves every SECS, and the rig says so
+#                     (icom)
+#   --eeprom=PATH     start from this EEPROM image, e.g. a dump of a real
+#                     rig (ft897)
+#
+# An emulator owns a pseudo-terminal and answers on it like the rig
+# would on its serial port.  A backend opens the pty's slave (printed at
+# start, or the --link symlink to it) like a real port:
+#
+#   open rig1 IC_r75
+#   put rig1.CONTROL.init /tmp/civ 19200
+#
+# rigbench_emu.py uses the emulators to time the serial path of a backend.
+#
+# CivEmulator is an Icom rig on a CI-V bus:
+#
+#   - everything sent to the bus comes back (the echo), as it does on
+#     the single CI-V wire;
+#   - frames are FE FE <to> <from> <cmd> [<sub>] [<data>] FD; the rig
+#     answers those for its address with data, FB (OK) or FA (NG);
+#   - frequency, mode, levels (0x14), meters (0x15), switches (0x16),
+#     PTT (0x1C 00) and ID (0x19 00) are kept and read back;
+#   - with transceive on, dial changes are broadcast to address 00;
+#   - a set is answered (FB) --set_delay secs later than a read, as a
+#     rig relocking its PLL;
+#   - a collision garbles a command on the bus: the sender sees a bad
+#     echo and no answer, like on a real bus with two talkers.
+#
+# --model=R75,R8500 puts several rigs (CivRig) on the one bus, each
+# answering at its own address, as a receiver farm on one interface.
+#
+# OrionEmulator is a Ten-Tec Orion, as tt_orion.py talks to it:
+#
+#   - commands end in CR; "*..." sets a value and gets no answer, "?..."
+#     is answered with "@..." and CR;
+#   - "*A"/"?A" carry the VFO freq as 4 binary bytes (FREQIO_BINARY),
+#     "*AF"/"?AF" as digits;
+#   - "?S" is the S meter (receiving) or the SWR bridge (transmitting),
+#     "?V" the firmware version, "XX" a reset ("ORION START").
+#
+# Its timing follows ORION_FIRMWARE.  v1 firmware loses commands that
+# come too soon after the previous one, while the DSP settles after a
+# filter, PBT or memory change, and AGC queries not spaced by GAU_WT:
+# they get no answer, the backend times out.  v2 is faster and makes
+# commands wait out the DSP instead.
+#
+# Ft897Emulator is a Yaesu FT-897D on its CAT port:
+#
+#   - 8N2 at 4800, 9600 or 38400 baud, the CAT RATE menu choices;
+#   - every command is 5 bytes, the opcode last: P1 P2 P3 P4 OP;
+#   - reads answer with data: freq and mode (0x03, 4 BCD bytes of 10 Hz
+#     and the mode), RX status (0xE7), TX status (0xF7), TX metering
+#     (0xBD) and 2 EEPROM bytes (0xBB);
+#   - sets answer 0x00, or 0xF0 if refused (e.g. PTT on when it is on);
+#   - unknown opcodes get no answer, and bytes of a command left
+#     incomplete for FT897_RESYNC secs are thrown away, as the rig does.
+#
+# Each command takes FT897_LATENCY secs in the rig (more for a freq
+# change, which relocks the PLL), plus the --delay given, so the time
+# of a command is about that plus 11 bits per byte each way.
+
+import os, sys, tty, select, threading, time, random, struct, array
+import fcntl, termios
+from ic_codes import CIVAD
+
+# ------- Pseudo-terminal and "wire" ---------
+
+class PtyEmulator(object):
+    # 'bits' per byte on the wire: start, 8 data and the stop bits.
+    def __init__(self, baud=19200, delay=0., jitter=0., link=None, bits=10,
+                 latency=0.):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)      # no echo, no line editing
+        self.path = os.ttyname(self.slave)
+        self.link = link
+        if link != None:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+        self.byte_time = 0.
+        if baud:
+            self.byte_time = float(bits) / baud
+        self.delay = delay
+        self.jitter = jitter
+        self.latency = latency
+        self.running = False
+        self.thread = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Send 'data' down the wire, taking as long as the baud rate says.
+    def send(self, data):
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        os.write(self.master, data)
+        self.bytes_out += len(data)
+
+    # The rig's thinking time before an answer.
+    def think(self):
+        t = self.delay
+        if self.jitter:
+            t += random.uniform(0., self.jitter)
+        if t > 0:
+            time.sleep(t)
+
+    # To be defined by the emulators: bytes from the controller, and
+    # a call about every 'tick' secs for unsolicited output.
+    def received(self, data):
+        pass
+
+    def tick(self):
+        pass
+
+    def run(self, tick=0.01):
+        self.running = True
+        while self.running:
+            r, w, e = select.select([self.master], [], [], tick)
+            if r:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break
+                self.bytes_in += len(data)
+                if self.latency:
+                    time.sleep(self.latency)
+                self.received(data)
+            self.tick()
+
+    # Run in a thread of our own; returns self.
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='rigemu')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link != None and os.path.islink(self.link):
+            os.unlink(self.link)
+
+# ------- Icom CI-V ---------
+
+PREAMBLE  = '\xFE\xFE'
+EOM       = '\xFD'
+OK        = '\xFB'
+NG        = '\xFA'
+CONTROLLER = 0xE0           # the computer's default address
+BROADCAST  = 0x00
+TRANSCEIVE_STEP = 100       # Hz the dial moves per transceive tick
+
+# Frequency <-> 5 BCD bytes, least significant first.
+def freq_bcd(f):
+    s = '%010d' % int(f)
+    return ''.join([ chr(int(s[i]) << 4 | int(s[i+1]))
+                     for i in (8, 6, 4, 2, 0) ])
+
+def bcd_freq(data):
+    f = 0
+    for c in reversed(data[:5]):
+        f = f * 100 + (ord(c) >> 4) * 10 + (ord(c) & 0x0F)
+    return f
+
+# Level 0-255 <-> 2 BCD bytes ("0255" -> 02 55).
+def level_bcd(v):
+    s = '%04d' % v
+    return chr(int(s[0]) << 4 | int(s[1])) + chr(int(s[2]) << 4 | int(s[3]))
+
+def bcd_level(data):
+    d = [ ord(c) for c in data[:2] ]
+    return (d[0] >> 4) * 1000 + (d[0] & 0x0F) * 100 + \
+           (d[1] >> 4) * 10 + (d[1] & 0x0F)
+
+# One rig on the bus: its state, and its answers to commands.
+class CivRig(object):
+    def __init__(self, model):
+        self.model = model
+        self.address = CIVAD[model]
+        self.freq = 14070000
+        self.offset = 0             # RIT/duplex offset, Hz
+        self.mode = (0x01, 0x02)    # USB, normal passband
+        self.levels = {}            # 0x14 sub:0-255
+        self.switches = {}          # 0x16 sub:value
+        self.ptt = 0
+        self.vfo = 0
+        self.atten = 0
+        self.power_on = 1
+
+    # Answer to a command (cmd, sub and data): the reply's payload.
+    def command(self, c):
+        cmd, rest = ord(c[0]), c[1:]
+        if cmd == 0x03:                     # read freq
+            return c[0] + freq_bcd(self.freq)
+        if cmd in (0x00, 0x05):             # set freq
+            if len(rest) < 5:
+                return NG
+            self.freq = bcd_freq(rest)
+            return OK
+        if cmd == 0x04:                     # read mode, passband
+            return c[0] + chr(self.mode[0]) + chr(self.mode[1])
+        if cmd in (0x01, 0x06):             # set mode
+            if len(rest) < 1:
+                return NG
+            self.mode = (ord(rest[0]), ord((rest + '\x02')[1]))
+            return OK
+        if cmd == 0x07:                     # VFO
+            if rest:
+                self.vfo = ord(rest[0])
+            return OK
+        if cmd == 0x0C:                     # read offset
+            f = self.offset / 10
+            if f < 0:
+                f = 10000 + f               # 9's complement
+            s = '%04d' % f
+            return c[0] + chr(int(s[2]) << 4 | int(s[3])) + \
+                chr(int(s[0]) << 4 | int(s[1]))
+        if cmd == 0x0D:                     # set offset
+            if len(rest) < 2:
+                return NG
+            f = (bcd_level(rest[1] + rest[0])) * 10
+            if f >= 90000:
+                f -= 100000
+            self.offset = f
+            return OK
+        if cmd in (0x10, 0x12):             # tuning step, antenna
+            return OK
+        if cmd == 0x11:                     # attenuator
+            if rest:
+                self.atten = ord(rest[0])
+            return OK
+        if cmd == 0x14 and rest:            # levels
+            sub = ord(rest[0])
+            if len(rest) >= 3:
+                self.levels[sub] = min(255, bcd_level(rest[1:3]))
+                return OK
+            return c[:2] + level_bcd(self.levels.get(sub, 128))
+        if cmd == 0x15 and rest:            # meters
+            sub = ord(rest[0])
+            if sub == 0x01:                 # squelch open
+                return c[:2] + '\x01'
+            return c[:2] + level_bcd(self.meter(sub))
+        if cmd == 0x16 and rest:            # switches
+            sub = ord(rest[0])
+            if len(rest) >= 2:
+                self.switches[sub] = ord(rest[1])
+                return OK
+            return c[:2] + chr(self.switches.get(sub, 0))
+        if cmd == 0x18 and rest:            # power
+            self.power_on = ord(rest[0])
+            return OK
+        if cmd == 0x19:                     # ID
+            return c[:2] + chr(self.address)
+        if cmd == 0x1C and rest and ord(rest[0]) == 0x00:   # PTT
+            if len(rest) >= 2:
+                self.ptt = ord(rest[1])
+                return OK
+            return c[:2] + chr(self.ptt)
+        return NG
+
+    # A meter reading that moves a little, like a real one.
+    def meter(self, sub):
+        if sub == 0x02:                     # S meter
+            return random.randint(60, 140)
+        if self.ptt:
+            return random.randint(100, 200)
+        return 0
+
+# The bus, with the rigs of 'model' on it ("R75", or "R75,R8500").
+# 'address' is that of the first.
+class CivEmulator(PtyEmulator):
+    def __init__(self, model='R75', collisions=0., transceive=None,
+                 set_delay=0., **kw):
+        PtyEmulator.__init__(self, **kw)
+        self.model = model
+        self.order = [ CivRig(m) for m in model.split(',') ]
+        self.rigs = dict([ (rig.address, rig) for rig in self.order ])
+        if len(self.rigs) != len(self.order):
+            raise ValueError('two rigs at one CI-V address: %s' % model)
+        self.address = self.order[0].address
+        self.collisions = collisions
+        self.transceive = transceive
+        self.set_delay = set_delay
+        self.next_transceive = time.time() + (transceive or 0.)
+        self.buf = ''
+        self.commands = 0
+        self.collided = 0
+
+    def received(self, data):
+        self.buf += data
+        while True:
+            start = self.buf.find(PREAMBLE)
+            if start < 0:
+                self.buf = self.buf[-1:]
+                return
+            end = self.buf.find(EOM, start)
+            if end < 0:
+                self.buf = self.buf[start:]
+                return
+            frame = self.buf[start:end+1]
+            self.buf = self.buf[end+1:]
+            self.frame(frame)
+
+    def frame(self, frame):
+        self.commands += 1
+        if self.collisions and random.random() < self.collisions:
+            # two talkers: the bus carries garbage, nobody understands it
+            self.collided += 1
+            garbled = frame[:2] + chr(ord(frame[2]) ^ 0x5A) + frame[3:]
+            self.send(garbled)
+            return
+        self.send(frame)                    # echo
+        if len(frame) < 6:
+            return
+        to, sender = ord(frame[2]), ord(frame[3])
+        rig = self.rigs.get(to)
+        if rig == None:
+            return                          # for no rig of ours
+        reply = rig.command(frame[4:-1])
+        if reply == None:
+            return
+        self.think()
+        if reply == OK and self.set_delay:
+            time.sleep(self.set_delay)
+        self.send(PREAMBLE + chr(sender) + chr(rig.address) + reply + EOM)
+
+    def tick(self):
+        if not self.transceive or time.time() < self.next_transceive:
+            return
+        self.next_transceive = time.time() + self.transceive
+        for rig in self.order:
+            rig.freq += TRANSCEIVE_STEP
+            self.send(PREAMBLE + chr(BROADCAST) + chr(rig.address) +
+                      '\x00' + freq_bcd(rig.freq) + EOM)
+
+    def status(self):
+        rigs = ', '.join([ '%s at 0x%02X' % (rig.model, rig.address)
+                           for rig in self.order ])
+        return '%s: %d commands, %d collided, %d bytes in, %d out' % \
+            (rigs, self.commands, self.collided, self.bytes_in,
+             self.bytes_out)
+
+# ------- Ten-Tec Orion ---------
+
+CR = '\r'
+
+# delay: secs to answer a query; min_gap: a command sooner than this
+# after the last answer is lost; dsp_busy: secs the DSP needs after a
+# filter/PBT/memory change; agc_gap: the same as min_gap, for the AGC
+# parameter queries; drop_busy: commands during dsp_busy are lost (else
+# they wait).
+ORION_FIRMWARE = {
+    'v1': { 'version':'Version 1.372', 'delay':0.02, 'min_gap':0.03,
+            'dsp_busy':0.2, 'agc_gap':0.1, 'drop_busy':True },
+    'v2': { 'version':'Version 2.059d', 'delay':0.005, 'min_gap':0.,
+            'dsp_busy':0.05, 'agc_gap':0., 'drop_busy':False },
+    }
+
+# Values set with "*<key><value>" and read with "?<key>", and their
+# values after a reset.  Longest keys are matched first.
+ORION_VALUES = {
+    'AF':'14070000', 'BF':'7050000', 'UM':'128', 'US':'128',
+    'TM':'50', 'TS':'5', 'TP':'100', 'RMX':'0', 'RME':'0',
+    }
+for rx in ('M', 'S'):
+    for key, value in (('M','0'), ('I','10'), ('F','2400'), ('P','0'),
+                       ('A','M'), ('AD','10.0000'), ('AH','0.1000'),
+                       ('AT','1.0000'), ('G','100'), ('R','0'),
+                       ('NB','0'), ('NN','0'), ('NA','0'), ('T','0')):
+        ORION_VALUES['R' + rx + key] = value
+ORION_KEYS = sorted(ORION_VALUES.keys(), key=len, reverse=True)
+
+def orion_dsp(key):         # does a change of 'key' retune the DSP?
+    return len(key) == 3 and key[0] == 'R' and key[2] in 'FP'
+
+def orion_agc(key):         # an AGC parameter (the GAU_WT queries)?
+    return len(key) == 4 and key[0] == 'R' and key[2] == 'A'
+
+class OrionEmulator(PtyEmulator):
+    def __init__(self, firmware='v2', **kw):
+        self.firmware = ORION_FIRMWARE[firmware]
+        kw.setdefault('baud', 57600)
+        kw.setdefault('delay', self.firmware['delay'])
+        PtyEmulator.__init__(self, **kw)
+        self.firmware_name = firmware
+        self.buf = ''
+        self.values = dict(ORION_VALUES)
+        self.ptt = False
+        self.last = 0.              # time of our last answer or command
+        self.busy_until = 0.        # DSP settling until then
+        self.commands = 0
+        self.lost = 0
+
+    def received(self, data):
+        self.buf += data
+        while True:
+            # binary freq sets are 4 raw bytes, which may hold a CR
+            if self.buf[:2] in ('*A', '*B') and self.buf[2:3] != 'F':
+                if len(self.buf) < 7:
+                    return
+                cmd, self.buf = self.buf[:6], self.buf[7:]
+            else:
+                end = self.buf.find(CR)
+                if end < 0:
+                    return
+                cmd, self.buf = self.buf[:end], self.buf[end+1:]
+            if cmd:
+                self.command(cmd)
+
+    def command(self, cmd):
+        self.commands += 1
+        now = time.time()
+        fw = self.firmware
+        gap = fw['min_gap']
+        if cmd[:1] == '?' and orion_agc(cmd[1:]):
+            gap = max(gap, fw['agc_gap'])
+        lost = now - self.last < gap
+        if now < self.busy_until:
+            if fw['drop_busy']:
+                lost = True
+            else:
+                time.sleep(self.busy_until - now)
+        self.last = time.time()
+        if lost:
+            self.lost += 1
+            return
+        if cmd[0] == '*':
+            self.set(cmd[1:])
+        elif cmd[0] == '?':
+            answer = self.query(cmd[1:])
+            self.think()
+            self.send(answer + CR)
+            self.last = time.time()
+        elif cmd == 'XX':
+            self.values = dict(ORION_VALUES)
+            self.think()
+            self.send('ORION START' + CR)
+            self.last = time.time()
+
+    def set(self, c):
+        if c[:1] in ('A', 'B') and c[1:2] != 'F' and len(c) == 5:
+            self.values[c[0] + 'F'] = str(struct.unpack('>I', c[1:5])[0])
+        elif c in ('TK', 'TU'):
+            self.ptt = c == 'TK'
+        elif c[:2] in ('KR', 'KW', 'KV', 'KA', 'UC'):
+            if c[:2] == 'KR':       # memory to VFO: new filter too
+                self.busy_until = time.time() + self.firmware['dsp_busy']
+        else:
+            for key in ORION_KEYS:
+                if c.startswith(key):
+                    self.values[key] = c[len(key):].strip()
+                    if orion_dsp(key):
+                        self.busy_until = time.time() + \
+                            self.firmware['dsp_busy']
+                    break
+
+    def query(self, c):
+        if c in ('A', 'B'):
+            return '@' + c + struct.pack('>I', int(self.values[c + 'F']))
+        if c == 'V':
+            return self.firmware['version']
+        if c == 'S':
+            if self.ptt:
+                return '@STF%03dR%03dS%03d' % (random.randint(80, 100),
+                    random.randint(5, 10), random.randint(256, 300))
+            return '@SRM%03dS%03d' % (random.randint(10, 90),
+                                      random.randint(10, 90))
+        if self.values.has_key(c):
+            return '@' + c + self.values[c]
+        return 'Z!'                 # not a command we know
+
+    def status(self):
+        return 'Orion %s: %d commands, %d lost, %d bytes in, %d out' % \
+            (self.firmware_name, self.commands, self.lost, self.bytes_in,
+             self.bytes_out)
+
+# ------- Yaesu FT-897D CAT ---------
+
+FT897_BAUDS   = (4800, 9600, 38400)
+FT897_RESYNC  = 0.1         # secs an incomplete command is kept
+FT897_EEPROM  = 0x1A00      # bytes of EEPROM
+FT897_VFO_ADDR = 0x55       # EEPROM byte whose bit 0 is VFO A/B
+ACK_897       = '\x00'
+REFUSED_897   = '\xF0'
+
+# Secs the rig takes to answer, by kind of command.
+FT897_LATENCY = { 'read':0.002, 'status':0.001, 'eeprom':0.004,
+                  'set':0.003, 'freq':0.02 }
+
+FT897_READS = {             # opcode: kind
+    0x03:'read', 0xE7:'status', 0xF7:'status', 0xBD:'status',
+    0xBB:'eeprom',
+    }
+
+FT897_MODES = (0x00, 0x01, 0x02, 0x03, 0x04, 0x06, 0x08, 0x0A, 0x0C,
+               0x82, 0x88)  # LSB USB CW CWR AM WFM FM DIG PKT CWN FMN
+
+# 8 digits of 10 Hz <-> 4 BCD bytes, most significant first.
+def freq_bcd4(f):
+    s = '%08d' % (int(f) / 10)
+    return ''.join([ chr(int(s[i]) << 4 | int(s[i+1]))
+                     for i in (0, 2, 4, 6) ])
+
+def bcd4_freq(data):
+    f = 0
+    for c in data[:4]:
+        f = f * 100 + (ord(c) >> 4) * 10 + (ord(c) & 0x0F)
+    return f * 10
+
+class Ft897Emulator(PtyEmulator):
+    def __init__(self, eeprom=None, **kw):
+        kw.setdefault('baud', 4800)
+        kw['bits'] = 11             # 8N2
+        if kw['baud'] and kw['baud'] not in FT897_BAUDS:
+            raise ValueError('the FT-897D talks CAT at 4800, 9600 or '
+                             '38400 baud')
+        PtyEmulator.__init__(self, **kw)
+        self.buf = ''
+        self.buf_time = 0.
+        self.eeprom = array.array('B', [0] * FT897_EEPROM)
+        if eeprom != None:
+            f = open(eeprom, 'rb')
+            data = f.read(FT897_EEPROM)
+            f.close()
+            self.eeprom[:len(data)] = array.array('B', data)
+        self.vfos = [ [14070000, 0x01], [7050000, 0x00] ]   # A, B
+        self.vfo = self.eeprom[FT897_VFO_ADDR] & 1
+        self.ptt = False
+        self.split = False
+        self.high_swr = False
+        self.clar = False
+        self.clar_offset = 0
+        self.lock = False
+        self.power_on = True
+        self.tone_mode = 0x8A       # off
+        self.tone = 0x0885          # 88.5 Hz, BCD
+        self.dcs = 0x0023
+        self.rpt_dir = 0x89         # simplex
+        self.rpt_offset = 600000
+        self.s_meter = 5            # 0-15, moves a little
+        self.squelch = 2            # S meter below this: squelched
+        self.commands = 0
+        self.ignored = 0
+
+    def received(self, data):
+        now = time.time()
+        if self.buf and now - self.buf_time > FT897_RESYNC:
+            self.ignored += 1
+            self.buf = ''
+        if not self.buf:
+            self.buf_time = now
+        self.buf += data
+        while len(self.buf) >= 5:
+            cmd, self.buf = self.buf[:5], self.buf[5:]
+            # the pty delivers at once; the rig has the command only
+            # when its last byte is in
+            left = self.buf_time + 5 * self.byte_time - time.time()
+            if left > 0:
+                time.sleep(left)
+            self.buf_time = time.time()
+            self.command(cmd)
+
+    def command(self, cmd):
+        self.commands += 1
+        p, op = [ ord(c) for c in cmd[:4] ], ord(cmd[4])
+        kind = FT897_READS.get(op, 'set')
+        if not self.power_on and kind != 'set':
+            reply = None
+        elif kind == 'set':
+            reply = self.set(op, p, cmd[:4])
+        else:
+            reply = self.read(op, p)
+        if reply == None:
+            self.ignored += 1
+            return
+        if op == 0x01 and reply == ACK_897:
+            kind = 'freq'
+        time.sleep(FT897_LATENCY[kind])
+        self.think()
+        self.send(reply)
+
+    def read(self, op, p):
+        freq, mode = self.vfos[self.vfo]
+        if op == 0x03:
+            return freq_bcd4(freq) + chr(mode)
+        if op == 0xE7:
+            s = self.meter()
+            return chr((s < self.squelch) << 7 |
+                       (self.tone_mode != 0x8A) << 6 |
+                       (mode not in (0x08, 0x88)) << 5 | s)
+        if op == 0xF7:
+            if not self.ptt:
+                return '\xFF'
+            return chr(self.high_swr << 6 | (not self.split) << 5 |
+                       random.randint(8, 12))
+        if op == 0xBD:
+            if not self.ptt:
+                return '\x00\x00'
+            return chr(random.randint(8, 12) << 4 | random.randint(0, 3)) + \
+                   chr(random.randint(1, 3) << 4 | random.randint(4, 9))
+        if op == 0xBB:
+            addr = (p[0] << 8 | p[1]) % FT897_EEPROM
+            return chr(self.eeprom[addr]) + \
+                   chr(self.eeprom[(addr + 1) % FT897_EEPROM])
+        return None
+
+    # A set: the ack, or None for an opcode the rig does not know.
+    def set(self, op, p, data):
+        if not self.power_on and op != 0x0F:
+            return None                     # off: only power on works
+        if op in (0x00, 0x80):              # lock on/off
+            refused = self.lock == (op == 0x00)
+            self.lock = op == 0x00
+        elif op in (0x08, 0x88):            # PTT on/off
+            refused = self.ptt == (op == 0x08)
+            self.ptt = op == 0x08
+        elif op == 0x01:                    # freq
+            self.vfos[self.vfo][0] = bcd4_freq(data)
+            refused = False
+        elif op == 0x07:                    # mode
+            refused = p[0] not in FT897_MODES
+            if not refused:
+                self.vfos[self.vfo][1] = p[0]
+        elif op in (0x02, 0x82):            # split on/off
+            refused = self.split == (op == 0x02)
+            self.split = op == 0x02
+        elif op in (0x05, 0x85):            # clarifier on/off
+            refused = self.clar == (op == 0x05)
+            self.clar = op == 0x05
+        elif op == 0xF5:                    # clarifier offset
+            self.clar_offset = bcd4_freq('\x00\x00' + data[2:4])
+            if p[0]:
+                self.clar_offset = -self.clar_offset
+            refused = False
+        elif op == 0x81:                    # VFO A/B toggle
+            refused = self.ptt
+            if not refused:
+                self.vfo ^= 1
+                self.eeprom[FT897_VFO_ADDR] = \
+                    self.eeprom[FT897_VFO_ADDR] & 0xFE | self.vfo
+        elif op == 0x0A:                    # CTCSS/DCS mode
+            refused = p[0] not in (0x0A, 0x0B, 0x0C, 0x2A, 0x3A, 0x4A,
+                                   0x8A)
+            if not refused:
+                self.tone_mode = p[0]
+        elif op == 0x0B:                    # CTCSS tone
+            self.tone = p[0] << 8 | p[1]
+            refused = False
+        elif op == 0x0C:                    # DCS code
+            self.dcs = p[0] << 8 | p[1]
+            refused = False
+        elif op == 0x09:                    # repeater shift
+            refused = p[0] not in (0x09, 0x49, 0x89)
+            if not refused:
+                self.rpt_dir = p[0]
+        elif op == 0xF9:                    # repeater offset
+            self.rpt_offset = bcd4_freq(data)
+            refused = False
+        elif op in (0x0F, 0x8F):            # power on/off
+            self.power_on = op == 0x0F
+            refused = False
+        elif op == 0xBC:                    # EEPROM write, 2 bytes
+            addr = (p[0] << 8 | p[1]) % FT897_EEPROM
+            self.eeprom[addr] = p[2]
+            self.eeprom[(addr + 1) % FT897_EEPROM] = p[3]
+            self.vfo = self.eeprom[FT897_VFO_ADDR] & 1
+            refused = False
+        else:
+            return None
+        if refused:
+            return REFUSED_897
+        return ACK_897
+
+    # The S meter, wandering a little between reads.
+    def meter(self):
+        self.s_meter = max(0, min(15, self.s_meter + random.randint(-1, 1)))
+        return self.s_meter
+
+    def status(self):
+        return 'FT-897D: %d commands, %d ignored, %d bytes in, %d out' % \
+            (self.commands, self.ignored, self.bytes_in, self.bytes_out)
+
+# ------- A plain client, for tests and benchmarks ---------
+
+class PtyClient(object):
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+    # Read up to and including 'end', or 'size' bytes; '' on timeout.
+    def read(self, end=None, size=None, timeout=0.2):
+        data = ''
+        deadline = time.time() + timeout
+        while True:
+            if end != None and data.endswith(end):
+                return data
+            if size != None and len(data) >= size:
+                return data
+            left = deadline - time.time()
+            if left <= 0:
+                return ''
+            r, w, e = select.select([self.fd], [], [], left)
+            if r:
+                data += os.read(self.fd, 1)
+
+    def close(self):
+        os.close(self.fd)
+
+# The calls of pyserial's Serial that ic_codes makes, on a pty, with the
+# read() and write() system calls counted: to time the CI-V codec on
+# its own, with or without pyserial.
+class PtySerial(PtyClient):
+    def __init__(self, path, timeout=0.2):
+        PtyClient.__init__(self, path)
+        self.timeout = timeout
+        self.syscalls = 0
+
+    def write(self, data):
+        self.syscalls += 1
+        os.write(self.fd, data)
+
+    def read(self, size=1):
+        data = ''
+        deadline = time.time() + self.timeout
+        while len(data) < size:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            r, w, e = select.select([self.fd], [], [], left)
+            if r:
+                self.syscalls += 1
+                data += os.read(self.fd, size - len(data))
+        return data
+
+    def inWaiting(self):
+        n = fcntl.ioctl(self.fd, termios.FIONREAD, '\0\0\0\0')
+        return struct.unpack('i', n)[0]
+
+    def flushInput(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def flushOutput(self):
+        termios.tcflush(self.fd, termios.TCOFLUSH)
+
+EMULATORS = { 'icom': CivEmulator, 'orion': OrionEmulator,
+              'ft897': Ft897Emulator }
+
+# "--name=value" arguments -> keyword arguments of the emulator.
+OPTIONS = { 'baud':int, 'delay':float, 'jitter':float, 'link':str,
+            'latency':float,
+            'model':str, 'collisions':float, 'transceive':float,
+            'set_delay':float,
+            'firmware':str, 'eeprom':str }
+
+def parse_options(args):
+    kw = {}
+    for arg in args:
+        if not arg.startswith('--') or arg.find('=') < 0:
+            raise ValueError('bad option: %s' % arg)
+        name, value = arg[2:].split('=', 1)
+        if not OPTIONS.has_key(name):
+            raise ValueError('unknown option: %s' % arg)
+        kw[name] = OPTIONS[name](value)
+    return kw
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not EMULATORS.has_key(sys.argv[1]):
+        print 'usage: %s %s [--name=value ...]' % \
+            (sys.argv[0], '|'.join(sorted(EMULATORS.keys())))
+        sys.exit(1)
+    try:
+        emu = EMULATORS[sys.argv[1]](**parse_options(sys.argv[2:]))
+    except (ValueError, KeyError, TypeError, IOError), e:
+        print 'bad option:', e
+        sys.exit(1)
+    print '%s emulator on %s' % (sys.argv[1], emu.link or emu.path)
+    try:
+        emu.run()
+    except KeyboardInterrupt:
+        print emu.status()
+        emu.stop()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# File: rigframe.py
+# Version: 1.0
+#
+# mrigd: length-prefixed binary framing for the rigserve protocol
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# rigserve talks text by default: one command per line, one reply per
+# command, in order.  A client that sends "frame binary" (and gets "OK")
+# switches its connection to frames, both ways:
+#
+#   +-----------+------------+--------+------------------+
+#   | length    | request id | status | payload          |
+#   | 4 bytes   | 4 bytes    | 1 byte | 'length' bytes   |
+#   +-----------+------------+--------+------------------+
+#
+# All numbers are unsigned, network byte order.  A request carries the
+# command text (status 0).  Its reply carries the same request id and
+# the reply text; for an error the status is ST_NAK and the "? " is not
+# repeated in the payload.  Replies are sent as soon as they are ready,
+# so they may come in any order: match them by request id.  Watch values
+# are pushed with request id 0 and ST_PUSH, payload "rig.trv.method value".
+# A framed "frame text" goes back to text mode after its reply.
+
+import struct
+from globals import *
+
+HEADER = struct.Struct('!IIB')      # payload length, request id, status
+MAX_REQUEST = 65536                 # longest request payload accepted
+
+ST_OK   = 0
+ST_NAK  = 1
+ST_PUSH = 2
+
+FRAME_ON  = 'frame binary'
+FRAME_OFF = 'frame text'
+
+def encode(req_id, status, payload):
+    return HEADER.pack(len(payload), req_id, status) + payload
+
+# The reply frame for a rigserve result.
+def encode_reply(req_id, result):
+    result = str(result)
+    if result.startswith(NAK1):
+        return encode(req_id, ST_NAK, result[len(NAK):])
+    return encode(req_id, ST_OK, result)
+
+# Take the first whole frame off a buffer: ((req_id, status, payload),
+# rest), or (None, buf) if it is not all there yet.
+def split_frame(buf):
+    if len(buf) < HEADER.size:
+        return None, buf
+    length, req_id, status = HEADER.unpack(buf[:HEADER.size])
+    end = HEADER.size + length
+    if len(buf) < end:
+        return None, buf
+    return (req_id, status, buf[HEADER.size:end]), buf[end:]
+
+# Split a buffer into whole frames: ([(req_id, status, payload)], rest)
+def decode(buf):
+    frames = []
+    while True:
+        frame, buf = split_frame(buf)
+        if frame == None:
+            return frames, buf
+        frames.append(frame)
+
+# Length of the payload the buffer is announcing, or 0 if not known yet.
+def pending_length(buf):
+    if len(buf) < HEADER.size:
+        return 0
+    return HEADER.unpack(buf[:HEADER.size])[0]
+
+# ------- Blocking client side ---------
+
+class FramedClient(object):
+    # 'sock' is a connected rigserve socket; the welcome line is read and
+    # the connection switched to frames here.
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.next_id = 1
+        self.replies = {}       # req_id:(status, payload) read ahead
+        self.pushes = []        # (status, payload) of pushed values
+        self.read_line()        # "Welcome to Rigserve!"
+        self.sock.sendall(FRAME_ON + '\n')
+        reply = self.read_line()
+        if reply != ACK:
+            raise IOError('rigserve refused framing: %s' % reply)
+
+    def read_line(self):
+        while self.buf.find('\n') < 0:
+            self.fill()
+        p = self.buf.find('\n')
+        line = self.buf[:p]
+        self.buf = self.buf[p+1:]
+        return line.strip()
+
+    def fill(self):
+        data = self.sock.recv(8192)
+        if data == '':
+            raise EOFError('rigserve closed the connection')
+        self.buf += data
+
+    # Send a command without waiting; returns its request id.
+    def send(self, cmd):
+        req_id = self.next_id
+        self.next_id = (self.next_id % 0xFFFFFFFF) + 1
+        self.sock.sendall(encode(req_id, ST_OK, cmd))
+        return req_id
+
+    # Move the whole frames read so far to 'replies' (or 'pushes').
+    def take(self):
+        frames, self.buf = decode(self.buf)
+        for rid, status, payload in frames:
+            if status == ST_PUSH:
+                self.pushes.append((status, payload))
+            else:
+                self.replies[rid] = (status, payload)
+
+    # Wait for the reply to 'req_id': returns (status, payload).
+    def wait(self, req_id):
+        while not self.replies.has_key(req_id):
+            self.take()
+            if not self.replies.has_key(req_id):
+                self.fill()
+        return self.replies.pop(req_id)
+
+    # Send a command and wait for its reply, in text form (NAKs with "? ").
+    def command(self, cmd):
+        status, payload = self.wait(self.send(cmd))
+        if status == ST_NAK:
+            return NAK + payload
+        return payload
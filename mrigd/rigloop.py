@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#
+# File: rigloop.py
+# Version: 1.0
+#
+# mrigd: event loop for the rigserve network server
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# A small single-threaded event loop (Python 2 has no asyncio).
+#
+# Every connection keeps its own input and output buffers.  Input is
+# split into commands on newlines, so several pipelined commands in one
+# TCP segment are seen separately, and output is written without
+# blocking, so one slow client never stalls the others.
+#
+# Old clients sometimes send a command without the terminating newline
+# and wait for the reply.  If an unterminated command has been sitting
+# in the buffer for LINE_TIMEOUT seconds, it is taken as complete.
+#
+# A connection may be switched to length-prefixed frames (see rigframe.py)
+# at any point; the input after the switch is split into frames instead.
+
+import socket, select, errno, time, heapq, os, fcntl, threading
+import rigframe
+
+LINE_TIMEOUT = 0.05     # secs before an unterminated line is accepted
+RECV_SIZE    = 8192
+MAX_LINE     = 65536    # longest command we are willing to buffer
+
+class Loop(object):
+    def __init__(self):
+        self.handlers = {}      # fileno:handler
+        self.timers   = []      # heap of [when, seq, fn, args]
+        self.seq      = 0
+        self.running  = False
+        self.waker    = Waker(self)
+
+    def add(self, handler):
+        self.handlers[handler.fileno()] = handler
+
+    def remove(self, handler):
+        for fd in self.handlers.keys():
+            if self.handlers[fd] is handler:
+                del self.handlers[fd]
+
+    # Run fn(*args) after 'delay' seconds.  Returns a handle that can be
+    # given to cancel().
+    def call_later(self, delay, fn, *args):
+        self.seq += 1
+        timer = [time.time() + delay, self.seq, fn, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    # Run fn(*args) in the loop thread.  May be called from any thread.
+    def call_soon_threadsafe(self, fn, *args):
+        self.waker.post(fn, args)
+
+    def cancel(self, timer):
+        if timer:
+            timer[2] = None     # dropped when it comes due
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, fn, args = heapq.heappop(self.timers)
+            if fn:
+                fn(*args)
+
+    def timeout(self):
+        if not self.timers:
+            return 40.0
+        return max(0.0, self.timers[0][0] - time.time())
+
+    def run_once(self):
+        rlist = self.handlers.keys()
+        wlist = [ fd for fd in rlist if self.handlers[fd].wants_write() ]
+        try:
+            r, w, e = select.select(rlist, wlist, [], self.timeout())
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                return
+            raise
+        for fd in w:
+            if fd in self.handlers:
+                self.handlers[fd].handle_write()
+        for fd in r:
+            if fd in self.handlers:
+                self.handlers[fd].handle_read()
+        self.run_timers()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+    def close_all(self):
+        for handler in self.handlers.values():
+            handler.close()
+
+# Wakes the loop up from other threads (e.g. rig workers) through a
+# pipe, and runs the calls they posted.
+
+class Waker(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.calls = []
+        loop.add(self)
+
+    def fileno(self):
+        return self.rfd
+
+    def wants_write(self):
+        return False
+
+    def handle_write(self):
+        pass
+
+    def post(self, fn, args):
+        self.lock.acquire()
+        self.calls.append((fn, args))
+        wake = len(self.calls) == 1
+        self.lock.release()
+        if wake:
+            try:
+                os.write(self.wfd, 'x')
+            except OSError:
+                pass            # pipe full: the loop is awake anyway
+
+    def handle_read(self):
+        try:
+            os.read(self.rfd, 4096)
+        except OSError:
+            pass
+        self.lock.acquire()
+        calls, self.calls = self.calls, []
+        self.lock.release()
+        for fn, args in calls:
+            fn(*args)
+
+    def close(self):
+        pass                    # lives as long as the loop
+
+# Accepts connections on a listening socket.  'factory(loop, sock, addr)'
+# builds the connection handler.
+
+class Listener(object):
+    def __init__(self, loop, sock, factory):
+        self.loop = loop
+        self.sock = sock
+        self.factory = factory
+        self.sock.setblocking(0)
+        loop.add(self)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_write(self):
+        return False
+
+    def handle_write(self):
+        pass
+
+    def handle_read(self):
+        try:
+            new_socket, addr = self.sock.accept()
+        except socket.error:
+            return
+        new_socket.setblocking(0)
+        if new_socket.family == socket.AF_INET:
+            new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.factory(self.loop, new_socket, addr)
+
+    def close(self):
+        self.loop.remove(self)
+        self.sock.close()
+
+# A newline-framed connection.  Subclasses override line_received() and
+# may call write() at any time.  After set_framed(True), the input comes
+# to frame_received() instead.
+
+class LineConnection(object):
+    def __init__(self, loop, sock, addr):
+        self.loop = loop
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = ''
+        self.outbuf = ''
+        self.closing = False    # close once the output is flushed
+        self.closed = False
+        self.line_timer = None
+        self.framed = False
+        self.fd = sock.fileno()
+        loop.add(self)
+
+    def fileno(self):
+        return self.fd
+
+    def wants_write(self):
+        return len(self.outbuf) > 0
+
+    def write(self, data):
+        if self.closed:
+            return
+        self.outbuf += data
+        self.handle_write()         # try at once, the loop finishes it
+
+    def handle_write(self):
+        try:
+            while self.outbuf:
+                n = self.sock.send(self.outbuf)
+                self.outbuf = self.outbuf[n:]
+        except socket.error, err:
+            if err[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.close()
+                return
+        if self.closing and not self.outbuf:
+            self.close()
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if data == '':
+            self.close()
+            return
+        self.inbuf += data
+        self.process_input()
+
+    def process_input(self):
+        self.loop.cancel(self.line_timer)
+        self.line_timer = None
+        if self.framed:
+            self.process_frames()
+            return
+        while not self.closed and not self.closing and not self.framed:
+            p = self.inbuf.find('\n')
+            if p < 0:
+                break
+            line = self.inbuf[:p]
+            self.inbuf = self.inbuf[p+1:]
+            self.line_received(line)
+        if self.framed:
+            self.process_frames()   # switched by the last line
+        elif self.inbuf and not self.closed:
+            if len(self.inbuf) > MAX_LINE:
+                self.close()
+            else:
+                self.line_timer = self.loop.call_later(LINE_TIMEOUT,
+                                                       self.flush_line)
+
+    def process_frames(self):
+        while self.framed and not self.closed and not self.closing:
+            if rigframe.pending_length(self.inbuf) > rigframe.MAX_REQUEST:
+                self.close()
+                return
+            frame, self.inbuf = rigframe.split_frame(self.inbuf)
+            if frame == None:
+                return
+            self.frame_received(frame[0], frame[2])
+        if not self.framed and self.inbuf:
+            self.process_input()    # back to text: the rest is lines
+
+    # Switch the input to frames (True) or lines (False).  Takes effect
+    # at the next command, even if it is already in the buffer.
+    def set_framed(self, on):
+        self.framed = on
+
+    def flush_line(self):       # unterminated line timed out: accept it
+        self.line_timer = None
+        if self.inbuf and not self.closed and not self.framed:
+            line = self.inbuf
+            self.inbuf = ''
+            self.line_received(line)
+
+    def line_received(self, line):
+        pass
+
+    def frame_received(self, req_id, payload):
+        pass
+
+    def close_when_done(self):
+        self.closing = True
+        if not self.outbuf:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.cancel(self.line_timer)
+        self.loop.remove(self)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.connection_lost()
+
+    def connection_lost(self):
+        pass
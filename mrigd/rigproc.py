@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# File: rigproc.py
+# Version: 1.0
+#
+# mrigd: running a rig backend in a process of its own
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# "open rig1 IC_r75 process" runs rig1's backend in a child process
+# instead of inside rigserve.  rigserve keeps routing, the cache, the
+# watches and the rig's worker thread; the worker sends each backend
+# call down a pipe and waits for the result:
+#
+#   parent -> child:  (method, tp, args)      None: exit
+#   child -> parent:  result
+#
+# So rigs with busy backends use a core each instead of sharing one
+# interpreter, and a backend that crashes takes only its own rig with
+# it: its calls are answered with a NAK until the rig is opened again.
+# So is a call the child does not answer within CALL_TIMEOUT: the child
+# is taken for hung and killed (a late answer would be taken for the
+# next call's).
+#
+# The child is forked from rigserve, which by then runs threads (the
+# network thread, the rigs' workers).  Only the forking thread goes on
+# in the child; what the others were doing there is lost, and a lock
+# one of them held stays held for good.  The child does not use
+# rigserve's objects (it closes their files, see close_inherited()),
+# and Python holds its import lock across the fork, so importing the
+# backend is safe; the module locks a backend may take (statistics,
+# link learning, CI-V ports, traces) are made anew in the child.
+
+import os, sys, multiprocessing, threading, traceback
+from globals import *
+
+CALL_TIMEOUT = 30.      # secs for the child to answer a backend call
+
+# module: its locks a backend may take (see renew_locks())
+MODULE_LOCKS = { 'rigstats': ('lock',), 'linkctl': ('lock',),
+                 'civbus': ('ports_lock',), 'rigtrace': ('lock',) }
+
+class RigProcess(object):
+    def __init__(self, rig_name, module, rig_type):
+        self.rig_name = rig_name
+        self.lock = threading.Lock()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve,
+            name='rig-%s' % rig_name,
+            args=(child_conn, self.conn, rig_name, module, rig_type))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.dead = False
+
+    # Run backend.method(tp, *args) in the child and return the result.
+    def call(self, method, tp, *args):
+        self.lock.acquire()
+        try:
+            if self.dead:
+                return NAK + 'rig process of %s has died.' % self.rig_name
+            try:
+                self.conn.send((method, tp, args))
+                if self.conn.poll(CALL_TIMEOUT):
+                    return self.conn.recv()
+            except (EOFError, IOError, OSError):
+                self.dead = True
+                return NAK + 'rig process of %s has died.' % self.rig_name
+            self.dead = True
+            self.process.terminate()
+            return NAK + 'rig process of %s does not answer.' % self.rig_name
+        finally:
+            self.lock.release()
+
+    # Let the child finish, or kill it if it does not.
+    def stop(self):
+        self.lock.acquire()
+        try:
+            if not self.dead:
+                try:
+                    self.conn.send(None)
+                except (IOError, OSError):
+                    pass
+            self.dead = True
+            self.conn.close()
+        finally:
+            self.lock.release()
+        self.process.join(2.)
+        if self.process.is_alive():
+            self.process.terminate()
+        return ACK
+
+    def status(self):
+        if self.dead or not self.process.is_alive():
+            return 'process %d (died)' % self.process.pid
+        return 'process %d' % self.process.pid
+
+# A backend method as seen from rigserve: its dispatch table entry
+# points here instead of at the bound method of a local backend.
+class RemoteMethod(object):
+    def __init__(self, proc, name):
+        self.proc = proc
+        self.__name__ = name
+
+    def __call__(self, tp, *args):
+        return self.proc.call(self.__name__, tp, *args)
+
+# ------- Child side ---------
+
+def serve(conn, parent_conn, rig_name, module, rig_type):
+    parent_conn.close()
+    close_inherited(conn.fileno())
+    renew_locks()
+    backend = getattr(__import__(module), rig_type)(rig_name)
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, IOError):
+            break                       # rigserve is gone
+        if request == None:
+            break
+        method, tp, args = request
+        try:
+            result = getattr(backend, method)(tp, *args)
+        except Exception, e:
+            traceback.print_exc()
+            result = NAK + 'Internal error in rig %s: %s' % (rig_name, e)
+        conn.send(result)
+
+# Drop rigserve's sockets and the other rigs' pipes, so that they close
+# when rigserve does, not when the last rig process exits.
+def close_inherited(keep):
+    try:
+        fds = [ int(fd) for fd in os.listdir('/proc/self/fd') ]
+    except OSError:
+        fds = range(3, 256)
+    for fd in fds:
+        if fd > 2 and fd != keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+# Locks held by other rigserve threads when the child was forked would
+# never be released in it: give the child its own.
+def renew_locks():
+    for name, attrs in MODULE_LOCKS.items():
+        module = sys.modules.get(name)
+        if module != None:
+            for attr in attrs:
+                setattr(module, attr, threading.Lock())
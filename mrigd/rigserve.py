@@ -25,8 +25,10 @@
 # Wood Road, Branford CT 06405, USA.
 
 
-import sys, socket, time, os
-import select
+import sys, socket, time, os, collections
+import rigloop, rigframe, rigworker, rigcache, rigwatch, rigstats, rigconn
+import rigproc, rigstate, rigtrace
+import threading
 
 # v 0.1 initial release, 11/16/2006
 # v 0.2 changes
@@ -47,6 +49,8 @@ IDENT='rigserve-mrigd 1.0: 04/2008 AA6E, 02/2016 EA4GJA'
 from globals import *
 
 from service import *
+from service_metrics import *
+from backend import Backend
 
 # 'globals' includes SUPPORTED_RIGS structure and other common info.
 
@@ -59,10 +63,40 @@ nameSp      = {}    # identifier:module namespace
 backEnd     = {}    # identifier:backend object
 openDrivers = []    # handles of opened rigs
 openRigType = {}    # names of instantiated backend subclasses
+dispatch    = {}    # (identifier, method):(bound method, supported ops)
+workers     = {}    # identifier:RigWorker running the rig's backend calls
+processes   = {}    # identifier:RigProcess, for rigs opened as 'process'
+caches      = {}    # identifier:RigCache of recent get replies
+inited      = {}    # identifier:True, once a put of its init was ACKed
+watches     = {}    # 'rig_id.trv.method':Watch, for the watch command
+queued_puts = {}    # (rig_id, trv, method):queued put (see queue_put())
+
+# Rig calls run in the rig's own worker thread (see rigworker.py).  With
+# USE_WORKERS off they run in the caller's thread, as in older versions.
+# result_post(done, result) hands finished results back to the network
+# loop; if it is None, 'done' is called in the worker thread.
+USE_WORKERS = True
+result_post = None
+
+# Rigs run their backend inside rigserve ('thread'), or each one in a
+# child process ('process', see rigproc.py).  'open' may choose either;
+# this is the default.
+RIG_PROCESSES = False
+
+# A put queued for a rig, and not started yet, is replaced by a newer put
+# to the same rig, trv and method: only the latest value reaches the rig,
+# and all the absorbed puts get its reply (and its trace, if they are
+# traced).  PTT and init are never coalesced.  The newer put runs in the
+# older one's place, so it is not absorbed if its connection has queued
+# anything for the rig since (say a get, that would see the new value).
+COALESCE_PUTS = True
+NO_COALESCE   = ('transmit', 'init')
+coalesce_lock = threading.Lock()
 
 # Services dictionary
 
-services_dict = {"dummy": Service("rigserve")}
+services_dict = {"dummy": Service("rigserve"),
+                 "metrics": Service_Metrics("rigserve")}
 
 # Who can connect to us:  If null (''), allow anyone. Use 'localhost'
 # to allow only connections from the same machine.
@@ -73,14 +107,20 @@ services_dict = {"dummy": Service("rigserve")}
 #       instead.
 ALLOWED_IP = '127.0.0.1'     # Allow connect from anyone (subject to firewalls)
 PORT    =14652      # Pick a memorable port number to listen on.
+UNIX_PATH = None    # Also listen on this Unix socket (--unix=PATH), for
+                    # local clients: cheaper than loopback TCP.
+STATE_PATH = None   # The state table (see rigstate.py) in this file
+                    # (--state=PATH), else in anonymous shared memory.
 # ** End of Globals **     
 
 # The "do_" routines are carrying out high-level commands coming in
 # on the socket interface.
 
-# input: "rig_id backend_id"
+# input: "rig_id backend_id [thread|process]"
 # The rig_id is an arbitrary name specified by the user and used as
-# the key in the nameSp and backEnd dictionaries.
+# the key in the nameSp and backEnd dictionaries.  With 'process' the
+# backend runs in a child process (see rigproc.py); the local backend
+# object is then only used for its services and capabilities.
 # Check if backend_id 'x' is in the list of supported rigs.  If so, import
 # its module (as named in SUPPORTED_RIGS[x][0]) as namespace nameSp[rig_id].
 # Then, execute/evaluate the class instantiation.
@@ -88,24 +128,36 @@ PORT    =14652      # Pick a memorable port number to listen on.
 
 def do_open(s):
     global nameSp, backEnd, openDrivers, openRigType
-    split = s.split(None,1)
-    if len(split) != 2:
+    split = s.split()
+    if len(split) < 2 or len(split) > 3:
         return NAK + "open needs two args."
     h = split[0]
     rig_type = split[1]
+    in_process = RIG_PROCESSES
+    if len(split) == 3:
+        if not split[2] in ('thread', 'process'):
+            return NAK + "open: 'thread' or 'process', not '%s'." % split[2]
+        in_process = split[2] == 'process'
     # Do we know about the rig type?
     if not SUPPORTED_RIGS.has_key(rig_type):
         return NAK+"Rig type not found: %s" % rig_type
+    if h in openDrivers:
+        do_close(h)                     # re-opened: old calls finish first
     # Import the module using function call, module namespace goes
     # into nameSp
     nameSp[h] = __import__(SUPPORTED_RIGS[rig_type][0])
-    # Construct a python function name to be eval'd.  This will be
-    # the backend class name, e.g. '<namespace>.TT_orion()'. There may
-    # be a way to do this without the eval??
-    cmd = "nameSp[h].%s(h)" % rig_type
-    backEnd[h] = eval( cmd )            # Creates the backend object
+    # The backend class has the same name as the rig type, e.g.
+    # '<namespace>.TT_orion'.
+    backEnd[h] = getattr(nameSp[h], rig_type)(h)   # Creates the backend object
     openDrivers += [ h ]                # keep track of opened rig IDs
     openRigType[h] = rig_type           # .. and backend names
+    if in_process:
+        processes[h] = rigproc.RigProcess(h, SUPPORTED_RIGS[rig_type][0],
+                                          rig_type)
+    build_dispatch(h)
+    if USE_WORKERS:
+        workers[h] = rigworker.RigWorker(h, result_post)
+    caches[h] = rigcache.RigCache()
     print '(Opening rig_type = %s)' % rig_type
     return SUPPORTED_RIGS[rig_type][1]  # return the text rig description
 
@@ -117,6 +169,15 @@ def do_close(s):
     fields = s.split(None,1)    # check number of fields, returns list
     h = fields[0]
     if h in openDrivers:
+        drop_watches(h)
+        stop_worker(h)              # queued calls run first
+        drop_dispatch(h)
+        if hasattr(backEnd[h], 'close'):
+            backEnd[h].close()      # e.g. leave a shared CI-V bus
+        del caches[h]
+        inited.pop(h, None)
+        if rigstate.table:
+            rigstate.table.drop(h)
         del backEnd[h]              # delete backend for garbage coll. ?
         del nameSp[h]               # delete module namespace
         del openRigType[h]          # delete rig's backend name
@@ -125,33 +186,142 @@ def do_close(s):
     else:
         return NAK + "not open."
 
-def make_cmd(sense, s):   # Parse sub-command & create backend fn call
-    if not sense in ['put', 'get', 'test']:     # allowed options
-        return NAK+"make call -- bad sense: %s" % sense
+# Stop the rig's worker, and its process, and wait until the worker's
+# queued calls have run, so the rig can be torn down under them.  (Not
+# when the worker itself closes the rig, from a batch: it cannot wait
+# for itself.)
+def stop_worker(h):
+    proc = processes.pop(h, None)
+    worker = workers.pop(h, None)
+    if worker != None:
+        if proc != None:
+            worker.submit(proc.stop, (), None, rigworker.P_POLL)
+        worker.stop()
+        if threading.currentThread() is not worker:
+            worker.join()
+    elif proc != None:
+        proc.stop()
+
+# The dispatch table is built once per rig, when it is opened.  It maps
+# (rig_id, method) to the bound backend method and the set of operations
+# (T_GET/T_PUT/T_TEST) the rig really supports, so a get/put/test costs
+# one dictionary lookup and one call.
+#
+# A method that is only the skeleton in Backend is not implemented for
+# the rig (it would return None) and supports nothing.  A rig with a
+# capabilities dictionary (Icom family) supports what it lists: 'r' ->
+# get and 'w' -> put, and nothing for a method it does not list (the
+# family defines it, this model lacks it).  For a rig without one, any
+# other method is assumed to support all three.
+# For a rig in a process of its own the entry is a rigproc.RemoteMethod.
+
+def build_dispatch(h):
+    global dispatch
+    drop_dispatch(h)
+    be = backEnd[h]
+    for fn_name in dir(be):
+        if fn_name.startswith('_'):
+            continue
+        fn = getattr(be, fn_name)
+        if not callable(fn) or not hasattr(fn, 'im_func'):
+            continue
+        code = fn.im_func.func_code
+        if code.co_argcount < 3:    # (self, tp, trv, ...) or not a rig method
+            continue
+        skel = getattr(Backend, fn_name, None)
+        if fn_name != 'info' and skel is not None and \
+                skel.im_func is fn.im_func:
+            support = ()
+        elif be.capabilities:
+            rw = be.capabilities.get(fn_name)
+            support = ()
+            if rw != None:
+                support = (T_TEST,)
+                if 'r' in rw: support += (T_GET,)
+                if 'w' in rw: support += (T_PUT,)
+        else:
+            support = (T_TEST, T_GET, T_PUT)
+        if processes.has_key(h):
+            fn = rigproc.RemoteMethod(processes[h], fn_name)
+        dispatch[(h, fn_name)] = (fn, support)
+
+def drop_dispatch(h):
+    global dispatch
+    for key in dispatch.keys():
+        if key[0] == h:
+            del dispatch[key]
+
+# input: "rig_id.trv.method [args]"
+# Look up a sub-command in the dispatch table.
+# Returns (rig_id, bound method, support, trv, args) or None.
+
+def lookup(s):
     parms = s.split(None,1)
-    subcom = parms[0]                       # The sub-command part
+    if parms == []:
+        return None
     args = ''
     if len(parms)>1: args = parms[1]        # The arguments, if any
-    if sense == 'put' and args == '':
-        return NAK                          # puts require arguments
-    split = subcom.split(".", 3)            # rig_id, main/sub/control, action
+    split = parms[0].split(".", 3)          # rig_id, main/sub/control, action
     if len(split) != 3:
-        return NAK
-    h = split[0]
-    trv = split[1]
-    cmd = split[2]
+        return None
+    h, trv, fn_name = split
     # Check for valid trv?  Not here - we don't know what's valid.
-    fn_name = cmd                           # e.g. af_gain
-    if not h in backEnd:
-        return NAK + "Radio not open."
-    if dir(backEnd[h]).count(fn_name) == 0: # do we know about fn_name?
-        return NAK+"function name not recognized: '%s'" % fn_name
-    mode = { 'get':T_GET, 'put':T_PUT, 'test':T_TEST } [sense]
-    cmd1 = "backEnd['%s'].%s(%d,'%s'" % (h,fn_name,mode,trv)
-    if sense == 'put':                      # if 'put', add arguments
-        cmd1 += ", '%s'" % args
-    cmd1 += ')'
-    return cmd1         # returns fully qualified function call in string
+    entry = dispatch.get((h, fn_name))
+    if entry == None:                       # rig not open or unknown fn_name
+        return None
+    return h, entry[0], entry[1], trv, args
+
+# Call a backend method in the rig's worker thread and wait for it.
+def rig_call(h, fn, tp, *args):
+    worker = workers.get(h)
+    if worker == None:
+        return backend_call(h, fn, tp, *args)
+    if tp == T_PUT:
+        prio = method_priority(fn.__name__)
+    else:
+        prio = rigworker.P_READ
+    return worker.call(prio, backend_call, h, fn, tp, *args)
+
+# Priority classes (see rigworker.py).  PTT goes before anything else.
+PTT_METHODS = ('transmit',)
+
+def method_priority(method):
+    if method in PTT_METHODS:
+        return rigworker.P_PTT
+    return rigworker.P_WRITE
+
+# The class of a command; plain gets and tests are in class 'reads'.
+def command_priority(func, args, reads):
+    if func == do_put:
+        split = args.split(None,1)
+        if split:
+            return method_priority(split[0].split('.')[-1])
+        return rigworker.P_WRITE
+    if func == do_batch:
+        prio = reads
+        for sub in args.split(BATCH_SEP):
+            split = sub.split(None,1)
+            if len(split) > 1 and split[0][0] == 'p':
+                prio = min(prio, command_priority(do_put, split[1], reads))
+        return prio
+    return reads
+
+OP_NAMES = { T_TEST:'test', T_GET:'get', T_PUT:'put' }
+
+def backend_call(h, fn, tp, *args):     # timed for rigstats
+    t0 = time.time()
+    rigtrace.mark_current('backend:' + fn.__name__)
+    result = fn(tp, *args)
+    rigtrace.mark_current('backend:' + fn.__name__ + '.done')
+    labels = (('rig',h), ('method',fn.__name__), ('op',OP_NAMES[tp]))
+    rigstats.observe('rigserve_backend_seconds', labels, time.time() - t0)
+    if str(result).startswith(NAK1):
+        rigstats.count('rigserve_naks_total', labels)
+    return result
+
+def command_done(h, fn, op, t0):
+    labels = (('rig',h), ('method',fn.__name__), ('op',op))
+    rigstats.observe('rigserve_command_seconds', labels, time.time() - t0)
 
 # input: "rig-command parameters"
 # A rig-command has the form <rig_id>.<type>.<action>, where
@@ -160,48 +330,374 @@ def make_cmd(sense, s):   # Parse sub-command & create backend fn call
 # 'action' is 'mode', 'af_gain', 'vfo_freq', etc.
 
 def do_put(s):      # e.g., rig1.rx.af_gain value
-    # use make_getput to construct the command with namespace, 
-    # parameters, etc.: '<namespace>.put_<action> parameters'
-    cmd = make_cmd('put',s)
-    if cmd.startswith(NAK):
+    t0 = time.time()
+    entry = lookup(s)
+    if entry == None or entry[4] == '':     # puts require arguments
         return NAK+"put command unrecognized or needs argument: '%s'" % s
-    resp = eval (cmd)           # execute the command, response passed up
-    return resp
+    h, fn, support, trv, args = entry
+    result = rig_call(h, fn, T_PUT, trv, args)
+    if fn.__name__ == 'init':
+        if result == ACK:
+            inited[h] = True
+        else:
+            inited.pop(h, None)
+    if caches.has_key(h):
+        caches[h].invalidate(fn.__name__)   # even after a NAK: unsure now
+    if rigstate.table:
+        rigstate.table.expire(h, changed_methods(h, fn.__name__))
+    command_done(h, fn, 'put', t0)
+    return result                   # response passed up
 
-# like 'do_put', except no parameters and translates to get_<action>
-def do_get(s):      # e.g., rig1.rx.af_gain
-    cmd = make_cmd('get',s)
-    if cmd.startswith(NAK) :
+# like 'do_put', except no parameters.  Answered from the rig's cache
+# when it has a fresh enough value (see rigcache.py).  With the 'age'
+# argument, the reply is followed by ' age=<secs>', the time since the
+# value was read from the rig.
+def do_get(s):      # e.g., rig1.rx.af_gain [age]
+    t0 = time.time()
+    entry = lookup(s)
+    if entry == None:
         return NAK+"get command not recognized: %s" % s
-    resp = eval (cmd)           # pass response up
-    return resp
+    h, fn, support, trv, args = entry
+    hit = None
+    if caches.has_key(h):
+        hit = caches[h].lookup(trv, fn.__name__)
+    if hit != None:
+        result = with_age(hit[0], hit[1], args)
+    else:
+        result = with_age(rig_get(h, fn, trv), 0., args)
+    command_done(h, fn, 'get', t0)
+    return result                   # pass response up
+
+# Read a value from the rig itself, and keep it in the cache.
+def rig_get(h, fn, trv):
+    when = time.time()
+    result = rig_call(h, fn, T_GET, trv)
+    if caches.has_key(h):
+        caches[h].store(trv, fn.__name__, result, when)
+    if rigstate.table and not str(result).startswith(NAK1):
+        rigstate.table.publish('%s.%s.%s' % (h, trv, fn.__name__), result)
+    return result
+
+# The methods of rig 'h' a put of 'method' may have changed.
+def changed_methods(h, method):
+    if method == 'init':
+        return [ key[1] for key in dispatch.keys() if key[0] == h ]
+    return [method] + rigcache.RELATED.get(method, [])
+
+# input: "" or "rig_id"
+# The values in the shared state table (see rigstate.py), with their age.
+def do_state(s):
+    if not rigstate.table:
+        return NAK + "no state table."
+    h = s.strip()
+    r = 'State table:\n'
+    for name, value, age in rigstate.table.dump():
+        if h == '' or name.split('.')[0] == h:
+            r += '\t%s %s (%.3f s)\n' % (name, value, age)
+    r += 'End of state table'
+    return r
+
+def with_age(result, age, args):
+    if args != 'age' or str(result).startswith(NAK1):
+        return result
+    return '%s age=%.3f' % (result, age)
+
+# A get answered from the cache without going to the rig's worker, or
+# None.  Used by the network side, which must not wait for the rig.
+def cached_get(s):
+    entry = lookup(s)
+    if entry == None:
+        return None
+    h, fn, support, trv, args = entry
+    cache = caches.get(h)
+    if cache == None or cache.writers > 0:
+        return None                 # a put may change it: ask the worker
+    hit = cache.lookup(trv, fn.__name__, False)
+    if hit == None:
+        return None
+    return with_age(hit[0], hit[1], args)
 
 def do_test(s):     # Test if a command is implemented for this rig
-                    # parse s: rig.vrx.freq --> eg 'rig.vrx.freq'
+                    # parse s: [get|put] rig.vrx.freq
                     # Note that vrx field is not verified here.
     parms = s.split(None,2)     # (will ignore any arguments after
+    tp = T_TEST
+    if len(parms) > 1 and parms[0] in ('get', 'put', 'test'):
+        tp = { 'get':T_GET, 'put':T_PUT, 'test':T_TEST } [parms[0]]
+        parms = parms[1:]
+    if parms == []:
+        return NAK+'Test 1: no command given'
     lst = parms[0].split('.',3)   # want exactly 3 fields
-    if len(lst) < 3:
+    if len(lst) != 3:
         return NAK+'Test 2: invalid format "%s"' % s
     h, vrx, cmd = lst
-    sp = cmd.find(' ')                 # trim space & stuff at end
-    if sp >= 0: cmd = cmd[:sp-1]
     if not backEnd.has_key(h):  
         return NAK+'Test 3: rig type unknown: "%s"' % h
-    # Try to find the class where the command/method is first located,
-    # if it exists at all.
-    trial_cmd = 'backEnd[h].%s(T_TEST,"%s")' %(cmd, vrx)
-    try:
-        result = eval (trial_cmd)
-    except AttributeError:
+    entry = dispatch.get((h, cmd))
+    if entry == None:
         # The method name is not even in backend - spelling error?
         return NAK+'Function unknown: %s' % parms[0]
-    if result == None:
+    if not entry[1]:
         # Method exists, but not implemented except in Backend. Fail.
         return NAK+'Function not implemented for this rig.'
+    if not tp in entry[1]:
+        # Implemented, but not for this operation (e.g. 'put' on a meter)
+        return NAK+'Operation not supported for this rig.'
         # Method was overlayed on Backend: command implemented. Success.
     return ACK
 
+# input: "get rig.X.y; put rig.X.z value; test rig.X.w; ..."
+# Run several get/put/test sub-commands, in order, in one request.  Each
+# one gets its own status in the framed response (see globals.py).
+
+BATCH_COMMANDS = { 'g':do_get, 'p':do_put, 't':do_test }
+
+def do_batch(s):
+    prefetch(s)
+    replies = []
+    for sub in s.split(BATCH_SEP):
+        split = sub.split(None,1)
+        if split == []:
+            continue                # allow a trailing separator
+        args = ''
+        if len(split) > 1: args = split[1]
+        func = BATCH_COMMANDS.get(split[0][0])
+        if func == None:
+            replies.append(NAK+'batch: only get/put/test allowed: "%s"' % sub.strip())
+        else:
+            replies.append(func(args))
+    return format_batch(replies)
+
+# The gets of a batch (up to its first put), by rig: {h: [(method, trv)]},
+# leaving out those the cache will answer.
+def batch_gets(s):
+    gets = {}
+    for sub in s.split(BATCH_SEP):
+        split = sub.split(None,1)
+        if len(split) < 2:
+            continue
+        if split[0][0] == 'p':
+            break                   # what follows may read what it changes
+        if split[0][0] != 'g':
+            continue
+        entry = lookup(split[1])
+        if entry == None:
+            continue
+        h, fn, support, trv, args = entry
+        if caches.has_key(h) and caches[h].fresh(trv, fn.__name__):
+            continue
+        gets.setdefault(h, []).append((fn.__name__, trv))
+    return gets
+
+# Let the backend of each rig read a batch's gets at once, if it can
+# (e.g. Icom.prefetch, pipelined on the CI-V bus); the gets then find
+# their answers ready.  Not for a rig in a process of its own.
+def prefetch(s):
+    for h, calls in batch_gets(s).items():
+        be = backEnd.get(h)
+        if len(calls) < 2 or processes.has_key(h) or \
+                not hasattr(be, 'prefetch'):
+            continue
+        worker = workers.get(h)
+        if worker == None:
+            be.prefetch(calls)
+        else:
+            worker.call(rigworker.P_READ, be.prefetch, calls)
+
+# The rig ids a batch talks to, e.g. ['rig1', 'rig2'].
+def batch_rigs(s):
+    rigs = []
+    for sub in s.split(BATCH_SEP):
+        split = sub.split(None,1)
+        if len(split) < 2 or not BATCH_COMMANDS.has_key(split[0][0]):
+            continue
+        h = split[1].split('.',1)[0]
+        if not h in rigs:
+            rigs.append(h)
+    return rigs
+
+# input: "rig_id [stats|on|off|clear|ttl [method secs]]"
+# Look at or tune the cache of a rig.  A TTL of 0 stops caching a method.
+def do_cache(s):
+    split = s.split()
+    if split == []:
+        return NAK + "cache needs a rig id."
+    h = split[0]
+    if not caches.has_key(h):
+        return NAK + "not open."
+    cache = caches[h]
+    if len(split) == 1 or split[1] == 'stats':
+        return cache.stats()
+    if split[1] == 'on':
+        cache.set_enabled(True)
+    elif split[1] == 'off':
+        cache.set_enabled(False)
+    elif split[1] == 'clear':
+        cache.clear()
+    elif split[1] == 'ttl':
+        if len(split) == 2:
+            return cache.ttl_list()
+        if len(split) != 4:
+            return NAK + "cache ttl needs a method and a time in secs."
+        try:
+            secs = float(split[3])
+        except ValueError:
+            return NAK + "invalid time: %s" % split[3]
+        if not dispatch.has_key((h, split[2])):
+            return NAK + "function name not recognized: '%s'" % split[2]
+        cache.set_ttl(split[2], secs)
+    else:
+        return NAK + "unknown cache command: %s" % split[1]
+    return ACK
+
+# input: "rig_id.trv.method interval|on-change"
+# Per-connection: push the value to 'conn' every 'interval' secs, or
+# whenever it changes.  All the connections watching the same feature
+# share its reads (see rigwatch.py).
+def do_watch(conn, s):
+    split = s.split()
+    if len(split) != 2:
+        return NAK + "watch needs a rig command and an interval or 'on-change'."
+    name = split[0]
+    try:
+        interval = rigwatch.parse_interval(split[1])
+    except ValueError:
+        return NAK + "invalid interval (min. %gs): %s" % \
+            (rigwatch.MIN_INTERVAL, split[1])
+    entry = lookup(name)
+    if entry == None:
+        return NAK + "watch command not recognized: %s" % name
+    h, fn, support, trv, args = entry
+    if not T_GET in support:
+        return NAK + 'Operation not supported for this rig.'
+    if not watches.has_key(name):
+        watches[name] = rigwatch.Watch(conn.loop, name,
+                                       watch_reader(h, fn, trv))
+    watches[name].add(conn, interval)
+    return ACK
+
+# input: "[rig_id.trv.method]"  (none: all of this connection's watches)
+def do_unwatch(conn, s):
+    name = s.strip()
+    if name != '' and not (watches.has_key(name) and
+                           watches[name].subs.has_key(conn)):
+        return NAK + "not watching %s" % name
+    for key in watches.keys():
+        if name == '' or key == name:
+            watches[key].remove(conn)
+            if not watches[key].subs:
+                del watches[key]
+    return ACK
+
+# input: "binary|text"
+# Per-connection: switch to length-prefixed frames or back to text (see
+# rigframe.py).  Only with no other request of the connection pending,
+# so the replies of both modes are never mixed.
+def do_frame(conn, s):
+    mode = s.strip()
+    if not mode in ('binary', 'text'):
+        return NAK + "frame needs 'binary' or 'text'."
+    if conn.pending() > 1:
+        return NAK + "frame: wait for the pending replies first."
+    conn.set_framed(mode == 'binary')
+    return ACK
+
+# input: "[interactive|poll]"
+# Per-connection: the priority class of its gets.  A service that polls
+# the rig in the background says 'poll', so its reads never hold up
+# the gets of interactive clients (puts and PTT go first anyway).
+def do_priority(conn, s):
+    mode = s.strip()
+    if mode == '':
+        if conn.reads == rigworker.P_POLL:
+            return 'poll'
+        return 'interactive'
+    if not mode in ('interactive', 'poll'):
+        return NAK + "priority needs 'interactive' or 'poll'."
+    if mode == 'poll':
+        conn.reads = rigworker.P_POLL
+    else:
+        conn.reads = rigworker.P_READ
+    return ACK
+
+def watch_reader(h, fn, trv):
+    def read(done):
+        worker = workers.get(h)
+        if worker != None:
+            worker.submit(rig_get, (h, fn, trv), done, rigworker.P_POLL)
+        else:
+            done(rig_get(h, fn, trv))
+    return read
+
+def drop_watches(h):
+    for key in watches.keys():
+        if key.split('.',1)[0] == h:
+            watches[key].close('rig closed.')
+            del watches[key]
+
+# input: "[reset]"
+# Latency histograms, counters and queue depths (see rigstats.py).
+def do_stats(s):
+    if s.strip() == 'reset':
+        rigstats.reset()
+        return ACK
+    if s.strip() != '':
+        return NAK + "unknown stats command: %s" % s.strip()
+    return rigstats.report()
+
+def queue_depths():
+    depths = []
+    for h in workers.keys():
+        for prio in xrange(len(rigworker.PRIO_NAMES)):
+            labels = (('rig',h), ('prio',rigworker.PRIO_NAMES[prio]))
+            depths.append((labels, workers[h].pending(prio)))
+    return depths
+
+def cache_hits():
+    return [ ((('rig',h),), caches[h].hits) for h in caches.keys() ]
+
+def cache_misses():
+    return [ ((('rig',h),), caches[h].misses) for h in caches.keys() ]
+
+def cache_bypassed():
+    return [ ((('rig',h),), caches[h].bypassed) for h in caches.keys() ]
+
+rigstats.gauge('rigserve_queue_depth', queue_depths)
+rigstats.gauge('rigserve_cache_hits_total', cache_hits)
+rigstats.gauge('rigserve_cache_misses_total', cache_misses)
+rigstats.gauge('rigserve_cache_bypassed_total', cache_bypassed)
+
+# input: "[n]", "save file [n]", "clear" or "mark id stage=time ..."
+# The last n traced requests, hop by hop (see rigtrace.py).
+def do_trace(s):
+    split = s.split()
+    try:
+        if split == []:
+            return rigtrace.report()
+        if split[0] == 'save' and len(split) in (2, 3):
+            last = None
+            if len(split) == 3:
+                last = int(split[2])
+            n = rigtrace.save(split[1], last)
+            return ACK + ' %d stages saved to %s' % (n, split[1])
+        if split[0] == 'clear' and len(split) == 1:
+            rigtrace.clear()
+            return ACK
+        if split[0] == 'mark' and len(split) > 2:
+            trace_id, stages = rigtrace.parse_token(';'.join(split[1:]))
+            if trace_id == None:
+                return NAK + "bad trace stages: %s" % s.strip()
+            for stage, t in stages:
+                rigtrace.mark(trace_id, stage, t)
+            return ACK
+        if len(split) == 1:
+            return rigtrace.report(int(split[0]))
+    except ValueError:
+        pass
+    except IOError, e:
+        return NAK + "cannot save traces: %s" % e
+    return NAK + "unknown trace command: %s" % s.strip()
+
 # Provide status of this server (not the rig)
 def do_status(s):
     global nameSp, backEnd, openDrivers
@@ -222,11 +718,16 @@ def do_status(s):
     r += "\n\n"
     r += "Open rig list:\n"
     for rig in backEnd:
-        if "TRUE" in backEnd[rig].init(T_GET).upper():
+        # What the last init put answered: asking the backend would run
+        # on this (the reactor's) thread, behind the rig's worker.
+        if inited.get(rig):
             r += "\tInited     "
         else:
             r += "\tNon-inited "
-        r += rig + " (" + backEnd[rig].backend_id + ")\n"
+        r += rig + " (" + backEnd[rig].backend_id + ")"
+        if processes.has_key(rig):
+            r += " in " + processes[rig].status()
+        r += "\n"
     r += "End of open rig list"
 
     r += "\n\n"
@@ -250,6 +751,14 @@ def do_status(s):
             r += scope + "." + service_name + args + " - " + service.description + "\n"
     r += "End of service list\n"
 
+    r += "\n"
+    r += "Watch list:\n"
+    names = watches.keys()
+    names.sort()
+    for name in names:
+        r += "\t" + watches[name].status() + "\n"
+    r += "End of watch list\n"
+
     r += "\n** End of status info."
     return r
 
@@ -259,17 +768,35 @@ def do_help(s):
     Rigserve 0.20 responds to the following commands, with typical arguments:
 
     open rig1 TT_orion                                 - instantiate a rig object for a particular rig type.
+    open rig1 IC_r75 process                           - same, with the backend in a process of its own
     close rig1                                         - release a rig's resources.
     put rig1.CONTROL.init /dev/ttyUSB0 4800            - attach serial port /dev/ttyUSB0 (4800 baud) to rig1
     put rig1.CONTROL.init remoterig 10.3.73.128 12337  - attach remoterig at IP address 10.3.73.128 (UDP port 12337) to rig1
     put rig1.VFOA.freq 14.05e6                         - send a value to rig/vfo/frequency
     get rig1.VFOA.freq                                 - get current freq. for rig/vfo
     test put rig1.MAIN.rx_mode                         - Check if command is implemented for this rig
+    get rig1.VFOA.freq age                             - same, plus the age in secs of the (maybe cached) value
+    batch get rig1.VFOA.freq; put rig1.TX.power 50     - run several get/put/test commands at once
+    cache rig1                                         - show cache hits and misses for rig1
+    cache rig1 ttl freq 0.5                            - keep rig1's freq for 0.5 secs (0 = never cache)
+    cache rig1 on|off|clear                            - turn rig1's cache on or off, or empty it
+    stats                                              - latency histograms, error counters, queue depths
+    stats reset                                        - start counting again
+    state rig1                                         - latest values in the shared state table (all rigs: no argument)
+    trace 10                                           - latency of each hop of the last 10 traced requests ("@id get ...")
+    trace save /tmp/traces.txt                         - write the traced stages to a file ('trace clear' forgets them)
+    frame binary                                       - switch to length-prefixed frames with request ids (see rigframe.py)
+    watch rig1.MAIN.strength_raw 0.2                   - push "WATCH rig1.MAIN.strength_raw <value>" every 0.2 secs
+    watch rig1.VFOA.freq on-change                     - push the value whenever it changes
+    unwatch rig1.VFOA.freq                             - stop a watch (no argument: stop them all)
+    priority poll                                      - this connection's gets are background polling (PTT and puts go first)
     status                                             - Get some status info for the server
+    start rigserve.metrics listen_tcp_port=14656       - serve the stats to Prometheus on http://127.0.0.1:14656/metrics
     start rigserve.global_service_name                 - Start a rigserve-wide service
     start rig1.rig_service_name                        - Start a rig-wide service
     stop rigserve.global_service_name                  - Stop a rigserve-wide service
     stop rig1.rig_service_name                         - Stop a rig-wide service
+    ready rig1.simple rig1.hamlib timeout=10           - wait until services are listening (default: all started ones)
     help                                               - Get this message 
 
     A typical session would:
@@ -317,6 +844,45 @@ def do_start(s):
     else:
         return NAK + "Unknown service " + scope + "." + service_name + "."
 
+# input: "[scope.service ...] [timeout=secs]"
+# Wait until the given services (default: all started ones) are ready,
+# i.e. listening and connected.  Run in a thread of its own, since the
+# services connect back to us while we wait.
+READY_TIMEOUT = 30.     # secs
+
+def do_ready(s):
+    timeout = READY_TIMEOUT
+    names = []
+    for arg in s.split():
+        if arg.startswith('timeout='):
+            try:
+                timeout = float(arg[len('timeout='):])
+            except ValueError:
+                return NAK + "invalid timeout: %s" % arg
+        else:
+            names.append(arg)
+    scopes = { 'rigserve':services_dict }
+    for rig in backEnd.keys():
+        scopes[rig] = backEnd[rig].get_services_dict()
+    if names == []:
+        for scope in scopes:
+            for name in scopes[scope]:
+                if "TRUE" in scopes[scope][name].status().upper():
+                    names.append(scope + "." + name)
+    deadline = time.time() + timeout
+    not_ready = []
+    for name in names:
+        split = name.split(".", 1)
+        if len(split) != 2 or not scopes.has_key(split[0]) or \
+                not scopes[split[0]].has_key(split[1]):
+            return NAK + "Unknown service " + name + "."
+        service = scopes[split[0]][split[1]]
+        if not service.wait_ready(max(0., deadline - time.time())):
+            not_ready.append(name)
+    if not_ready:
+        return NAK + "Not ready: " + " ".join(not_ready)
+    return ACK
+
 def do_stop(s):
     split = s.split(".", 1)
 
@@ -341,8 +907,10 @@ def do_stop(s):
 # socket), recognizes the 'major command', and executes it.
 
 command_dict = { 'o':do_open, 'c':do_close, 't':do_test,
-                'p':do_put, 'g':do_get, 's':do_status, 'h':do_help,
-                'start':do_start, 'stop':do_stop }
+                'p':do_put, 'g':do_get, 'b':do_batch, 's':do_status, 'h':do_help,
+                'start':do_start, 'stop':do_stop, 'cache':do_cache,
+                'stats':do_stats, 'ready':do_ready, 'state':do_state,
+                'trace':do_trace }
 def command(cmd):
     global command_dict
     # These are the major commands, all unique in their first letter.
@@ -365,6 +933,328 @@ def command(cmd):
     else:
         result = func(args)
     return result
+
+# Like 'command', but do not wait for the rig: done(result) is called
+# when the command has run.  get/put, and a batch for a single rig, run
+# in that rig's worker, so a slow rig only delays its own clients.  A
+# batch for several rigs gets a thread of its own that waits on each
+# rig in turn, and so does 'ready'.  Everything else (open, close,
+# status...) runs at once.  'reads' is the priority class of gets
+# (rigworker.P_READ, or P_POLL for a polling client).  A put may be
+# absorbed by a queued one (see COALESCE_PUTS).  The worker runs the
+# calls of one 'owner' (a client connection) in the order they came.
+
+def command_async(cmd, done, reads=rigworker.P_READ, trace_id=None,
+                  owner=None):
+    split = cmd.split(None,1)
+    if split == []:
+        done(command(cmd))
+        return
+    func, args, rigs = command_rigs(split)
+    done = request_timer(func, done)
+    if func == do_get and rigs:
+        result = cached_get(args)
+        if result != None:
+            done(result)
+            return
+    job, job_args = command, (cmd,)
+    queued = None
+    if func == do_put and len(rigs) == 1 and COALESCE_PUTS:
+        key = coalesce_key(args)
+        if key != None:
+            queued = queue_put(key, cmd, done, trace_id,
+                               workers[rigs[0]], owner)
+            if queued == None:
+                return                  # absorbed by a queued put
+            job, job_args, done = run_put, (queued,), reply_all(queued)
+            trace_id = None             # run_put traces them all
+    if func in (do_put, do_batch):
+        writing = [ caches[h] for h in rigs if caches.has_key(h) ]
+        for cache in writing:
+            cache.put_queued()
+        done = put_finished(writing, done)
+    if trace_id != None:
+        job = traced(trace_id, job)
+    if len(rigs) == 1:
+        prio = command_priority(func, args, reads)
+        submitted = workers[rigs[0]].submit(job, job_args, done, prio, owner)
+        if queued != None:
+            coalesce_lock.acquire()
+            queued[3] = submitted
+            coalesce_lock.release()
+    elif len(rigs) > 1 or func == do_ready:
+        threading.Thread(target=command_thread, args=(cmd, done)).start()
+    else:
+        done(command(cmd))
+
+# (function, args, [rig ids with a worker]) of a split command line.
+def command_rigs(split):
+    m = split[0]
+    args = ''
+    if len(split) > 1: args = split[1]
+    func = command_dict.get(m, command_dict.get(m[0]))
+    if func in (do_get, do_put):
+        rigs = [ args.split('.',1)[0] ]
+    elif func == do_batch:
+        rigs = batch_rigs(args)
+    else:
+        rigs = []
+    return func, args, [ h for h in rigs if workers.has_key(h) ]
+
+# The rig whose worker will run command 'cmd', or None if it runs in
+# the network thread or a thread of its own.
+def worker_rig(cmd):
+    split = cmd.split(None,1)
+    if split == []:
+        return None
+    func, args, rigs = command_rigs(split)
+    if len(rigs) == 1 and func in (do_get, do_put, do_batch):
+        return rigs[0]
+    return None
+
+# Time the whole request, from here to the reply, for rigstats.
+def request_timer(func, done):
+    t0 = time.time()
+    op = 'unknown'
+    if func != None:
+        op = func.__name__[3:]      # do_get -> get
+    def finished(result):
+        labels = (('op',op),)
+        rigstats.observe('rigserve_request_seconds', labels, time.time() - t0)
+        if str(result).startswith(NAK1):
+            rigstats.count('rigserve_request_naks_total', labels)
+        done(result)
+    return finished
+
+# Run 'job' as part of trace 'trace_id' (see rigtrace.py): the worker
+# marks when it starts it, and backend_call marks each rig call.
+def traced(trace_id, job):
+    def run(*args):
+        rigtrace.mark(trace_id, 'rigserve.worker')
+        rigtrace.current.ids = (trace_id,)
+        try:
+            return job(*args)
+        finally:
+            rigtrace.current.ids = ()
+    return run
+
+# (rig_id, trv, method) of a put that may be coalesced, or None.
+def coalesce_key(s):
+    entry = lookup(s)
+    if entry == None:
+        return None
+    h, fn, support, trv, args = entry
+    if fn.__name__ in NO_COALESCE:
+        return None
+    return h, trv, fn.__name__
+
+# Queue a put under 'key', from 'owner' to the rig of 'worker'.  If one
+# is queued already, and the put may run in its place (the owner has
+# nothing queued on the worker after it), it takes our value, 'done'
+# and trace, and None is returned.  Else we get a new queue entry, the
+# one later puts join: [cmd, [done, ...], [trace id, ...], worker job
+# (set once submitted), key].
+def queue_put(key, cmd, done, trace_id, worker, owner):
+    coalesce_lock.acquire()
+    try:
+        queued = queued_puts.get(key)
+        if queued != None and queued[3] != None and (owner == None or
+               worker.last_queued(owner) in (None, queued[3])):
+            queued[0] = cmd
+            queued[1].append(done)
+            if trace_id != None:
+                queued[2].append(trace_id)
+            rigstats.count('rigserve_puts_coalesced_total',
+                (('rig',key[0]), ('trv',key[1]), ('method',key[2])))
+            return None
+        queued = queued_puts[key] = [cmd, [done], [], None, key]
+        if trace_id != None:
+            queued[2].append(trace_id)
+        return queued
+    finally:
+        coalesce_lock.release()
+
+# In the rig's worker: run the latest put of 'queued', as part of the
+# traces of all the puts it took in.
+def run_put(queued):
+    coalesce_lock.acquire()
+    try:
+        if queued_puts.get(queued[4]) is queued:
+            del queued_puts[queued[4]]
+        cmd, trace_ids = queued[0], tuple(queued[2])
+    finally:
+        coalesce_lock.release()
+    for trace_id in trace_ids:
+        rigtrace.mark(trace_id, 'rigserve.worker')
+    rigtrace.current.ids = trace_ids
+    try:
+        return command(cmd)
+    finally:
+        rigtrace.current.ids = ()
+
+def reply_all(queued):
+    def done(result):
+        for d in queued[1]:
+            d(result)
+    return done
+
+def put_finished(writing, done):
+    def finished(result):
+        for cache in writing:
+            cache.put_done()
+        done(result)
+    return finished
+
+def command_thread(cmd, done):
+    result = command(cmd)
+    if result_post:
+        result_post(done, result)
+    else:
+        done(result)
+
+# One client connection to the control port.  Commands are separated by
+# newlines; each one gets exactly one reply, in order.  Commands for
+# different rigs may finish out of order, so every command gets a reply
+# slot and the slots are sent as soon as all the earlier ones are filled.
+# Watched values are pushed in between replies, one line each.
+#
+# In framed mode (after 'frame binary') every request is a frame with an
+# id, and each reply is sent, with that id, as soon as it is ready.
+#
+# Either way, a connection's requests take effect in the order they came.
+# Those for one rig's worker are kept in order by the worker (see
+# rigworker.py), and may be in flight together, on several rigs.  Any
+# other request (stats, cache, state, a batch for several rigs...)
+# waits until all the earlier ones have run, and the later ones wait
+# for it.
+
+def traced_answer(trace_id, answer):
+    def reply(result):
+        rigtrace.mark(trace_id, 'rigserve.reply')
+        answer(result)
+    return reply
+
+conn_command_dict = { 'watch':do_watch, 'unwatch':do_unwatch,
+                      'frame':do_frame, 'priority':do_priority }
+
+class RigserveConnection(rigloop.LineConnection):
+    count = 0                       # open connections, for rigstats
+
+    def __init__(self, loop, sock, addr):
+        rigloop.LineConnection.__init__(self, loop, sock, addr)
+        RigserveConnection.count += 1
+        self.slots = []             # [reply or None], in command order
+        self.outstanding = 0        # framed requests not yet answered
+        self.waiting = collections.deque()  # requests held back, in order
+        self.running = {}           # rig id (None: others): requests run
+        self.dispatching = False
+        self.quitting = False
+        self.reads = rigworker.P_READ   # priority class of our gets
+        print time.asctime(),' Connected from', addr
+        self.write('Welcome to Rigserve!\n')
+
+    def line_received(self, line):
+        if self.quitting:
+            return                  # nothing after QUIT is run
+        slot = [None]
+        self.slots.append(slot)
+        self.request(line, lambda result: self.reply(slot, result))
+
+    def frame_received(self, req_id, payload):
+        if self.quitting:
+            return
+        self.outstanding += 1
+        self.request(payload,
+                     lambda result: self.frame_reply(req_id, result))
+
+    # Run one request; answer(result) gets its reply.  A request may
+    # carry a trace (see rigtrace.py): "@<id>;<stages> <command>".
+    def request(self, line, answer):
+        rData = line.rstrip().lstrip()
+        trace_id, stages, rData = rigtrace.untag(rData)
+        if trace_id != None:
+            for stage, t in stages:
+                rigtrace.mark(trace_id, stage, t)
+            rigtrace.mark(trace_id, 'rigserve.recv')
+            answer = traced_answer(trace_id, answer)
+        if rData.upper().startswith("QUIT"):
+            self.quitting = True
+        split = rData.split(None,1)
+        h = None
+        if split and not conn_command_dict.has_key(split[0]):
+            h = worker_rig(rData)
+        self.waiting.append((rData, answer, trace_id, h))
+        self.dispatch()
+
+    # Start the requests held back that may run now, in order.
+    def dispatch(self):
+        if self.dispatching:
+            return                  # a request done at once: the caller goes on
+        self.dispatching = True
+        try:
+            while self.waiting:
+                h = self.waiting[0][3]
+                if self.running and (h == None or self.running.has_key(None)):
+                    break           # behind the requests running
+                rData, answer, trace_id, h = self.waiting.popleft()
+                self.running[h] = self.running.get(h, 0) + 1
+                self.run(rData, self.finished(h, answer), trace_id)
+        finally:
+            self.dispatching = False
+
+    def finished(self, h, answer):
+        def done(result):
+            self.running[h] -= 1
+            if not self.running[h]:
+                del self.running[h]
+            answer(result)
+            self.dispatch()
+        return done
+
+    def run(self, rData, answer, trace_id):
+        split = rData.split(None,1)
+        if rData.upper().startswith("QUIT"):
+            answer("QUIT")
+        elif split and conn_command_dict.has_key(split[0]):
+            args = ''
+            if len(split) > 1: args = split[1]
+            answer(conn_command_dict[split[0]](self, args))
+        else:
+            command_async(rData, answer, self.reads, trace_id, self)
+
+    def pending(self):
+        return len(self.slots) + self.outstanding
+
+    def reply(self, slot, result):
+        slot[0] = str(result) + "\n"
+        while self.slots and self.slots[0][0] != None:
+            self.write(self.slots.pop(0)[0])
+        self.check_quit()
+
+    def frame_reply(self, req_id, result):
+        self.outstanding -= 1
+        self.write(rigframe.encode_reply(req_id, result))
+        self.check_quit()
+
+    def check_quit(self):
+        if self.quitting and self.pending() == 0:
+            self.close_when_done()
+
+    def push(self, name, value):
+        if self.framed:
+            self.write(rigframe.encode(0, rigframe.ST_PUSH,
+                                       '%s %s' % (name, value)))
+        else:
+            self.write('%s %s %s\n' % (rigwatch.WATCH_PREFIX, name, value))
+
+    def connection_lost(self):
+        RigserveConnection.count -= 1
+        do_unwatch(self, '')
+        print time.asctime(), " Disconnected from", self.addr
+
+rigstats.gauge('rigserve_connections',
+               lambda: [ ((), RigserveConnection.count) ])
+
 #
 # MAIN PROGRAM
 #
@@ -380,34 +1270,42 @@ if __name__ == '__main__':
     if not test_mode:
     # Normal execution: communicate with client over PORT
 
-    # Note: after program terminates, you cannot restart and use bind
-    # until after a 60 sec timeout, due to OS (Linux).  There is an 
-    # "SO_REUSEADDR" option in Linux, but we probably need to use 
-    # the more complicated Python SocketServer facility to get it.
+    # Note: the port is bound with SO_REUSEADDR (see rigconn.bind), so a
+    # restart does not have to wait for the old connections' TIME_WAIT.
+    # If another rigserve still holds it, we wait a while for it to go.
     # Future: communicate on multiple ports at once!
 
         print IDENT
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        counter = 0
-        while True:
-            try:
-                counter = counter + 1
-                s.bind((ALLOWED_IP, PORT))
-                break
-            except socket.error:
-                if counter == 1:
-                    print "Can't open IP Port. Waiting until available..."
-                elif counter > 66:
-                    print "the IP port is not avaliable, exiting"
-                    exit(1)
-                time.sleep(1)
+        if not rigconn.bind(s, (ALLOWED_IP, PORT), 0):
+            print "Can't open IP Port. Waiting until available..."
+            if not rigconn.bind(s, (ALLOWED_IP, PORT), 66):
+                print "the IP port is not avaliable, exiting"
+                exit(1)
         s.listen(5)
-        clients = []
-        addrs_dict = {}
 
+        files = []
         for arg in sys.argv[1:len(sys.argv)]:
+            if arg.startswith('--unix='):
+                UNIX_PATH = arg[len('--unix='):]
+            elif arg.startswith('--state='):
+                STATE_PATH = arg[len('--state='):]
+            else:
+                files.append(arg)
+        # before any service or rig process is forked, so they all see it
+        rigstate.table = rigstate.StateTable(STATE_PATH)
+        unix_listener = None
+        if UNIX_PATH:
+            unix_listener = rigconn.listen(rigconn.UNIX_PREFIX + UNIX_PATH, 5)
+            if unix_listener == None:
+                print "cannot listen on " + UNIX_PATH + ", exiting"
+                exit(1)
+            # the services started from here reach us the same way
+            rigconn.RIGSERVE_ADDR = rigconn.UNIX_PREFIX + UNIX_PATH
+
+        for arg in files:
             try:
                 my_file = open(arg, "r")
             except:
@@ -423,49 +1321,19 @@ if __name__ == '__main__':
                 print ".... returned " + reply
         print "End of file processing."
 
+        loop = rigloop.Loop()
+        result_post = loop.call_soon_threadsafe
+        for h in workers:
+            workers[h].post = result_post
+        rigloop.Listener(loop, s, RigserveConnection)
+        if unix_listener:
+            rigloop.Listener(loop, unix_listener, RigserveConnection)
+        rigconn.signal_ready()          # tell mrigd we are serving
         try:
-            new_socket = 0
-            while True:
-               to_be_selected = [s]
-               for client in clients:
-                  to_be_selected.append(client)
-
-               [r, w, e] = select.select(to_be_selected, [], [], 40)
-
-               if s in r:
-                  new_socket, addr = s.accept()
-                  new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                  clients.append(new_socket)
-                  addrs_dict[new_socket] = addr
-                  print time.asctime(),' Connected from', addr
-                  new_socket.sendall('Welcome to Rigserve!\n')
-
-               for c in r:
-                  if not c is s:
-                     try:
-                        rData = c.recv(8192)
-                        rData = rData.rstrip().lstrip()
-                        #print "rcv:", rData, "from:", addrs_dict[c]
-                        if rData.upper().startswith("QUIT"):
-                           if c in w:
-                              c.sendall("QUIT\n")
-                           c.close()
-                           print time.asctime(), " Disconnected from", addrs_dict[c]
-                           clients.remove(c)
-                           del addrs_dict[c]
-                        else:
-                           reply = str(command(rData))
-                           #print "snd:", reply, "to:", addrs_dict[c]
-                           c.sendall(reply + "\n")
-                     except socket.error:
-                        c.close()
-                        clients.remove(c)
-                        del addrs_dict[c]
+            loop.run()
         except KeyboardInterrupt:
-             for c in clients:
-                 c.close()
-             s.close()
-             print "All closed"
+            loop.close_all()
+            print "All closed"
     else:
 
 # Place diagnostic calls below -- executed when test_mode == True
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# File: rigstate.py
+# Version: 1.0
+#
+# mrigd: shared-memory table of the latest rig values
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# rigserve publishes every value it reads from a rig ("rig1.VFOA.freq")
+# into a table in shared memory.  The services rigserve starts are forked
+# from it and inherit the table, so they can look a value up without a
+# round trip to rigserve: a few memory reads, no system calls.  With
+# --state=PATH the table is a file (e.g. in /dev/shm) that other
+# programs can attach() to.
+#
+# The table is a header and NSLOTS fixed-size slots:
+#
+#   header:  magic 'RIGS', number of slots, slot size, generation
+#   slot:    seq, time, key length, key, value length, value
+#
+# 'time' is CLOCK_MONOTONIC when the value was read from the rig, 0 if it
+# is no longer valid (a put may have changed it).  Only rigserve writes.
+# Each slot is a seqlock: the writer makes 'seq' odd, writes, and makes
+# it even again; a reader retries if 'seq' was odd, or changed while it
+# was reading.
+#
+# A reader keeps the slot of each name it found, and remembers the names
+# it did not find with the generation it looked at.  The writer adds one
+# to the generation after a slot gets a new name (or loses it), so a
+# name never published costs one header read, not a scan of the table,
+# until the names change.
+
+import mmap, struct, threading, os, ctypes, ctypes.util
+
+MAGIC      = 'RIGS'
+NSLOTS     = 512
+KEY_SIZE   = 63             # longest "rig.trv.method"
+VALUE_SIZE = 127            # longest value kept; longer ones are not
+RETRIES    = 100            # reads of a slot being written
+
+HEADER = struct.Struct('=4sIII')
+GEN_OFFSET = struct.calcsize('=4sII')
+SLOT   = struct.Struct('=Id B%ds B%ds' % (KEY_SIZE, VALUE_SIZE))
+SEQ    = struct.Struct('=I')
+
+# ------- CLOCK_MONOTONIC, the same for all processes ---------
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                        use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (OSError, AttributeError):
+    clock_gettime = None
+
+def monotonic():
+    if clock_gettime == None:
+        return os.times()[4]
+    t = timespec()
+    clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+# ------- The table ---------
+
+class StateTable(object):
+    # A new table: anonymous shared memory, or the file 'path'.
+    def __init__(self, path=None, nslots=NSLOTS):
+        size = HEADER.size + nslots * SLOT.size
+        if path == None:
+            self.mm = mmap.mmap(-1, size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+            os.close(fd)
+        HEADER.pack_into(self.mm, 0, MAGIC, nslots, SLOT.size, 0)
+        self.nslots = nslots
+        self.lock = threading.Lock()
+        self.slots = {}                 # writer: name:slot number
+        self.free = range(nslots - 1, -1, -1)
+        self.index = {}                 # reader: name:slot number
+        self.missing = {}               # reader: name:generation not found
+
+    def offset(self, i):
+        return HEADER.size + i * SLOT.size
+
+    def generation(self):
+        return SEQ.unpack_from(self.mm, GEN_OFFSET)[0]
+
+    # ------- Writer side (rigserve) ---------
+
+    def write(self, i, stamp, name, value):
+        off = self.offset(i)
+        seq = SEQ.unpack_from(self.mm, off)[0]
+        SEQ.pack_into(self.mm, off, seq + 1)       # odd: being written
+        SLOT.pack_into(self.mm, off, seq + 1, stamp,
+                       len(name), name, len(value), value)
+        SEQ.pack_into(self.mm, off, seq + 2)
+
+    # After the slots written: the names in the table changed.
+    def new_generation(self):
+        SEQ.pack_into(self.mm, GEN_OFFSET,
+                      (self.generation() + 1) & 0xffffffff)
+
+    # Publish a value just read from the rig.  False if it does not fit.
+    def publish(self, name, value):
+        value = str(value)
+        if len(name) > KEY_SIZE or len(value) > VALUE_SIZE:
+            return False
+        self.lock.acquire()
+        try:
+            i = self.slots.get(name)
+            if i != None:
+                self.write(i, monotonic(), name, value)
+                return True
+            if not self.free:
+                return False
+            i = self.slots[name] = self.free.pop()
+            self.write(i, monotonic(), name, value)
+            self.new_generation()
+            return True
+        finally:
+            self.lock.release()
+
+    # A put to rig 'h' may have changed these methods: mark them invalid.
+    def expire(self, h, methods):
+        self.lock.acquire()
+        for name, i in self.slots.items():
+            split = name.split('.')
+            if split[0] == h and split[-1] in methods:
+                self.write(i, 0., name, '')
+        self.lock.release()
+
+    # Forget all values of rig 'h' (closed), or all of them.
+    def drop(self, h=None):
+        self.lock.acquire()
+        for name, i in self.slots.items():
+            if h == None or name.split('.')[0] == h:
+                self.write(i, 0., '', '')
+                del self.slots[name]
+                self.free.append(i)
+        self.new_generation()
+        self.lock.release()
+
+    # ------- Reader side (any process) ---------
+
+    # A consistent copy of slot i: (stamp, name, value), or None.
+    def read_slot(self, i):
+        off = self.offset(i)
+        for n in xrange(RETRIES):
+            seq = SEQ.unpack_from(self.mm, off)[0]
+            if seq & 1:
+                continue
+            s, stamp, klen, key, vlen, value = SLOT.unpack_from(self.mm, off)
+            if s == seq and SEQ.unpack_from(self.mm, off)[0] == seq:
+                return stamp, key[:klen], value[:vlen]
+        return None
+
+    def find(self, name):
+        gen = self.generation()
+        if self.missing.get(name) == gen:
+            return None                 # not there when last looked
+        for i in xrange(self.nslots):
+            slot = self.read_slot(i)
+            if slot != None and slot[1] == name:
+                self.index[name] = i
+                self.missing.pop(name, None)
+                return i
+        if len(self.missing) >= self.nslots:
+            self.missing.clear()        # names asked for, not unbounded
+        self.missing[name] = gen
+        return None
+
+    # The latest value of 'name' and its age in secs, or None if there is
+    # none (or it is older than 'max_age').
+    def read(self, name, max_age=None):
+        i = self.index.get(name)
+        if i == None:
+            i = self.find(name)
+            if i == None:
+                return None
+        slot = self.read_slot(i)
+        if slot == None:
+            return None
+        stamp, key, value = slot
+        if key != name:
+            del self.index[name]        # slot reused: look again next time
+            return None
+        if stamp == 0.:
+            return None
+        age = monotonic() - stamp
+        if max_age != None and age > max_age:
+            return None
+        return value, age
+
+    # [(name, value, age)] of all valid values.
+    def dump(self):
+        now = monotonic()
+        values = []
+        for i in xrange(self.nslots):
+            slot = self.read_slot(i)
+            if slot != None and slot[1] != '' and slot[0] != 0.:
+                values.append((slot[1], slot[2], now - slot[0]))
+        values.sort()
+        return values
+
+# A table created by another process with StateTable(path).
+def attach(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        mm = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    magic, nslots, slot_size, gen = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or slot_size != SLOT.size:
+        raise IOError('%s is not a rig state table' % path)
+    table = StateTable.__new__(StateTable)
+    table.mm = mm
+    table.nslots = nslots
+    table.index = {}
+    table.missing = {}
+    return table
+
+# rigserve's table, inherited by the services it starts; None if there
+# is none (readers then ask rigserve).
+table = None
+
+def read(name, max_age=None):
+    if table == None:
+        return None
+    return table.read(name, max_age)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# File: rigstats.py
+# Version: 1.0
+#
+# mrigd: latency and throughput metrics for rigserve and backends
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# One process-wide registry of metrics, safe to use from any thread:
+#
+#   observe(name, labels, secs)   - add a time to a latency histogram
+#   count(name, labels, n)        - add to a counter
+#   gauge(name, fn)               - fn() returns [(labels, value), ...]
+#                                   when the metrics are read
+#
+# 'labels' is a tuple of (key, value) pairs, e.g. (('rig','r1'),).
+# report() gives a text summary (the 'stats' command of rigserve) and
+# prometheus() the Prometheus text format (the 'metrics' service).
+#
+# The times taken along a request's way tell where it went:
+#
+#   rigserve_request_seconds    line received -> reply ready (all of it)
+#   rigserve_queue_wait_seconds waiting in the rig's worker queue
+#   rigserve_command_seconds    get/put in the dispatcher, cache included
+#   rigserve_backend_seconds    the backend method (driver + radio)
+#   serial_seconds              serial port transactions (radio)
+
+import threading, time
+
+# Upper bounds of the histogram buckets, in secs (+Inf is implicit)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HELP = {
+    'rigserve_request_seconds':     'Time from command received to reply ready.',
+    'rigserve_queue_wait_seconds':  'Time waiting in the rig worker queue.',
+    'rigserve_command_seconds':     'Time of a get/put in the dispatcher.',
+    'rigserve_backend_seconds':     'Time of a backend method call.',
+    'rigserve_naks_total':          'Backend calls answered with an error.',
+    'rigserve_request_naks_total':  'Requests answered with an error.',
+    'rigserve_queue_depth':         'Calls waiting in the rig worker queue.',
+    'rigserve_puts_coalesced_total':'Puts replaced by a newer one before reaching the rig.',
+    'rigserve_starved_total':       'Calls run ahead of their class after waiting too long.',
+    'rigserve_connections':         'Open client connections.',
+    'rigserve_cache_hits_total':    'Gets answered from the cache.',
+    'rigserve_cache_misses_total':  'Cacheable gets that reached the backend.',
+    'rigserve_cache_bypassed_total':'Gets not cacheable (cache off, no TTL).',
+    'serial_seconds':               'Time of a serial port transaction.',
+    'serial_timeouts_total':        'Serial reads that timed out.',
+    'serial_errors_total':          'Serial replies that were malformed.',
+    'civ_transceive_total':         'CI-V freq/mode broadcasts taken off the bus.',
+    'civ_state_hits_total':         'Icom gets answered from the broadcast state.',
+    'civ_pipeline_resends_total':   'Pipelined CI-V frames sent again for want of an answer.',
+    'civ_prefetch_hits_total':      'CI-V commands answered by a pipelined read.',
+    'link_saved_seconds_total':     'Fixed waits and timeouts a link controller cut short.',
+    'link_retry_seconds_total':     'Time spent retrying commands that got no answer.',
+    'link_retries_total':           'Commands sent again for want of an answer.',
+    'link_timeouts_total':          'Commands that got no answer within their timeout.',
+    'link_gap_seconds':             'Gap learned as safe before a paced command.',
+    }
+
+lock       = threading.Lock()
+histograms = {}     # (name, labels):Histogram
+counters   = {}     # (name, labels):value
+gauges     = {}     # name:fn
+started    = time.time()
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def add(self, secs):
+        i = 0
+        while i < len(BUCKETS) and secs > BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += secs
+        if secs > self.max:
+            self.max = secs
+
+    # Quantile q (0. - 1.), interpolated in the bucket holding it, as if
+    # its samples were spread evenly between its bounds (the last one's
+    # upper bound, and any bucket's past the largest sample, is max).
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.
+        want = q * self.count
+        n = 0
+        lower = 0.
+        for i in xrange(len(BUCKETS) + 1):
+            if i < len(BUCKETS):
+                upper = min(BUCKETS[i], self.max)
+            else:
+                upper = self.max
+            if self.buckets[i] and n + self.buckets[i] >= want:
+                part = (want - n) / float(self.buckets[i])
+                return lower + max(part, 0.) * (upper - lower)
+            n += self.buckets[i]
+            if i < len(BUCKETS):
+                lower = BUCKETS[i]
+        return self.max
+
+def observe(name, labels, secs):
+    lock.acquire()
+    try:
+        h = histograms.get((name, labels))
+        if h == None:
+            h = histograms[(name, labels)] = Histogram()
+        h.add(secs)
+    finally:
+        lock.release()
+
+def count(name, labels, n=1):
+    lock.acquire()
+    counters[(name, labels)] = counters.get((name, labels), 0) + n
+    lock.release()
+
+def gauge(name, fn):
+    gauges[name] = fn
+
+def reset():
+    global started
+    lock.acquire()
+    histograms.clear()
+    counters.clear()
+    started = time.time()
+    lock.release()
+
+def label_str(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join([ '%s="%s"' % (k, v) for k, v in labels ]) + '}'
+
+# Counters of events are ints, counters of time (*_seconds_total) floats.
+def counter_str(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    return '%d' % value
+
+def gauge_values():
+    values = []
+    for name in sorted(gauges.keys()):
+        try:
+            for labels, value in gauges[name]():
+                values.append((name, labels, value))
+        except Exception:
+            pass                # never let a gauge break the report
+    return values
+
+# Text summary: one line per histogram, counter and gauge.
+def report():
+    lock.acquire()
+    try:
+        secs = time.time() - started
+        r = 'Statistics for the last %.1f secs (times in ms):\n' % secs
+        r += '%-62s %8s %8s %8s %8s %8s %8s %8s\n' % \
+            ('histogram', 'count', 'avg', 'p50', 'p90', 'p99', 'p999', 'max')
+        for key in sorted(histograms.keys()):
+            h = histograms[key]
+            r += '%-62s %8d %8.2f %8.2f %8.2f %8.2f %8.2f %8.2f\n' % \
+                (key[0] + label_str(key[1]), h.count,
+                 1e3 * h.sum / max(h.count, 1), 1e3 * h.quantile(0.5),
+                 1e3 * h.quantile(0.9), 1e3 * h.quantile(0.99),
+                 1e3 * h.quantile(0.999), 1e3 * h.max)
+        for key in sorted(counters.keys()):
+            r += '%-62s %8s\n' % (key[0] + label_str(key[1]),
+                                  counter_str(counters[key]))
+    finally:
+        lock.release()
+    for name, labels, value in gauge_values():
+        r += '%-62s %8s\n' % (name + label_str(labels), value)
+    r += 'End of statistics'
+    return r
+
+# Prometheus text exposition format, version 0.0.4
+def prometheus():
+    out = []
+    typed = {}
+    def header(name, kind):
+        if not typed.has_key(name):
+            typed[name] = True
+            out.append('# HELP %s %s' % (name, HELP.get(name, name)))
+            out.append('# TYPE %s %s' % (name, kind))
+    lock.acquire()
+    try:
+        for key in sorted(histograms.keys()):
+            name, labels = key
+            h = histograms[key]
+            header(name, 'histogram')
+            n = 0
+            for i in xrange(len(BUCKETS)):
+                n += h.buckets[i]
+                out.append('%s_bucket%s %d' % (name,
+                    label_str(labels, (('le', repr(BUCKETS[i])),)), n))
+            out.append('%s_bucket%s %d' % (name,
+                label_str(labels, (('le', '+Inf'),)), h.count))
+            out.append('%s_sum%s %r' % (name, label_str(labels), h.sum))
+            out.append('%s_count%s %d' % (name, label_str(labels), h.count))
+        for key in sorted(counters.keys()):
+            header(key[0], 'counter')
+            out.append('%s%s %s' % (key[0], label_str(key[1]),
+                                    counter_str(counters[key])))
+    finally:
+        lock.release()
+    for name, labels, value in gauge_values():
+        if name.endswith('_total'):
+            header(name, 'counter')
+        else:
+            header(name, 'gauge')
+        out.append('%s%s %s' % (name, label_str(labels), value))
+    return '\n'.join(out) + '\n'
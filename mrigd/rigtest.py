@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# File: rigtest.py
+# Version: 1.0
+#
+# mrigd: tests of the codecs and shared tables
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Usage: rigtest.py [-v] [TestCase[.test]]
+#
+# The pieces the rest of mrigd takes on trust, checked without a rig,
+# rigserve or pyserial: ic_codes' BCD encoding and CI-V frames, the
+# rigframe header, the rigcache TTLs, the rigstate seqlock and name
+# lookup, and rigconn's address parsing.
+
+import unittest, threading, time, socket, struct
+import ic_codes, rigframe, rigcache, rigstate, rigconn, rigstats
+from globals import *
+
+class BcdTest(unittest.TestCase):
+    def test_freq_bcd(self):
+        # 14.074 MHz, least significant byte first
+        self.assertEqual(ic_codes.freq_bcd(14074000), '\x00\x40\x07\x14\x00')
+        self.assertEqual(ic_codes.freq_bcd(7050000.), '\x00\x00\x05\x07\x00')
+
+    def test_bcd_freq(self):
+        self.assertEqual(ic_codes.bcd_freq('\x00\x40\x07\x14\x00'), 14074000)
+        self.assertEqual(ic_codes.bcd_freq('\x99\x99\x99\x99\x09'), 999999999)
+
+    def test_freq_round_trip(self):
+        for f in (0, 1, 30000, 1800000, 14074000, 145500000, 999999999):
+            self.assertEqual(ic_codes.bcd_freq(ic_codes.freq_bcd(f)), f)
+
+    def test_level_bcd(self):
+        self.assertEqual(ic_codes.level_bcd(255), '\x02\x55')
+        self.assertEqual(ic_codes.level_bcd(0), '\x00\x00')
+        self.assertEqual(ic_codes.level_bcd(9999), '\x99\x99')
+
+    def test_digits(self):
+        self.assertEqual(ic_codes.bcd4(1, 2, 3, 4), (0x12, 0x34))
+        self.assertEqual(ic_codes.bcd4r(1, 2, 3, 4), (0x34, 0x12))
+        self.assertEqual(ic_codes.bcd2(4, 2), (0x42,))
+        self.assertEqual(ic_codes.ubcd('\x42'), (4, 2))
+        self.assertEqual([ ic_codes.nib('\x12\x34', i) for i in xrange(4) ],
+                         [1, 2, 3, 4])
+
+    def test_frame(self):
+        self.assertEqual(ic_codes.frame(0x5A, (0x03,)),
+                         '\xFE\xFE\x5A\xE0\x03\xFD')
+        self.assertEqual(ic_codes.frame(0x5A, (0x14, 0x01), '\x02\x55'),
+                         '\xFE\xFE\x5A\xE0\x14\x01\x02\x55\xFD')
+
+class FrameTest(unittest.TestCase):
+    def test_header(self):
+        self.assertEqual(rigframe.HEADER.size, 9)
+        self.assertEqual(rigframe.encode(7, rigframe.ST_OK, 'abc'),
+                         struct.pack('!IIB', 3, 7, 0) + 'abc')
+
+    def test_partial(self):
+        buf = rigframe.encode(1, rigframe.ST_OK, 'freq 7050000')
+        for n in xrange(len(buf)):
+            self.assertEqual(rigframe.split_frame(buf[:n]), (None, buf[:n]))
+        self.assertEqual(rigframe.pending_length(buf[:4]), 0)
+        self.assertEqual(rigframe.pending_length(buf[:9]), 12)
+
+    def test_decode(self):
+        buf = rigframe.encode(1, rigframe.ST_OK, 'one') + \
+              rigframe.encode(2, rigframe.ST_PUSH, '') + \
+              rigframe.encode(3, rigframe.ST_NAK, 'three')
+        frames, rest = rigframe.decode(buf + buf[:5])
+        self.assertEqual(frames, [ (1, rigframe.ST_OK, 'one'),
+                                   (2, rigframe.ST_PUSH, ''),
+                                   (3, rigframe.ST_NAK, 'three') ])
+        self.assertEqual(rest, buf[:5])
+
+    def test_encode_reply(self):
+        self.assertEqual(rigframe.encode_reply(4, NAK + 'no rig'),
+                         rigframe.encode(4, rigframe.ST_NAK, 'no rig'))
+        self.assertEqual(rigframe.encode_reply(5, 7050000.0),
+                         rigframe.encode(5, rigframe.ST_OK, '7050000.0'))
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = rigcache.RigCache()
+        self.cache.set_ttl('freq', 0.5)
+
+    def test_fresh(self):
+        self.cache.store('VFOA', 'freq', '7050000', time.time())
+        reply, age = self.cache.lookup('VFOA', 'freq')
+        self.assertEqual(reply, '7050000')
+        self.assertTrue(0 <= age < 0.5)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_expired(self):
+        self.cache.store('VFOA', 'freq', '7050000', time.time() - 0.6)
+        self.assertEqual(self.cache.lookup('VFOA', 'freq'), None)
+        self.assertFalse(self.cache.fresh('VFOA', 'freq'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+    def test_not_cached(self):
+        self.cache.set_ttl('freq', 0)
+        self.cache.store('VFOA', 'freq', '7050000', time.time())
+        self.assertEqual(self.cache.lookup('VFOA', 'freq'), None)
+        self.cache.set_ttl('freq', 0.5)
+        self.cache.store('VFOA', 'freq', NAK + 'timeout', time.time())
+        self.assertEqual(self.cache.lookup('VFOA', 'freq'), None)
+        self.cache.set_enabled(False)
+        self.cache.store('VFOA', 'freq', '7050000', time.time())
+        self.assertEqual(self.cache.lookup('VFOA', 'freq'), None)
+        self.assertEqual((self.cache.misses, self.cache.bypassed), (1, 2))
+
+    def test_invalidate(self):
+        now = time.time()
+        self.cache.store('MAIN', 'rx_mode', 'USB', now)
+        self.cache.store('MAIN', 'bandpass', '0 2400', now)
+        self.cache.store('VFOA', 'freq', '7050000', now)
+        self.cache.invalidate('rx_mode')    # and RELATED: bandpass
+        self.assertEqual(self.cache.lookup('MAIN', 'bandpass'), None)
+        self.assertEqual(self.cache.lookup('VFOA', 'freq')[0], '7050000')
+        self.cache.invalidate('init')
+        self.assertEqual(self.cache.lookup('VFOA', 'freq'), None)
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.table = rigstate.StateTable(nslots=8)
+
+    def test_publish(self):
+        self.assertTrue(self.table.publish('r1.VFOA.freq', 7050000.0))
+        value, age = self.table.read('r1.VFOA.freq')
+        self.assertEqual(value, '7050000.0')
+        self.assertTrue(age >= 0)
+        self.assertEqual(self.table.read('r1.VFOA.freq', -1), None)
+        self.assertFalse(self.table.publish('r1.VFOA.freq', 'x' * 200))
+
+    def test_expire_drop(self):
+        self.table.publish('r1.MAIN.rx_mode', 'USB')
+        self.table.publish('r2.MAIN.rx_mode', 'LSB')
+        self.table.expire('r1', ['rx_mode'])
+        self.assertEqual(self.table.read('r1.MAIN.rx_mode'), None)
+        self.table.drop('r2')
+        self.assertEqual(self.table.read('r2.MAIN.rx_mode'), None)
+        self.assertEqual(len(self.table.free), 7)
+
+    def test_being_written(self):
+        self.table.publish('r1.VFOA.freq', '7050000')
+        i = self.table.slots['r1.VFOA.freq']
+        off = self.table.offset(i)
+        seq = rigstate.SEQ.unpack_from(self.table.mm, off)[0]
+        rigstate.SEQ.pack_into(self.table.mm, off, seq + 1)
+        self.assertEqual(self.table.read_slot(i), None)
+        rigstate.SEQ.pack_into(self.table.mm, off, seq)
+        self.assertEqual(self.table.read_slot(i)[1:], ('r1.VFOA.freq', '7050000'))
+
+    def test_no_torn_reads(self):
+        values = ('A' * 100, 'B' * 10)
+        done = []
+        def writer():
+            for n in xrange(20000):
+                self.table.publish('r1.VFOA.freq', values[n % 2])
+            done.append(True)
+        t = threading.Thread(target=writer)
+        t.start()
+        while not done:
+            read = self.table.read('r1.VFOA.freq')
+            if read != None:
+                self.assertTrue(read[0] in values)
+        t.join()
+
+    def test_new_names(self):
+        gen = self.table.generation()
+        self.assertEqual(self.table.read('r1.VFOA.freq'), None)
+        self.assertEqual(self.table.missing, {'r1.VFOA.freq': gen})
+        self.table.publish('r1.VFOA.freq', '7050000')
+        self.assertNotEqual(self.table.generation(), gen)
+        self.assertEqual(self.table.read('r1.VFOA.freq')[0], '7050000')
+        self.table.publish('r1.VFOA.freq', '7060000')
+        self.assertEqual(self.table.read('r1.VFOA.freq')[0], '7060000')
+        self.table.drop('r1')
+        self.table.publish('r2.VFOA.freq', '3500000')   # takes the slot
+        self.assertEqual(self.table.read('r1.VFOA.freq'), None)
+        self.assertEqual(self.table.read('r2.VFOA.freq')[0], '3500000')
+
+class HistogramTest(unittest.TestCase):
+    def test_quantile(self):
+        h = rigstats.Histogram()
+        self.assertEqual(h.quantile(0.5), 0.)
+        for i in xrange(100):
+            h.add(0.002)                # bucket 0.001 - 0.0025
+        self.assertAlmostEqual(h.quantile(0.5), 0.0015)
+        self.assertAlmostEqual(h.quantile(1.), 0.002)
+        h.add(10.)                      # past the last bucket
+        self.assertAlmostEqual(h.quantile(1.), 10.)
+        self.assertTrue(0.001 <= h.quantile(0.99) <= 0.0025)
+
+class AddrTest(unittest.TestCase):
+    def test_parse_addr(self):
+        self.assertEqual(rigconn.parse_addr('127.0.0.1:14652'),
+                         (socket.AF_INET, ('127.0.0.1', 14652)))
+        self.assertEqual(rigconn.parse_addr('unix:/tmp/rigserve.sock'),
+                         (socket.AF_UNIX, '/tmp/rigserve.sock'))
+        self.assertEqual(rigconn.parse_addr('localhost:80'),
+                         (socket.AF_INET, ('localhost', 80)))
+        self.assertRaises(ValueError, rigconn.parse_addr, 'localhost')
+        self.assertRaises(ValueError, rigconn.parse_addr, 'localhost:http')
+
+    def test_unix_paths(self):
+        self.assertTrue(rigconn.is_unix('unix:/tmp/simple.sock'))
+        self.assertFalse(rigconn.is_unix('127.0.0.1:14653'))
+        self.assertEqual(rigconn.sync_path('/tmp/simple.sock', 14654),
+                         '/tmp/simple.sock.14654')
+        self.assertNotEqual(rigconn.client_path('/tmp/simple.sock'),
+                            '/tmp/simple.sock')
+        self.assertNotEqual(rigconn.client_path('/tmp/simple.sock'),
+                            rigconn.client_path('/tmp/simple.sock'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# File: rigtrace.py
+# Version: 1.0
+#
+# mrigd: per-request tracing across mrig, the services and rigserve
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# A trace follows one operation (e.g. a knob turned in mrig) through
+# every hop on its way to the rig.  Each hop marks a named stage with
+# the time it got there; the stages of one trace, in time order, give
+# the latency of each hop.
+#
+# The trace id and the stages marked so far travel with the request:
+#
+#   simple protocol:    "trace: <id>;mrig.send=<t>" before the feature
+#                       lines it applies to
+#   rigserve protocol:  "@<id>;mrig.send=<t>;simple.recv=<t> <command>"
+#
+# rigserve takes the stages a request carries, adds its own (recv,
+# worker, backend:<method>, reply) and keeps the lot in a ring buffer of
+# the last RING_SIZE stages.  A hop that comes after the reply (e.g. the
+# simple service syncing its clients) is added with "trace mark".
+# "trace" shows the last traces hop by hop; "trace save <file>" writes
+# the raw stages out.
+#
+# Times are wall clock secs (time.time()), so that they compare across
+# processes.  For a hop between two hosts the latency shown includes
+# the difference between their clocks.
+
+import time, random, threading, collections
+
+RING_SIZE   = 4096      # stages kept
+TRACE_PREFIX = '@'
+
+ring = collections.deque(maxlen=RING_SIZE)  # (trace id, stage, time)
+lock = threading.Lock()
+
+# The traces of the request a worker thread is running, if any (several
+# for puts coalesced into one, see rigserve.py).
+current = threading.local()
+
+def new_id():
+    return '%08x' % random.getrandbits(32)
+
+def mark(trace_id, stage, t=None):
+    if t == None:
+        t = time.time()
+    lock.acquire()
+    ring.append((trace_id, stage, t))
+    lock.release()
+
+def mark_current(stage):
+    for trace_id in getattr(current, 'ids', ()):
+        mark(trace_id, stage)
+
+def clear():
+    lock.acquire()
+    ring.clear()
+    lock.release()
+
+# ------- Carrying a trace in a request ---------
+
+# "<id>;stage=t;..." -> (id, [(stage, t)]), or (None, []) if malformed.
+def parse_token(token):
+    split = token.split(';')
+    trace_id = split[0]
+    if trace_id == '':
+        return None, []
+    stages = []
+    for s in split[1:]:
+        try:
+            stage, t = s.split('=', 1)
+            stages.append((stage, float(t)))
+        except ValueError:
+            return None, []
+    return trace_id, stages
+
+def make_token(trace_id, stages=()):
+    return ';'.join([ trace_id ] +
+                    [ '%s=%.6f' % (stage, t) for stage, t in stages ])
+
+# Split a rigserve request "@<token> <command>" into (trace id, carried
+# stages, command).  An untraced request gives (None, [], request).
+def untag(line):
+    if not line.startswith(TRACE_PREFIX):
+        return None, [], line
+    split = line[len(TRACE_PREFIX):].split(None, 1)
+    if not split:
+        return None, [], ''
+    trace_id, stages = parse_token(split[0])
+    if trace_id == None:
+        return None, [], line
+    if len(split) == 1:
+        return trace_id, stages, ''
+    return trace_id, stages, split[1]
+
+def tag(trace_id, cmd, stages=()):
+    return TRACE_PREFIX + make_token(trace_id, stages) + ' ' + cmd
+
+# ------- Reading the ring ---------
+
+# {trace id: [(time, stage)]} and the ids in order of their first stage.
+def collect():
+    lock.acquire()
+    records = list(ring)
+    lock.release()
+    traces = {}
+    order = []
+    for trace_id, stage, t in records:
+        if not traces.has_key(trace_id):
+            traces[trace_id] = []
+            order.append(trace_id)
+        traces[trace_id].append((t, stage))
+    for trace_id in order:
+        traces[trace_id].sort()
+    return traces, order
+
+# The last 'last' traces, each one hop by hop, as text.
+def report(last=20):
+    traces, order = collect()
+    r = ''
+    for trace_id in order[-last:]:
+        stages = traces[trace_id]
+        t0 = stages[0][0]
+        r += 'trace %s: %d stages, %.3f ms, started %s\n' % \
+            (trace_id, len(stages), (stages[-1][0] - t0) * 1e3,
+             time.strftime('%H:%M:%S', time.localtime(t0)))
+        prev = t0
+        for t, stage in stages:
+            r += '    %-32s %+10.3f ms %10.3f ms\n' % \
+                (stage, (t - prev) * 1e3, (t - t0) * 1e3)
+            prev = t
+    if r == '':
+        return 'no traces.'
+    return r + 'End of trace list'
+
+# Write the stages of the last 'last' traces to 'path', one per line:
+# "<trace id> <stage> <time>".  Returns the number of stages written.
+def save(path, last=None):
+    traces, order = collect()
+    if last != None:
+        order = order[-last:]
+    f = open(path, 'w')
+    n = 0
+    try:
+        for trace_id in order:
+            for t, stage in traces[trace_id]:
+                f.write('%s %s %.6f\n' % (trace_id, stage, t))
+                n += 1
+    finally:
+        f.close()
+    return n
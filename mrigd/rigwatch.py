@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# File: rigwatch.py
+# Version: 1.0
+#
+# mrigd: server-push subscriptions ("watch") for rigserve
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# A Watch is one watched rig feature, e.g. rig1.MAIN.strength_raw.  It
+# reads the feature once per tick, however many clients watch it, and
+# pushes the value to each of them:
+#
+#   - every 'interval' seconds, for an interval subscriber, or
+#   - whenever it changes, for an on-change subscriber.
+#
+# The tick is the shortest interval asked for (CHANGE_POLL for on-change
+# subscribers).  A new read is never started while one is in flight, so
+# a slow rig is read back to back, not queued up.
+#
+# In text mode the pushed lines look like "WATCH rig1.MAIN.strength_raw 57".
+
+import time
+from globals import *
+
+WATCH_PREFIX = 'WATCH'
+CHANGE_POLL  = 0.1      # secs between reads for on-change subscribers
+MIN_INTERVAL = 0.02     # shortest interval a client may ask for
+
+# 'interval' argument of the watch command -> secs, None for on-change.
+# Raises ValueError if it is neither.
+def parse_interval(s):
+    if s in ('on-change', 'change'):
+        return None
+    secs = float(s)
+    if secs < MIN_INTERVAL:
+        raise ValueError(s)
+    return secs
+
+class Watch(object):
+    # 'read(done)' starts a read of the feature; done(value) must be
+    # called in the loop thread.  Subscribers need a push(name, value)
+    # method.
+    def __init__(self, loop, name, read):
+        self.loop = loop
+        self.name = name
+        self.read = read
+        self.subs = {}          # subscriber:[interval, next due, last sent]
+        self.timer = None
+        self.reading = False
+        self.started = 0.
+        self.reads = 0
+
+    def add(self, sub, interval):
+        self.subs[sub] = [interval, 0., None]
+        if not self.reading:
+            self.schedule(0.)   # first value at once
+
+    def remove(self, sub):
+        if self.subs.has_key(sub):
+            del self.subs[sub]
+        if not self.subs:
+            self.loop.cancel(self.timer)
+            self.timer = None
+
+    def period(self):
+        p = None
+        for interval, due, last in self.subs.values():
+            if interval == None:
+                interval = CHANGE_POLL
+            if p == None or interval < p:
+                p = interval
+        return p
+
+    def schedule(self, delay):
+        self.loop.cancel(self.timer)
+        self.timer = self.loop.call_later(delay, self.tick)
+
+    def tick(self):
+        self.timer = None
+        if self.reading or not self.subs:
+            return
+        self.reading = True
+        self.started = time.time()
+        self.reads += 1
+        self.read(self.got)
+
+    def got(self, value):
+        self.reading = False
+        if not self.subs:
+            return
+        now = time.time()
+        value = str(value)
+        slack = self.period() / 2
+        for sub, state in self.subs.items():
+            interval, due, last = state
+            if interval == None:
+                send = value != last
+            else:
+                send = now >= due - slack
+                if send:
+                    state[1] = due + interval
+                    if state[1] < now:      # late (or the first value)
+                        state[1] = now + interval
+            if send:
+                state[2] = value
+                sub.push(self.name, value)
+        self.schedule(max(0., self.started + self.period() - now))
+
+    # The feature is gone (rig closed): tell the subscribers, stop.
+    def close(self, reason):
+        for sub in self.subs.keys():
+            sub.push(self.name, NAK + reason)
+        self.subs = {}
+        self.loop.cancel(self.timer)
+        self.timer = None
+
+    def status(self):
+        n_change = len([ s for s in self.subs.values() if s[0] == None ])
+        return '%s: %d watching (%d on change), every %gs, %d reads' % \
+            (self.name, len(self.subs), n_change, self.period(), self.reads)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# File: rigworker.py
+# Version: 1.0
+#
+# mrigd: per-rig I/O worker threads for rigserve
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Every opened rig gets a RigWorker: a thread that owns the rig's port
+# and runs all of its backend calls, one at a time, from a request queue.
+# The network side only enqueues and gets the result back later, so a
+# blocking serial read on one rig never delays the clients of another.
+#
+# The queue is split into priority classes, and the highest class with
+# anything queued goes first:
+#
+#   P_PTT    transmit on/off: never waits for anything else queued
+#   P_WRITE  other puts
+#   P_READ   gets asked for by a client
+#   P_POLL   background polling (watches, polling services)
+#
+# So a PTT waits at most for the one call the rig is busy with, however
+# many pollers there are.  Starvation guard: below P_PTT, a call that has
+# been passed over for STARVE_AFTER secs goes before the higher classes.
+#
+# Classes only order the calls of different owners (client connections).
+# The calls of one owner run in the order they were queued: when a call
+# is chosen, the owner's earliest queued call, if another, runs first.
+# So a connection's PTT pulls its own earlier gets ahead with it, and a
+# get never sees the result of a put its connection sent after it.
+
+import threading, collections, traceback, time
+from globals import *
+import rigstats
+
+P_PTT, P_WRITE, P_READ, P_POLL = range(4)
+PRIO_NAMES  = ('ptt', 'write', 'read', 'poll')
+STARVE_AFTER = 0.5      # secs a call may be passed over
+USE_PRIORITY = True     # False: one queue, first in first out (rigbench)
+
+class RigWorker(threading.Thread):
+    # 'post(done, result)' delivers results; by default 'done' is called
+    # in the worker thread itself.
+    def __init__(self, rig_name, post=None):
+        threading.Thread.__init__(self, name='rig-%s' % rig_name)
+        self.setDaemon(True)
+        self.rig_name = rig_name
+        self.labels = (('rig', rig_name),)
+        self.post = post
+        self.cond = threading.Condition()
+        self.queues = [ collections.deque() for p in PRIO_NAMES ]
+        self.owners = {}        # owner: deque of its queued jobs, in order
+        self.stopping = False
+        self.start()
+
+    def run(self):
+        while True:
+            job = self.next_job()
+            if job == None:
+                break                   # stopped
+            fn, args, done, queued, prio, owner = job
+            rigstats.observe('rigserve_queue_wait_seconds',
+                             self.labels + (('prio', PRIO_NAMES[prio]),),
+                             time.time() - queued)
+            result = self.execute(fn, args)
+            if done:
+                if self.post:
+                    self.post(done, result)
+                else:
+                    done(result)
+
+    # Wait for the next call to run, None once stopped and drained.
+    def next_job(self):
+        self.cond.acquire()
+        try:
+            while True:
+                prio = self.choose()
+                if prio != None:
+                    return self.take(self.queues[prio][0])
+                if self.stopping:
+                    return None
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    # The class to serve next, None if all are empty.
+    def choose(self):
+        first = None
+        starved = None
+        oldest = time.time() - STARVE_AFTER
+        for prio in xrange(len(self.queues)):
+            queue = self.queues[prio]
+            if not queue:
+                continue
+            if prio == P_PTT:
+                return prio
+            if first == None:
+                first = prio
+            if queue[0][3] < oldest:
+                starved = prio
+                oldest = queue[0][3]
+        if starved != None and starved != first:
+            rigstats.count('rigserve_starved_total',
+                           self.labels + (('prio', PRIO_NAMES[starved]),))
+            return starved
+        return first
+
+    # Take 'job' off the queues, or its owner's earliest job if another.
+    def take(self, job):
+        owner = job[5]
+        if owner != None:
+            jobs = self.owners[owner]
+            job = jobs.popleft()
+            if not jobs:
+                del self.owners[owner]
+        queue = self.queues[job[4]]
+        if queue[0] is job:
+            queue.popleft()
+        else:
+            queue.remove(job)
+        return job
+
+    def execute(self, fn, args):
+        try:
+            return fn(*args)
+        except Exception, e:
+            traceback.print_exc()
+            return NAK + 'Internal error in rig %s: %s' % (self.rig_name, e)
+
+    def put(self, job):
+        if not USE_PRIORITY:
+            job = job[:4] + (P_READ,) + job[5:]
+        self.cond.acquire()
+        self.queues[job[4]].append(job)
+        if job[5] != None:
+            self.owners.setdefault(job[5], collections.deque()).append(job)
+        self.cond.notify()
+        self.cond.release()
+        return job
+
+    # Queue fn(*args); done(result) is called when it has run.  The jobs
+    # of one 'owner' (None: no order kept) run in the order queued.
+    # Returns the job, for last_queued().
+    def submit(self, fn, args, done=None, prio=P_READ, owner=None):
+        return self.put((fn, args, done, time.time(), prio, owner))
+
+    # The job 'owner' queued last and that has not started, None if none.
+    def last_queued(self, owner):
+        self.cond.acquire()
+        try:
+            jobs = self.owners.get(owner)
+            if jobs:
+                return jobs[-1]
+            return None
+        finally:
+            self.cond.release()
+
+    # Run fn(*args) in the worker and wait for the result.  Called from
+    # the worker itself (e.g. a command running there), it runs at once.
+    def call(self, prio, fn, *args):
+        if threading.currentThread() is self:
+            return fn(*args)
+        event = threading.Event()
+        box = []
+        def done(result):
+            box.append(result)
+            event.set()
+        self.put((fn, args, done, time.time(), prio, None))
+        event.wait()
+        return box[0]
+
+    # Finish the queued jobs, then end the thread.
+    def stop(self):
+        self.cond.acquire()
+        self.stopping = True
+        self.cond.notify()
+        self.cond.release()
+
+    def pending(self, prio=None):
+        if prio != None:
+            return len(self.queues[prio])
+        return sum([ len(queue) for queue in self.queues ])
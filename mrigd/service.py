@@ -23,6 +23,11 @@
 
 
 from globals import *
+import multiprocessing, time
+
+# A service is ready once it is listening and connected to whatever it
+# needs (usually rigserve).  Services running in a child process set
+# 'self.ready' from there; the base class is ready as soon as it starts.
 
 class Service(object):
     def __init__(self, rig_name):
@@ -30,9 +35,11 @@ class Service(object):
         self.__running = False
         self.rig_name = rig_name
         self.args = ""
+        self.ready = multiprocessing.Event()
 
     def start_action(self, args):
         self.args = args
+        self.ready.set()
         return ACK
 
     def stop_action(self):
@@ -43,6 +50,7 @@ class Service(object):
             return NAK + "Already running."
         else:
             self.__running = True
+            self.ready.clear()
             return self.start_action(args)
 
     def stop(self):
@@ -54,3 +62,16 @@ class Service(object):
 
     def status(self):
         return str(self.__running)
+
+    # Wait up to 'timeout' secs for the service to be ready.  False if it
+    # is not running, or stops while we wait.
+    def wait_ready(self, timeout):
+        deadline = time.time() + timeout
+        while not self.ready.is_set():
+            if not "TRUE" in self.status().upper():
+                return False
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            self.ready.wait(min(left, 0.05))
+        return True
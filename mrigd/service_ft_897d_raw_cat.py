@@ -29,6 +29,7 @@ from socket import *
 from time import *
 from globals import *
 from signal import *
+import rigconn
 
 class Service_FT_897d_Raw_CAT(Service):
     def __init__(self, rig_name):
@@ -40,16 +41,16 @@ class Service_FT_897d_Raw_CAT(Service):
         self.__rig_name = rig_name
         self.__terminating = False
         self.__rigserve = None
+        self.__pending = None
         self.description = "basic 3rd-party software (such as Pocket RxTX for Android) compatibility support"
 
     def send_raw_cat(self, value):
         request = "put " + self.__rig_name + ".CONTROL.raw_cat " + value
         print "3rd party request: " + request
-        self.__rigserve.sendall(request)
+        self.__pending = self.__rigserve.submit(request)
 
     def recv(self):
-        response = self.__rigserve.recv(10240)
-        response = response[:-1]
+        response = self.__pending.result()
         print "3rd party response: " + response
         return response
 
@@ -77,39 +78,19 @@ class Service_FT_897d_Raw_CAT(Service):
     def __target(self):
         signal(SIGTERM, self.__sigterm_handler)
 
-        PORT = 14652
-        self.__rigserve = socket(AF_INET, SOCK_STREAM)
-        self.__rigserve.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
-        counter = 0
-        while True:
-            try:
-               counter = counter + 1
-               self.__rigserve.connect(('127.0.0.1', PORT))
-               if len(self.__rigserve.recv(8192)) == 0:
-                   raise IOException
-               break
-            except:
-               if counter < 65:
-                   sleep(1)
-               else:
-                   print "3rd party compat. service: cannot connect to main rigserve server, exiting."
-                   exit(1)
+        self.__rigserve = rigconn.Client(connect_timeout=65)
+        try:
+            self.__rigserve.connect()
+        except (error, EOFError, IOError):
+            print "3rd party compat. service: cannot connect to main rigserve server, exiting."
+            exit(1)
 
         listen_socket = socket(AF_INET, SOCK_STREAM)
-        is_done = False
-        tries = 0
-        while not is_done and tries < 65:
-            tries = tries + 1
-            try:
-                listen_socket.bind((self.__parsed_args["listen_addr"], int(self.__parsed_args["listen_tcp_port"])))
-                is_done = True
-            except:
-                is_done = False
-                sleep(1)
-        if not is_done:
+        if not rigconn.bind(listen_socket, (self.__parsed_args["listen_addr"], int(self.__parsed_args["listen_tcp_port"])), 65):
             return
 
         listen_socket.listen(5)
+        self.ready.set()
 
         clients = []
         buffers_dict = {}
@@ -160,7 +141,6 @@ class Service_FT_897d_Raw_CAT(Service):
                     client.close()
 
         listen_socket.close()
-        self.__rigserve.send("quit")
         self.__rigserve.close()
 
     def start_action(self, args):
@@ -176,6 +156,7 @@ class Service_FT_897d_Raw_CAT(Service):
                     current_val = split2[1]
                     self.__parsed_args[current_key] = current_val
 
+        self.ready.clear()          # set by the service process
         self.__process = Process(target=self.__target, args=())
         self.__process.daemon = True
         self.__process.start()
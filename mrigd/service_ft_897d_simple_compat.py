@@ -27,8 +27,6 @@ import service
 import multiprocessing
 import globals
 import signal
-import service_ft_897d_simple_compat_low_latency
-import service_ft_897d_simple_compat_high_latency
 
 
 class Service_FT_897d_Simple_Compat(service.Service):
@@ -43,7 +41,6 @@ class Service_FT_897d_Simple_Compat(service.Service):
         self.__rig_name = rig_name
         self.__terminating = False
         self.__rigserve = None
-        self.rigserve_port = 14652
         self.description = "UNSTABLE - supports the basic protocol"
 
 
@@ -61,15 +58,19 @@ class Service_FT_897d_Simple_Compat(service.Service):
                     self.__parsed_args[current_key] = current_val
 
 
+        # the servers are imported here, so a missing one (the low latency
+        # server is not in this tree) only fails the latency asking for it
         try:
             if "latency" in self.__parsed_args:
                 latency = self.__parsed_args["latency"]
             else:
                 return globals.NAK + "latency unspecified"
             if latency.upper() == "LOW":
+                import service_ft_897d_simple_compat_low_latency
                 server = service_ft_897d_simple_compat_low_latency.server(self.__rig_name)
             elif latency.upper() == "HIGH":
                 return globals.NAK + "high latency server is broken... sorry!"
+                import service_ft_897d_simple_compat_high_latency
                 server = service_ft_897d_simple_compat_high_latency.server(self.__rig_name)
             else:
                 return globals.NAK + "latency must be high or low"
@@ -81,6 +82,8 @@ class Service_FT_897d_Simple_Compat(service.Service):
             my_arg = arg + "=" + self.__parsed_args[arg]
             my_args.append(my_arg)
 
+        self.ready.clear()
+        server.ready = self.ready   # set by the server process when ready
         self.__process = multiprocessing.Process(target=server.target, args=(my_args))
         self.__process.daemon = True
         self.__process.start()
@@ -35,6 +35,9 @@ import datetime
 import os
 import time
 import random
+import rigconn
+import rigstate
+import rigtrace
 
 
 class server():
@@ -45,9 +48,11 @@ class server():
         self.__client_is_done = False
         self.__rigserve = None
         self.__clients = None
+        self.__sync_addrs = { }     # client: where its syncs are sent
         self.__udp_socket = None
-        self.rigserve_port = 14652
+        self.ready = None           # multiprocessing.Event, set when serving
         self.__remote_udp_port = None
+        self.__traces = [ ]         # [(trace id, stages)] sent by clients this tick
 
         self.complex_ttl = 15
         self.long_ttl    = 6
@@ -295,11 +300,19 @@ class server():
             sync_str = sync_str.replace("<vfo>", self.__vfo)
             sync_strs.append(sync_str)
 
-        for sync_str in sync_strs:
-            self.__rigserve.sendall(sync_str)
-            response = self.__rigserve.recv(8192)
-            if globals.is_nak(response):
-                print "simple_server: warning: sync " + sync_str + " not applied to radio, received " + response
+        # one round trip for all the syncs; the first traced change
+        # of the tick (if any) is traced through rigserve
+        trace = None
+        if self.__traces:
+            trace_id, stages = self.__traces[0]
+            trace = (trace_id, stages + [("simple.sync", time.time())])
+        if sync_strs:
+            responses = self.__rigserve.batch(sync_strs, trace=trace)
+            if trace:
+                self.__traces[0] = (trace[0], [("simple.batch_done", time.time())])
+            for i in range(len(sync_strs)):
+                if globals.is_nak(responses[i]):
+                    print "simple_server: warning: sync " + sync_strs[i] + " not applied to radio, received " + responses[i]
 
         #for int_f in syncs:
         #    if not self.__metadata["internal"]["radio"][int_f]["readable"]:
@@ -328,7 +341,11 @@ class server():
 
             for line in lines:
                 spl = line.split(": ", 1)
-                if len(spl) > 1:
+                if len(spl) > 1 and spl[0] == "trace":
+                    trace_id, stages = rigtrace.parse_token(spl[1])
+                    if trace_id != None:
+                        self.__traces.append((trace_id, stages + [("simple.recv", time.time())]))
+                elif len(spl) > 1:
                     f  = spl[0]
                     v  = spl[1]
                     timestamp = datetime.datetime.utcnow()   # now
@@ -384,7 +401,7 @@ class server():
             last_read  = self.__state["current"]["external"]["radio"][f]["timestamp"]
             ttl        = self.__metadata["external"]["radio"][f]["ttl"]
             if last_read == None:
-                response = self.__get_radio(f)
+                response = self.__get_radio(f, self.__metadata["external"]["radio"][f]["ttl"])
                 if not globals.is_nak(response):
                     self.__state["current"]["external"]["radio"][f]["value"] = response
                     self.__state["current"]["external"]["radio"][f]["timestamp"]  = now                
@@ -412,7 +429,8 @@ class server():
 
         # poll
         if chosen_feature != None:
-            response = self.__get_radio(chosen_feature)
+            ttl = self.__metadata["external"]["radio"][chosen_feature]["ttl"]
+            response = self.__get_radio(chosen_feature, ttl / 2.0)
             if globals.is_nak(response):
                 self.__state["current"]["external"]["radio"][chosen_feature]["value"] = "?"
             else:
@@ -422,13 +440,16 @@ class server():
         self.__external_to_internal_current_radio_state()
 
 
-    def __get_radio(self, ext_f):
+    # A value read by rigserve in the last 'max_age' secs (for us or for
+    # anybody else) is taken from the shared state table, without asking.
+    def __get_radio(self, ext_f, max_age=None):
         command = "get " + self.__rig_name + "." + ext_f
         command = command.replace("<vfo>", self.__vfo)
-        self.__rigserve.sendall(command)
-        response = self.__rigserve.recv(8192)
-        response = response.splitlines()[0]   # remove tailing end-of-line, if any
-        return response
+        if max_age != None:
+            cached = rigstate.read(command[4:], max_age)
+            if cached != None:
+                return cached[0]
+        return self.__rigserve.command(command)
 
 
     def __external_to_internal_current_radio_state(self):
@@ -607,9 +628,23 @@ class server():
             self.__state["current"]["external"][c][f]  =  {"value": None, "timestamp": None, "ttl": None}
             self.__state["old"]["internal"][c][f]      =  {"value": None, "timestamp": None, "ttl": None}
             self.__state["old"]["external"][c][f]      =  {"value": None, "timestamp": None, "ttl": None}
+        self.__sync_addrs[c] = self.__sync_addr(c)
         self.__clients.append(c)
 
 
+    # Syncs go to the client's own IP address, or for a Unix client to the
+    # datagram socket next to the path it connected from.  A Unix client
+    # that did not bind one gets them next to our path (there can only be
+    # one such client).
+    def __sync_addr(self, c):
+        if c.family == socket.AF_UNIX:
+            path = c.getpeername()
+            if not path:
+                path = c.getsockname()
+            return rigconn.sync_path(path, self.__remote_udp_port)
+        return (c.getpeername()[0], self.__remote_udp_port)
+
+
     def __remove_client(self, c):
         try:
             c.close()
@@ -619,29 +654,34 @@ class server():
         del self.__state["current"]["external"][c]
         del self.__state["old"]["internal"][c]
         del self.__state["old"]["external"][c]
+        del self.__sync_addrs[c]
         self.__clients.remove(c)
 
 
+    def __report_traces(self):
+        # the clients are synced: hand the rest of each trace to rigserve,
+        # which keeps them all (see rigtrace.py)
+        now = time.time()
+        for trace_id, stages in self.__traces:
+            token = rigtrace.make_token(trace_id, stages + [("simple.synced", now)])
+            response = self.__rigserve.command("trace mark " + token.replace(";", " "))
+            if globals.is_nak(response):
+                print "simple_server: warning: cannot record trace " + trace_id + ": " + response
+        self.__traces = [ ]
+
+
     def __sigterm_handler(self, signalnum, frame):
         self.__terminating = True
 
 
     def __connect_to_rigserve(self):
-        self.__rigserve = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        counter = 0
-        while True:
-            try:
-               counter = counter + 1
-               self.__rigserve.connect(('127.0.0.1', self.rigserve_port))
-               break
-            except:
-               if counter < 65:
-                   sleep(1)
-               else:
-                   print "Simple compat. service: cannot connect to main rigserve server, exiting."
-                   exit(1)
-
-        self.__rigserve.recv(1024)    # Welcome message
+        # our gets are polling: interactive clients go first
+        self.__rigserve = rigconn.Client(setup=["priority poll"], connect_timeout=65)
+        try:
+            self.__rigserve.connect()
+        except (socket.error, EOFError, IOError):
+            print "Simple compat. service: cannot connect to main rigserve server, exiting."
+            exit(1)
 
 
     def __write_expired_non_readable_radio_features(self):
@@ -659,9 +699,9 @@ class server():
                         value = str(self.__state["current"]["internal"]["radio"][int_f]["value"])
                         writes_dict[int_f] = "put " + self.__rig_name + ".CONTROL.rit " + value
 
-        for w in writes_dict:
-            self.__rigserve.sendall(writes_dict[w])
-            response = self.__rigserve.recv(8192)
+        pending = [ (w, self.__rigserve.submit(writes_dict[w])) for w in writes_dict ]
+        for w, future in pending:
+            response = future.result()
             if globals.is_nak(response):
                 print "simple_server: warning: cannot write " + w + ": " + response
             else:
@@ -693,32 +733,33 @@ class server():
         listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listen_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        is_done = False
-        tries = 0
-        while not is_done and tries < 65:
-            tries = tries + 1
-            try:
-                listen_socket.bind((self.__parsed_args["listen_addr"], int(self.__parsed_args["listen_tcp_port"])))
-                is_done = True
-            except:
-                is_done = False
-                time.sleep(1)
-        if not is_done:
+        if not rigconn.bind(listen_socket, (self.__parsed_args["listen_addr"], int(self.__parsed_args["listen_tcp_port"])), 65):
             return
 
         listen_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         listen_socket.listen(5)
         listen_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        listeners = [listen_socket]
+
+        # local clients (hamlib) may come over a Unix socket instead
+        if self.__parsed_args.get("listen_unix"):
+            unix_socket = rigconn.listen(rigconn.UNIX_PREFIX + self.__parsed_args["listen_unix"], 65)
+            if unix_socket == None:
+                return
+            listeners.append(unix_socket)
 
         self.__connect_to_rigserve()
+        if self.ready:
+            self.ready.set()        # listening and connected: tell rigserve
         self.__udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__unix_udp_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
         # self.__udp_socket.bind((self.__parsed_args["listen_addr"], self.__parsed_args["listen_udp_port"]))
         self.__clients = [ ]
 
         start = datetime.datetime.utcnow()
         while not self.__terminating:
             # discover which clients need attention
-            selected = [listen_socket]
+            selected = listeners[:]
             for client in self.__clients:
                 selected.append(client)
 
@@ -733,12 +774,14 @@ class server():
 
             # accept any new client
             new_clients = [ ]
-            if listen_socket in r:
-                [new_socket, new_addr] = listen_socket.accept()
-                new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for l in listeners:
+                if not l in r:
+                    continue
+                [new_socket, new_addr] = l.accept()
+                if new_socket.family == socket.AF_INET:
+                    new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 new_socket.setblocking(1)
                 new_socket.settimeout(self.client_timeout)
-                new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 self.__add_client(new_socket)
                 new_clients.append(new_socket)
 
@@ -760,7 +803,7 @@ class server():
             for client in self.__clients:
                 client_diffs[client] = { }
             for client in r:
-                if not client is listen_socket:
+                if not client in listeners:
                     # read from client
                     try:
                         self.__read_current_client_state(client)
@@ -833,9 +876,16 @@ class server():
                 v = self.__state["current"]["internal"]["radio"][f]["value"]
                 full_sync_str += f + ": " + v + "\n"
             for c in self.__clients:
-                ip = c.getsockname()[0]
-                port = self.__remote_udp_port
-                self.__udp_socket.sendto(full_sync_str, (ip, port))
+                if c.family == socket.AF_UNIX:
+                    try:
+                        self.__unix_udp_socket.sendto(full_sync_str, self.__sync_addrs[c])
+                    except socket.error:
+                        pass    # client not listening (yet): like UDP
+                    continue
+                self.__udp_socket.sendto(full_sync_str, self.__sync_addrs[c])
+
+            if self.__traces:
+                self.__report_traces()
 
             self.__tick = self.__tick + 1
 
@@ -852,8 +902,9 @@ class server():
         for c in self.__clients:
             self.__remove_client(c)
 
-        listen_socket.close()
-        self.__rigserve.send("quit")
+        for l in listeners:
+            l.close()
         self.__rigserve.close()
         self.__udp_socket.close()
+        self.__unix_udp_socket.close()
 
@@ -32,6 +32,7 @@ from time import *
 from globals import *
 from signal import *
 import traceback
+import rigconn
 
 class Service_Hamlib_Compat(Service):
     def __init__(self, rig_name):
@@ -467,39 +468,31 @@ class Service_Hamlib_Compat(Service):
             print "Hamlib compat. service with cache: invalid simple server data, exiting."
             return
 
-        self.__to_simple = socket(AF_INET, SOCK_STREAM)
-        self.__to_simple.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
-        self.__from_simple = socket(AF_INET, SOCK_DGRAM)
-        self.__from_simple.bind((from_simple_if, simple_local_udp_port))
-        counter = 0
-        while True:
-            try:
-               counter = counter + 1
-               self.__to_simple.connect((simple_addr, simple_tcp_port))
-               break
-            except:
-               if counter < 65:
-                   sleep(1)
-               else:
-                   print "Hamlib compat. service with cache: cannot connect to simple server, exiting."
-                   exit(1)
+        # simple_addr=unix:/path: simple's Unix socket.  We connect to it
+        # from a path of our own, and its syncs come to a Unix datagram
+        # socket next to that path (see rigconn.py)
+        local_path = None
+        if rigconn.is_unix(simple_addr):
+            local_path = rigconn.client_path(simple_addr[len(rigconn.UNIX_PREFIX):])
+            from_simple_if = rigconn.UNIX_PREFIX + local_path
+        self.__from_simple = rigconn.datagram(from_simple_if, simple_local_udp_port)
+        try:
+            # simple may be starting at the same time as we are
+            if local_path:
+                self.__to_simple = rigconn.connect_to(simple_addr, 65, local_path)
+            else:
+                self.__to_simple = rigconn.connect((simple_addr, simple_tcp_port), 65)
+        except error:
+            print "Hamlib compat. service with cache: cannot connect to simple server, exiting."
+            exit(1)
         self.__to_simple.settimeout(0.05)
 
         listen_socket = socket(AF_INET, SOCK_STREAM)
         listen_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
-        is_done = False
-        tries = 0
-        while not is_done and tries < 65:
-            try:
-                listen_socket.bind((self.__parsed_args["listen_addr"], int(self.__parsed_args["listen_tcp_port"])))
-                is_done = True
-            except:
-                sleep(1)
-                is_done = False
-                tries = tries + 1
-        if not is_done:
+        if not rigconn.bind(listen_socket, (self.__parsed_args["listen_addr"], int(self.__parsed_args["listen_tcp_port"])), 65):
             return
         listen_socket.listen(5)
+        self.ready.set()
 
         clients = []
         buffers_dict = {}
@@ -608,6 +601,9 @@ class Service_Hamlib_Compat(Service):
         listen_socket.close()
         self.__from_simple.close()
         self.__to_simple.close()
+        if local_path:
+            rigconn.remove_stale(local_path)
+            rigconn.remove_stale(rigconn.sync_path(local_path, simple_local_udp_port))
 
 
     def start_action(self, args):
@@ -623,6 +619,7 @@ class Service_Hamlib_Compat(Service):
                     current_val = split2[1]
                     self.__parsed_args[current_key] = current_val
 
+        self.ready.clear()          # set by the service process
         self.__process = Process(target=self.__target, args=())
         self.__process.daemon = True
         self.__process.start()
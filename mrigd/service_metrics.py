@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# File: service_metrics.py
+# Version: 1.0
+#
+# mrigd: Prometheus metrics service for rigserve
+# Copyright (c) 2016 German EA4GJA
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# start rigserve.metrics listen_addr=127.0.0.1 listen_tcp_port=14656
+#
+# Serves the rigstats metrics in Prometheus text format on
+# http://<listen_addr>:<listen_tcp_port>/metrics.  Unlike the other
+# services it runs as a thread inside rigserve, since the metrics live
+# in rigserve's memory.
+
+from service import *
+from globals import *
+import threading, BaseHTTPServer
+import rigstats
+
+DEFAULT_LISTEN_ADDR = "127.0.0.1"
+DEFAULT_TCP_PORT = 14656
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = rigstats.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass                    # scraped every few secs: keep quiet
+
+class Service_Metrics(Service):
+    def __init__(self, rig_name):
+        super(Service_Metrics, self).__init__(rig_name)
+        self.description = "Prometheus metrics of rigserve over HTTP"
+        self.__server = None
+        self.__thread = None
+        self.__parsed_args = {}
+
+    def start_action(self, args):
+        super(Service_Metrics, self).start_action(args)
+        split = args.split(" ", 256)
+        for arg in split:
+            if "=" in arg:
+                split2 = arg.split("=", 2)
+                if len(split2) != 2:
+                    return NAK
+                else:
+                    self.__parsed_args[split2[0]] = split2[1]
+
+        addr = self.__parsed_args.get("listen_addr", DEFAULT_LISTEN_ADDR)
+        try:
+            port = int(self.__parsed_args.get("listen_tcp_port",
+                                              DEFAULT_TCP_PORT))
+            self.__server = BaseHTTPServer.HTTPServer((addr, port),
+                                                      MetricsHandler)
+        except Exception, e:
+            self.__server = None
+            return NAK + "metrics: cannot listen on %s: %s" % (addr, e)
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+        return ACK
+
+    def stop_action(self):
+        super(Service_Metrics, self).stop_action()
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+        return ACK
+
+    def status(self):
+        if not self.__thread:
+            return ACK + str(False)
+        return ACK + str(self.__thread.is_alive() and self.__server != None)
@@ -25,8 +25,9 @@
 # Wood Road, Branford CT 06405, USA.
 
 
-import sys,time
+import sys
 from tentec import *
+import linkctl
 
 # To do:
 #  Squelch settings
@@ -65,6 +66,12 @@ ORION_RX_ANTENNAS           = [ 'ANT1', 'ANT2', 'ANT3' ]
 
 ORION_MEMORY_CHANNELS       = [ 1, 200 ]
 ORION_DSP_DELAY             = 0.2   # secs to wait after bandpass op.
+GAU_WT                      = 0.10  # secs before an AGC query (prevents timeouts)
+ORION_MEMORY_DELAY          = ORION_DSP_DELAY + 0.2 # after memory -> vfo
+# Fixed waits, as linkctl pacing classes: the worst case, which the link
+# controller cuts down to what the rig's firmware is seen to need.
+ORION_GAPS                  = { 'dsp':ORION_DSP_DELAY, 'agc':GAU_WT,
+                                'memory':ORION_MEMORY_DELAY }
 ORION_RIT_RANGE_LIST        = [-10000., +10000.]    # float Hz
 ORION_XIT_RANGE_LIST        = ORION_RIT_RANGE_LIST
 
@@ -136,8 +143,30 @@ class TT_orion(Tentec):
         self.atten_v    = { }           # attenuator setting, string
         self.preamp_v   = { }           # on/off, bool (int)
         self.memory_channel_v = 1       # current channel, int
+        # Pacing, timeouts and retries learned per firmware (class name)
+        self.link = linkctl.LinkControl(self.__class__.__name__, None,
+                                        ORION_GAPS)
         return
 
+    # Queries are answered: they are timed, and sent again if lost (e.g.
+    # by v1 firmware, when they come too soon).  Sets are only paced.
+    def transact(self, msg, cmd):
+        if cmd[:1] == '?':
+            return self.link.run(cmd, lambda timeout:
+                                 self.query(msg, cmd, timeout))
+        return self.link.run(None, lambda timeout:
+                             Tentec.transact(self, msg, cmd))
+
+    def query(self, msg, cmd, timeout):
+        if timeout == None or not self.ser:
+            return Tentec.transact(self, msg, cmd)
+        fixed = self.ser.timeout
+        try:
+            self.ser.timeout = timeout
+            return Tentec.transact(self, msg, cmd)
+        finally:
+            self.ser.timeout = fixed
+
     def info(self,tp,rx='',data=''):
         if tp == T_PUT: return NO_WRITE
         elif tp == T_GET:
@@ -150,6 +179,8 @@ class TT_orion(Tentec):
         # 'Put' performs serial initialization
         if tp == T_PUT:
             Tentec.serial_init(self,data)
+            self.link = linkctl.LinkControl(self.__class__.__name__,
+                getattr(self.ser, 'timeout', None), ORION_GAPS)
             r = self.transact('init: error','XX')   # This is an Orion mystery
             if is_nak(r): return r                  # (does it do anything?)
             # Set up default VFO / Rx/Tx config (A<->MAIN, B<->SUB ?)
@@ -320,7 +351,7 @@ class TT_orion(Tentec):
                 return NAK+'bandpass_limits bad request %s' % data
             cmd = '*R%cF%d' % (ORION_RX_MAP[rx], int(width) )
             self.transact('put filter bw',cmd)              # Send filter BW
-            time.sleep(ORION_DSP_DELAY)
+            self.link.hold('dsp')
             cmd = '*R%cP%d' % (ORION_RX_MAP[rx], int(offset) )
             self.transact('put pbt',cmd)                    # Send PBT offset
             self.bandpass_v[rx] = [offset, width]   # remember as floats
@@ -361,9 +392,10 @@ class TT_orion(Tentec):
             print "DEBUG **** bandpass offs, wid = ",offset,width
             cmd = '*R%cP%d' % ( ORION_RX_MAP[rx], int(offset) )
             self.transact('bandpass put pbt',cmd)   # Send PBT offset
-            time.sleep(ORION_DSP_DELAY)
+            self.link.hold('dsp')
             cmd = '*R%cF%d' % ( ORION_RX_MAP[rx], int(width) )
             self.transact('bandpass put bw',cmd)    # send filter BW
+            self.link.hold('dsp')
             self.bandpass_v[rx] = [offset, width]   # remember as float Hz
             return ACK
         elif tp == T_GET:
@@ -446,10 +478,9 @@ class TT_orion(Tentec):
             return ACK
         elif tp == T_GET:
             if not rx in ORION_RX_LIST: return NAK+'rx invalid: %s' % rx
-            GAU_WT = 0.10                   # seems to prevent timeouts
             self.agc_mode(T_PUT,rx, 'PROG')
             cmd = '?R%cAD' % ORION_RX_MAP[rx]
-            time.sleep(GAU_WT)
+            self.link.hold('agc')           # seems to prevent timeouts
             r = self.transact('get db/sec',cmd)
             if is_nak(r): return r
             try:
@@ -458,7 +489,7 @@ class TT_orion(Tentec):
                 return NAK+'agc_user bad response 1 %s' % r
             tc = 3.0 / db_per_sec
             cmd = '?R%cAH' % ORION_RX_MAP[rx]
-            time.sleep(GAU_WT)
+            self.link.hold('agc')
             r = self.transact('get hold time',cmd)
             if is_nak(r): return r
             try:
@@ -466,7 +497,7 @@ class TT_orion(Tentec):
             except:
                 return NAK+'agc_user bad response 2 %s' % r
             cmd = '?R%cAT' % ORION_RX_MAP[rx]
-            time.sleep(GAU_WT)
+            self.link.hold('agc')
             r = self.transact('get threshold',cmd)
             if is_nak(r): return r
             try:
@@ -780,11 +811,11 @@ class TT_orion(Tentec):
             ch = int(self.memory_channel_v)
             self.transact('get vfo_memory',
                 '*KR%c%d' % (ORION_VFO_MAP[vfo],ch))  # Send mem to vfo.
-            time.sleep(ORION_DSP_DELAY)     # (change to bandpass)
+            # (change to bandpass) and avoid read timeout
+            self.link.hold('memory')
             # possibly should use Backend methods to store new Mode, BW,
             # and PBT, as well as VFO freq.  However, this requires an
             # analysis of which rx is currently attached to this vfo!
-            time.sleep(0.2)                 # Avoid read timeout
             ans = self.freq(T_GET,vfo)      # NB the vfo is not restored
             return ans                      # returns only the freq.
         elif tp == T_TEST: return ACK